@@ -0,0 +1,383 @@
+"""MPythonG123的基准测试，用合成数据的解码器和不出声的输出设备，不需要libmpg123、声卡和GTK，可以在CI中运行。
+python3 mpgbench.py --output bench.json 运行全部测试并保存结果，--compare old.json 和之前的结果比较"""
+import argparse
+import json
+import math
+import os
+import platform
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from mpg123 import ENC_FLOAT_32, ENC_SIGNED_16, ENC_SIGNED_32
+
+
+class SyntheticStream:
+    """和Mpg123Stream接口一样的流，输出44.1kHz双声道16位的正弦波，不读文件"""
+
+    RATE = 44100
+    CHANNELS = 2
+    PERIOD = 100  # 441Hz
+    PATTERN = None  # 所有流共用的一段PCM数据，长度为周期的整数倍
+
+    def __init__(self, path: str, seconds: float):
+        self.path = path
+        self.source = None  # 不读文件，没有读取统计
+        self.format = (self.RATE, self.CHANNELS, ENC_SIGNED_16)
+        self.sampleSize = self.CHANNELS * 2
+        self.total = int(seconds * self.RATE)
+        self.decoded = 0
+        self.prefetched = None
+        self.successor = None
+        self.seekIndex = None
+        self.pendingIndex = None
+        self.gains = dict()
+        if SyntheticStream.PATTERN is None:
+            wave = array('h', (int(8000 * math.sin(2 * math.pi * (i // 2) / self.PERIOD))
+                               for i in range(self.PERIOD * 164 * self.CHANNELS)))
+            SyntheticStream.PATTERN = memoryview(wave.tobytes())
+
+    @property
+    def rate(self):
+        return self.format[0]
+
+    def length(self):
+        return self.total
+
+    def duration(self):
+        return self.total / self.rate
+
+    def useIndex(self, index):
+        self.pendingIndex = index
+
+    def seek(self, sample: int):
+        self.decoded = max(0, min(sample, self.total))
+
+    def prefetch(self, size: int):
+        pass
+
+    def readInto(self, view: memoryview):
+        size = min(len(view) // self.sampleSize, self.total - self.decoded) * self.sampleSize
+        filled = 0
+        offset = self.decoded * self.sampleSize % (self.PERIOD * self.sampleSize)
+        while filled < size:  # 从正弦波的当前相位开始复制
+            count = min(size - filled, len(self.PATTERN) - offset)
+            view[filled:filled + count] = self.PATTERN[offset:offset + count]
+            filled += count
+            offset = 0
+        self.decoded += size // self.sampleSize
+        return size
+
+
+class NullOutput:
+    """丢弃数据的输出设备，realtime为True时按采样率阻塞，和声卡一样，speed为播放的倍速"""
+
+    WIDTHS = {ENC_SIGNED_16: 2, ENC_SIGNED_32: 4, ENC_FLOAT_32: 4}
+    LEAD = 0.05  # 设备缓冲区的长度，秒
+
+    def __init__(self, realtime=False, speed=1.0):
+        self.realtime = realtime
+        self.speed = speed
+        self.bytesPerSecond = 0
+        self.bytes = 0
+        self.clock = None  # realtime时设备播放到的时间
+
+    def start(self, rate: int, channels: int, encoding: int):
+        self.bytesPerSecond = rate * channels * self.WIDTHS.get(encoding, 2)
+
+    def play(self, view: memoryview, size: int):
+        self.bytes += size
+        if not self.realtime:
+            return
+        now = time.perf_counter()
+        self.clock = max(self.clock or now, now) + size / self.bytesPerSecond / self.speed
+        if self.clock - now > self.LEAD / self.speed:  # 设备中已经有足够的数据，等它播放
+            time.sleep(self.clock - now - self.LEAD / self.speed)
+
+    def drop(self):
+        self.clock = None
+
+
+class SyntheticBackend:
+    """Player的后端，每首歌都是trackSeconds长的合成流"""
+
+    def __init__(self, trackSeconds=180.0, realtime=False, speed=1.0):
+        self.trackSeconds = trackSeconds
+        self.realtime = realtime
+        self.speed = speed
+
+    def openStream(self, filePath: str):
+        return SyntheticStream(filePath, self.trackSeconds)
+
+    def buildIndex(self, filePath: str):
+        return None
+
+    def openOutput(self):
+        return NullOutput(self.realtime, self.speed)
+
+
+class MainLoop:
+    """代替GLib/asyncio的主循环，schedule可以在任意线程中调用，runUntil只在测试线程中调用"""
+
+    def __init__(self):
+        self.calls = queue.Queue()
+        self.timers = list()
+
+    def schedule(self, func, *args):
+        self.calls.put((func, args))
+
+    def later(self, seconds: float, func):
+        self.timers.append((time.perf_counter() + seconds, func))
+
+    def runUntil(self, condition, timeout=60.0):
+        """执行积压的调用直到condition()为真，返回是否满足"""
+        deadline = time.perf_counter() + timeout
+        while not condition():
+            now = time.perf_counter()
+            if now > deadline:
+                return False
+            due = [timer for timer in self.timers if timer[0] <= now]
+            for timer in due:
+                self.timers.remove(timer)
+                timer[1]()
+            try:
+                func, args = self.calls.get(timeout=0.001)
+            except queue.Empty:
+                continue
+            func(*args)
+        return True
+
+
+def makeTree(root: str, files: int, perDir=20):
+    """生成artist/album/track.mp3的目录树，文件只有几个字节"""
+    for i in range(files):
+        dd = os.path.join(root, f'artist{i // (perDir * 10):04d}', f'album{i // perDir % 10:02d}')
+        if i % perDir == 0:
+            os.makedirs(dd, exist_ok=True)
+        with open(os.path.join(dd, f'{i % perDir:02d} track {i}.mp3'), 'wb') as fp:
+            fp.write(b'ID3')
+
+
+def syntheticRows(count: int):
+    return [(f'/music/artist{i // 200:04d}/album{i // 20 % 10:02d}', f'{i % 20:02d} track {i}', 180.0,
+             f'Track {i}', f'Artist {i // 200}', f'Album {i // 20}', 1) for i in range(count)]
+
+
+def timed(func, *args):
+    began = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - began, result
+
+
+def benchScan(workdir: str, files: int):
+    """冷启动扫描和用缓存的曲库热启动"""
+    from mpgcore import LibraryScanner, MusicCatalog
+    root = os.path.join(workdir, 'library')
+    makeTree(root, files)
+    dbFile = os.path.join(workdir, 'scan.db')
+    results = dict()
+
+    for name, cached in (('cold', False), ('warm', True)):
+        loop = MainLoop()
+        state = {'rows': 0, 'first': None, 'done': False}
+
+        def onScanned(rows, isDone, cached=False):
+            if rows and state['first'] is None:
+                state['first'] = time.perf_counter()
+            state['rows'] += len(rows)
+            state['done'] = isDone
+
+        began = time.perf_counter()
+        catalog = MusicCatalog(dbFile)
+        scanner = LibraryScanner(catalog, onScanned, loop.schedule)
+        scanner.start([root], cached=cached)
+        loop.runUntil(lambda: state['done'])
+        elapsed = time.perf_counter() - began
+        results[name] = {'files': state['rows'], 'seconds': elapsed, 'filesPerSecond': state['rows'] / elapsed,
+                         'firstRows': (state['first'] or began) - began}
+        if cached:  # 热启动之后在后台核对整个目录树
+            done = threading.Event()
+            began = time.perf_counter()
+            scanner.refresh([root], lambda removed, rows: done.set(), deep=True)
+            loop.runUntil(done.is_set)
+            results['verify'] = {'seconds': time.perf_counter() - began}
+        catalog.db.close()
+    return results
+
+
+def benchShuffle(sizes: list, picks=10000):
+    from mpgcore import ShuffleEngine
+    results = dict()
+    for size in sizes:
+        shuffle = ShuffleEngine(seed=size)
+        grow, _ = timed(shuffle.grow, size)
+        current = -1
+        began = time.perf_counter()
+        for _ in range(picks):
+            current = shuffle.next(current)
+        elapsed = time.perf_counter() - began
+        results[str(size)] = {'growSeconds': grow, 'pickMicroseconds': elapsed / picks * 1e6}
+    return results
+
+
+def benchListPopulation(model, loop: MainLoop, count: int):
+    """把count首歌加入Model并经过通知总线送到列表，然后建立搜索索引"""
+    shown = array('I')
+
+    def onData(ids, mode, append=False):
+        if not append:
+            del shown[:]
+        shown.extend(ids)
+
+    model.registerCallbacks(data=onData)
+    model.reset()
+    rows = syntheticRows(count)
+    began = time.perf_counter()
+    model.addRows(rows)
+    loop.runUntil(lambda: len(shown) == count)
+    populate = time.perf_counter() - began
+    index, _ = timed(model.indexUpTo, len(model.tracks))
+    search, _ = timed(model.setFilter, 'track 1')  # 第一帧显示的结果
+    searchAll, _ = timed(model.finishSearch)
+    matched = len(model.view)
+    model.setFilter('')
+    return {'tracks': count, 'populateSeconds': populate, 'indexSeconds': index, 'searchSeconds': search,
+            'searchAllSeconds': searchAll, 'matched': matched}
+
+
+NEXT_TRACK_SPEED = 20.0
+
+
+def benchNextTrack(model, loop: MainLoop, runs: int):
+    """按下一首到输出设备收到新歌的第一个槽位的时间，prepared为预先打开了的下一首，cold为没有预测到的。
+    输出设备以NEXT_TRACK_SPEED倍速实时播放，设备正在播放的那一个槽位不会占满测到的时间"""
+    from mpgcore import PlayMode
+    player = model.player
+    model.settings.updateSetting(model.settings.keyMode, PlayMode.loop)
+
+    def started():
+        output = player.ThreadOutput
+        return output is not None and output.current is player.stream and output.samples > 0
+
+    results = dict()
+    for name in ('prepared', 'cold'):
+        latencies = list()
+        model.play(model.tracks.item(0))
+        loop.runUntil(started)
+        for i in range(runs):
+            loop.runUntil(lambda: player.nextStream is not None, 1.0)  # 等后台打开预测的下一首
+            began = time.perf_counter()
+            if name == 'prepared':
+                model.playPrevNext(True)
+            else:
+                model.play(model.tracks.item((i * 7919 + 13) % len(model.tracks)))
+            loop.runUntil(started)
+            latencies.append(time.perf_counter() - began)
+        latencies.sort()
+        results[name] = {'runs': runs, 'median': latencies[len(latencies) // 2], 'max': latencies[-1]}
+    model.stop()
+    return results
+
+
+def benchPipeline(seconds: float):
+    """不限速地把一首合成的歌经过解码线程、环形缓冲区、DSP和输出线程，结果为实时的倍数"""
+    from mpgcore import Player
+    finished = threading.Event()
+    player = Player(lambda isNormalDone, nextPath=None: finished.set(), None, SyntheticBackend(seconds))
+    player.setVolume(0.8)  # 不是满音量，DSP需要处理每个样本
+    player.setReplayGain('off')
+    began = time.perf_counter()
+    player.play('/synthetic/pipeline.mp3')
+    finished.wait(600)
+    elapsed = time.perf_counter() - began
+    return {'audioSeconds': seconds, 'seconds': elapsed, 'realtimeFactor': seconds / elapsed,
+            'underruns': player.underruns, 'bytes': player.output.bytes}
+
+
+def gitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def runAll(quick: bool, only: list):
+    workdir = tempfile.mkdtemp(prefix='mpgbench-')
+    os.environ['XDG_CONFIG_HOME'] = workdir  # 设置和曲库目录都放在临时目录中
+    import mpgcore
+    benchmarks = dict()
+
+    def wanted(name):
+        return not only or name in only
+
+    try:
+        if wanted('scan'):
+            benchmarks['scan'] = benchScan(workdir, 2000 if quick else 20000)
+        if wanted('shuffle'):
+            benchmarks['shuffle'] = benchShuffle([10000, 100000] if quick else [10000, 100000, 1000000])
+        if wanted('list') or wanted('next'):
+            loop = MainLoop()
+            model = mpgcore.Model(loop.schedule, later=loop.later, backend=SyntheticBackend(realtime=True, speed=NEXT_TRACK_SPEED))
+            if wanted('list'):
+                benchmarks['list'] = benchListPopulation(model, loop, 20000 if quick else 100000)
+            if wanted('next'):
+                if not len(model.tracks):
+                    model.addRows(syntheticRows(1000))
+                benchmarks['next'] = benchNextTrack(model, loop, 5 if quick else 20)
+        if wanted('pipeline'):
+            benchmarks['pipeline'] = benchPipeline(120.0 if quick else 1200.0)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {'commit': gitCommit(), 'time': time.time(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'numpy': mpgcore.np is not None, 'quick': quick,
+            'benchmarks': benchmarks}
+
+
+def flatten(tree: dict, prefix=''):
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(old: dict, new: dict):
+    """逐项打印两次结果的比值，时间类的数值变大是变慢，吞吐量类的变大是变快"""
+    before = dict(flatten(old['benchmarks']))
+    print(f'{"":<40}{old.get("commit") or "old":>14}{new.get("commit") or "new":>14}{"ratio":>10}')
+    for key, value in flatten(new['benchmarks']):
+        if key in before:
+            ratio = value / before[key] if before[key] else float('inf')
+            print(f'{key:<40}{before[key]:>14.6g}{value:>14.6g}{ratio:>10.3f}')
+
+
+def main(args: list):
+    parser = argparse.ArgumentParser(prog='mpgbench', description='MPythonG123基准测试')
+    parser.add_argument('--quick', action='store_true', help='用较小的规模，几秒钟跑完')
+    parser.add_argument('--only', action='append', choices=('scan', 'shuffle', 'list', 'next', 'pipeline'),
+                        help='只运行指定的测试，可以重复')
+    parser.add_argument('--output', metavar='FILE', help='把结果保存为JSON')
+    parser.add_argument('--compare', metavar='FILE', help='和之前保存的结果比较')
+    options = parser.parse_args(args[1:])
+
+    results = runAll(options.quick, options.only or [])
+    text = json.dumps(results, indent=1, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            fp.write(text + '\n')
+    if options.compare:
+        with open(options.compare) as fp:
+            compare(json.load(fp), results)
+    elif not options.output:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
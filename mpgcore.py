@@ -0,0 +1,4246 @@
+import ctypes
+import functools
+import hashlib
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import string
+import struct
+import threading
+import time
+import traceback
+import weakref
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum
+from json import JSONDecodeError
+from mpg123 import Mpg123, Out123, OK, DONE, NEW_FORMAT, ENC_FLOAT_32, ENC_SIGNED_16, ENC_SIGNED_32
+try:
+    import numpy as np
+except ImportError:  # 没有numpy时不做音量和ReplayGain处理
+    np = None
+try:
+    import xxhash
+except ImportError:  # 没有xxhash时重复检测用标准库的blake2b，慢一些
+    xxhash = None
+
+MUSIC_EXT = '.mp3'
+MPG123_INDEX_SIZE = 15  # enum mpg123_parms，python包中没有定义
+# 打开一个文件并开始解码时可能出现的错误，例如文件已经被删除或者不是mp3
+STREAM_ERRORS = (OSError, Mpg123.OpenFileException, Mpg123.FormatException, Mpg123.NeedMoreException,
+                 Mpg123.DecodeException)
+
+
+def configDir():
+    """配置和曲库目录所在的文件夹，和GLib.get_user_config_dir的规则一样"""
+    return os.path.join(os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config'), 'MPythonG123')
+
+
+def cacheDir():
+    """可以随时删除的缓存所在的文件夹，和GLib.get_user_cache_dir的规则一样"""
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'MPythonG123')
+
+
+class StartupTrace:
+    """记录启动各阶段的耗时，只有用--startup-trace启动时才打印"""
+
+    def __init__(self):
+        self.started = None
+        self.last = None
+        self.phases = list()
+
+    def begin(self, started: float):
+        """started为time.perf_counter()的值，通常在导入其它模块之前取得"""
+        self.started = self.last = started
+
+    def mark(self, phase: str):
+        if self.started is None:
+            return
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, phase: str):
+        """phase为最后一个阶段，例如第一帧画出来，之后不再记录"""
+        if self.started is None:
+            return
+        self.mark(phase)
+        for name, seconds in self.phases:
+            print(f'startup {name:<16}{seconds * 1000:8.1f} ms')
+        print(f'startup {"total":<16}{(self.last - self.started) * 1000:8.1f} ms')
+        self.started = None
+
+
+startupTrace = StartupTrace()
+
+
+class Histogram:
+    """按2的幂分桶的耗时直方图，单位为秒，observe只做一次二分查找和几次加法"""
+
+    BOUNDS = tuple(1e-6 * 2 ** i for i in range(21))  # 1µs到约1s
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)  # 最后一个桶为超过1s的
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float):
+        """q分位数所在桶的上界，只是估计值"""
+        target = q * self.count
+        total = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            total += count
+            if total >= target:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.quantile(0.5) if self.count else 0.0, 'p99': self.quantile(0.99) if self.count else 0.0,
+                'buckets': list(self.counts)}
+
+
+class Metrics:
+    """运行时指标：耗时直方图、计数器和取值时才计算的gauge，默认不启用。
+    热路径上写成if metrics.enabled: ...，不启用时只多一次属性判断，不调用perf_counter"""
+
+    PREFIX = 'mpythong123_'
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+        self.gauges = dict()  # name -> 数值或者返回数值的函数
+
+    def enable(self):
+        self.enabled = True
+
+    def observe(self, name: str, seconds: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.observe(seconds)
+
+    def add(self, name: str, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def gauge(self, name: str, value):
+        """value为数值，或者取值时调用的函数"""
+        self.gauges[name] = value
+
+    def snapshot(self):
+        gauges = dict()
+        for name, value in list(self.gauges.items()):
+            try:
+                gauges[name] = value() if callable(value) else value
+            except Exception as error:  # gauge读的是其它对象的状态，不能影响导出
+                print(f'read gauge {name} failed, error: {error}')
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        return {'time': time.time(), 'counters': counters, 'gauges': gauges,
+                'histograms': {name: histogram.snapshot() for name, histogram in histograms.items()}}
+
+    def toJson(self):
+        return json.dumps(self.snapshot(), indent=1, sort_keys=True)
+
+    def toPrometheus(self):
+        """Prometheus文本格式，可以交给node_exporter的textfile collector"""
+        snapshot = self.snapshot()
+        lines = list()
+        for name, value in sorted(snapshot['counters'].items()):
+            metric = self.PREFIX + name.replace('.', '_') + '_total'
+            lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        for name, value in sorted(snapshot['gauges'].items()):
+            metric = self.PREFIX + name.replace('.', '_')
+            lines += [f'# TYPE {metric} gauge', f'{metric} {value}']
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            metric = self.PREFIX + name.replace('.', '_') + '_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            total = 0
+            for bound, count in zip(Histogram.BOUNDS, histogram['buckets']):
+                total += count
+                lines.append(f'{metric}_bucket{{le="{bound:g}"}} {total}')
+            lines += [f'{metric}_bucket{{le="+Inf"}} {histogram["count"]}', f'{metric}_sum {histogram["sum"]}',
+                      f'{metric}_count {histogram["count"]}']
+        return '\n'.join(lines) + '\n'
+
+    def toText(self):
+        """给调试面板看的简短文本"""
+        snapshot = self.snapshot()
+        lines = [f'{name:<28}{value}' for name, value in sorted(snapshot['counters'].items())]
+        lines += [f'{name:<28}{value:.4g}' if isinstance(value, float) else f'{name:<28}{value}'
+                  for name, value in sorted(snapshot['gauges'].items())]
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            mean = histogram['sum'] / histogram['count'] if histogram['count'] else 0.0
+            lines.append(f'{name:<28}n={histogram["count"]} mean={mean * 1000:.3f}ms p50<{histogram["p50"] * 1000:.3f}ms '
+                         f'p99<{histogram["p99"] * 1000:.3f}ms max={histogram["max"] * 1000:.3f}ms')
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
+
+
+def writeAtomic(path: str, data):
+    """先写临时文件并fsync，再用os.replace替换，中途崩溃时原来的文件不受影响，读的一方也不会读到一半。data为str或者bytes"""
+    temp = path + '.tmp'
+    with open(temp, 'wb' if isinstance(data, (bytes, bytearray)) else 'w') as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temp, path)
+
+
+class MetricsDumper(threading.Thread):
+    """定期把指标写到文件，扩展名为.prom时为Prometheus文本格式，否则为JSON"""
+
+    def __init__(self, path: str, interval=10.0):
+        threading.Thread.__init__(self, name='metrics', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+
+    def stop(self):
+        self.stopped.set()
+        self.dump()
+
+    def dump(self):
+        text = metrics.toPrometheus() if self.path.endswith('.prom') else metrics.toJson()
+        try:
+            writeAtomic(self.path, text)
+        except OSError as error:
+            print(f'write metrics to {self.path} failed, error: {error}')
+
+
+def pcmType(encoding: int):
+    """mpg123输出编码对应的numpy类型和满幅值，没有numpy或者不支持的编码返回None"""
+    if np is None:
+        return None
+    if encoding == ENC_SIGNED_16:
+        return np.int16, 32768.0
+    if encoding == ENC_SIGNED_32:
+        return np.int32, 2147483648.0
+    if encoding == ENC_FLOAT_32:
+        return np.float32, 1.0
+    return None
+
+
+class ItemMusic:
+    """曲库中一首歌的轻量视图，只为界面实际用到的行创建，index即在TrackTable中的id"""
+
+    __slots__ = ('name', 'path', 'index')
+
+    def __init__(self, name, path='', index=0):
+        self.name = name
+        self.path = path
+        self.index = index
+
+    def __repr__(self):
+        return f'music name: {self.name}, path: {self.path}, index: {self.index}'
+
+    def __eq__(self, other):
+        return isinstance(other, ItemMusic) and self.index == other.index and self.path == other.path
+
+
+class StringColumn:
+    """把大量字符串以utf-8紧凑地存放在一个bytearray中，按行号取出"""
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.starts = array('Q')
+        self.lengths = array('I')
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index: int):
+        start = self.starts[index]
+        return self.blob[start:start + self.lengths[index]].decode('utf-8', 'surrogateescape')
+
+    def append(self, text: str):
+        data = text.encode('utf-8', 'surrogateescape')
+        self.starts.append(len(self.blob))
+        self.lengths.append(len(data))
+        self.blob += data
+
+    def set(self, index: int, text: str):
+        """新内容追加到末尾，旧内容占用的空间不回收"""
+        data = text.encode('utf-8', 'surrogateescape')
+        self.starts[index] = len(self.blob)
+        self.lengths[index] = len(data)
+        self.blob += data
+
+    def clear(self):
+        self.blob = bytearray()
+        self.starts = array('Q')
+        self.lengths = array('I')
+
+
+class TrackTable:
+    """列式存储的曲库：目录前缀去重后存一份，文件名存在一个字符串表里，时长存在数组里，行号就是歌曲id"""
+
+    TAG_NONE = 0
+    TAG_PENDING = 1
+    TAG_DONE = 2
+
+    def __init__(self):
+        self.generation = 0  # 每次清空加一，用来丢弃之前的异步结果
+        self.dirs = list()
+        self.dirIds = dict()
+        self.dirColumn = array('I')
+        self.names = StringColumn()  # 不含扩展名的文件名
+        self.titles = StringColumn()
+        self.artists = StringColumn()
+        self.albums = StringColumn()
+        self.durations = array('f')
+        self.tagged = bytearray()  # 标签的解析状态
+        self.removed = set()  # 文件已经删除的id，id不复用
+
+    def __len__(self):
+        return len(self.dirColumn)
+
+    def clear(self):
+        self.generation += 1
+        self.dirs.clear()
+        self.dirIds.clear()
+        self.dirColumn = array('I')
+        self.names.clear()
+        self.titles.clear()
+        self.artists.clear()
+        self.albums.clear()
+        self.durations = array('f')
+        self.tagged = bytearray()
+        self.removed.clear()
+
+    def extend(self, rows: list):
+        """rows为(dir, name, duration, title, artist, album, tagged)的列表，返回新加入行的id范围"""
+        first = len(self)
+        for dd, name, duration, title, artist, album, tagged in rows:
+            dirId = self.dirIds.get(dd)
+            if dirId is None:
+                dirId = self.dirIds[dd] = len(self.dirs)
+                self.dirs.append(dd)
+            self.dirColumn.append(dirId)
+            self.names.append(name)
+            self.titles.append(title or '')
+            self.artists.append(artist or '')
+            self.albums.append(album or '')
+            self.durations.append(duration or 0.0)
+            self.tagged.append(self.TAG_DONE if tagged else self.TAG_NONE)
+        return range(first, len(self))
+
+    def setMetadata(self, index: int, meta: dict):
+        self.titles.set(index, meta.get('title') or '')
+        self.artists.set(index, meta.get('artist') or '')
+        self.albums.set(index, meta.get('album') or '')
+        if meta.get('duration') and not self.durations[index]:
+            self.durations[index] = meta['duration']
+        self.tagged[index] = self.TAG_DONE
+
+    def invalidate(self, index: int, duration):
+        """文件内容变了，需要重新解析标签，解析完成前仍显示旧的名称"""
+        self.durations[index] = duration or 0.0
+        self.tagged[index] = self.TAG_NONE
+
+    def remove(self, index: int):
+        self.removed.add(index)
+        self.tagged[index] = self.TAG_DONE  # 不再解析标签
+
+    def liveIds(self):
+        if not self.removed:
+            return array('I', range(len(self)))
+        return array('I', (index for index in range(len(self)) if index not in self.removed))
+
+    def find(self, paths):
+        """返回paths中仍在曲库中的路径到id的映射，只遍历一次目录列"""
+        wanted = dict()
+        for path in paths:
+            dd, name = os.path.split(path)
+            dirId = self.dirIds.get(dd)
+            if dirId is not None and name.endswith(MUSIC_EXT):
+                wanted.setdefault(dirId, dict())[name[:-len(MUSIC_EXT)]] = path
+        found = dict()
+        if not wanted:
+            return found
+        for index, dirId in enumerate(self.dirColumn):
+            names = wanted.get(dirId)
+            if names is not None and index not in self.removed:
+                path = names.get(self.names[index])
+                if path is not None:
+                    found[path] = index
+        return found
+
+    def untagged(self):
+        """还没有解析标签的id，返回后标记为正在解析"""
+        ids = [index for index, tagged in enumerate(self.tagged) if tagged == self.TAG_NONE]
+        for index in ids:
+            self.tagged[index] = self.TAG_PENDING
+        return ids
+
+    def name(self, index: int):
+        """显示的名称，有标签时为"艺术家 - 标题"，否则为文件名"""
+        title = self.titles[index]
+        if not title:
+            return self.names[index]
+        artist = self.artists[index]
+        return f'{artist} - {title}' if artist else title
+
+    def searchText(self, index: int):
+        return f'{self.names[index]} {self.titles[index]} {self.artists[index]} {self.albums[index]}'
+
+    def path(self, index: int):
+        return os.path.join(self.dirs[self.dirColumn[index]], self.names[index] + MUSIC_EXT)
+
+    def item(self, index: int):
+        return ItemMusic(name=self.name(index), path=self.path(index), index=index)
+
+
+class PlayMode(Enum):
+    loop = 0
+    random = 1
+    singleLoop = 2
+    sequence = 3
+
+    def next(self):
+        return PlayMode.__new__(PlayMode, (self.value + 1) % 4)
+
+
+class ShuffleEngine:
+    """随机播放引擎：惰性的Fisher–Yates洗牌，O(1)选出下一首且一轮之内不重复，保留可以前进后退的播放历史"""
+
+    HISTORY_SIZE = 1000
+    ABSENT = 0xFFFFFFFF  # positions中不在洗牌范围内的id
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.bag = array('I')  # bag[:drawn]为本轮已经播放过的id，bag[drawn:]为还没播放的
+        self.positions = array('I')  # id -> 在bag中的位置
+        self.drawn = 0
+        self.history = list()
+        self.cursor = -1
+        self.peeked = -1  # peek提前抽出、还没有播放到的id
+
+    def __len__(self):
+        return len(self.bag)
+
+    def reset(self):
+        self.bag = array('I')
+        self.positions = array('I')
+        self.drawn = 0
+        self.restart()
+
+    def restart(self):
+        """开始新的一轮，清空历史"""
+        self.drawn = 0
+        self.history.clear()
+        self.cursor = -1
+        self.peeked = -1
+
+    def grow(self, size: int):
+        """曲库新增了id在[len(positions), size)之间的歌曲，都加入未播放的部分"""
+        first = len(self.positions)
+        if size > first:
+            self.positions.extend(range(len(self.bag), len(self.bag) + size - first))
+            self.bag.extend(range(first, size))
+
+    def resize(self, size: int):
+        """曲库新增了歌曲，但不加入洗牌的范围"""
+        if size > len(self.positions):
+            self.positions.extend(array('I', [self.ABSENT]) * (size - len(self.positions)))
+
+    def add(self, ids):
+        """把resize过的id加入未播放的部分"""
+        for index in ids:
+            if not self.contains(index):
+                self.positions[index] = len(self.bag)
+                self.bag.append(index)
+
+    def restrict(self, ids, size: int):
+        """只在ids（例如搜索的结果）中洗牌，重新开始一轮，保留历史"""
+        self.bag = array('I', ids)
+        self.positions = array('I', [self.ABSENT]) * size
+        for position, index in enumerate(self.bag):
+            self.positions[index] = position
+        self.drawn = 0
+        if self.peeked >= 0 and self.peeked in self.history[self.cursor + 1:]:
+            del self.history[self.cursor + 1:]
+        self.peeked = -1
+
+    def contains(self, index: int):
+        return index < len(self.positions) and self.positions[index] < len(self.bag) \
+            and self.bag[self.positions[index]] == index
+
+    def swap(self, i: int, j: int):
+        a, b = self.bag[i], self.bag[j]
+        self.bag[i], self.bag[j] = b, a
+        self.positions[a], self.positions[b] = j, i
+
+    def remove(self, index: int):
+        """曲库删除了一首歌"""
+        if not self.contains(index):
+            return
+        if self.positions[index] < self.drawn:
+            self.swap(self.positions[index], self.drawn - 1)
+            self.drawn -= 1
+        self.swap(self.positions[index], len(self.bag) - 1)
+        self.bag.pop()
+        if index == self.peeked:
+            self.peeked = -1
+        if index in self.history:
+            self.cursor -= sum(1 for ii in self.history[:self.cursor + 1] if ii == index)
+            self.history = [ii for ii in self.history if ii != index]
+
+    def markPlayed(self, index: int):
+        """把歌曲移到本轮已播放的部分"""
+        if self.contains(index) and self.positions[index] >= self.drawn:
+            self.swap(self.positions[index], self.drawn)
+            self.drawn += 1
+
+    def unmarkPlayed(self, index: int):
+        """把歌曲放回本轮未播放的部分"""
+        if self.contains(index) and self.positions[index] < self.drawn:
+            self.swap(self.positions[index], self.drawn - 1)
+            self.drawn -= 1
+
+    def draw(self, avoid: int):
+        """从未播放的部分随机取一首，新一轮开始时尽量不和avoid重复"""
+        if self.drawn >= len(self.bag):
+            self.drawn = 0
+        remaining = len(self.bag) - self.drawn
+        j = self.drawn + self.random.randrange(remaining)
+        if self.bag[j] == avoid and remaining > 1:
+            j = self.drawn + (j - self.drawn + 1 + self.random.randrange(remaining - 1)) % remaining
+        self.swap(self.drawn, j)
+        self.drawn += 1
+        return self.bag[self.drawn - 1]
+
+    def push(self, index: int):
+        if self.peeked >= 0 and self.peeked in self.history[self.cursor + 1:]:
+            self.unmarkPlayed(self.peeked)  # 预测的下一首没有播放到，放回去
+        self.peeked = -1
+        del self.history[self.cursor + 1:]  # 从历史中间开始播放新的歌曲时丢弃前进的历史
+        self.history.append(index)
+        if len(self.history) > self.HISTORY_SIZE:
+            del self.history[:len(self.history) - self.HISTORY_SIZE]
+        self.cursor = len(self.history) - 1
+
+    def played(self, index: int):
+        """用户直接选择播放了某首歌"""
+        if not self.history or self.history[self.cursor] != index:
+            self.push(index)
+        self.markPlayed(index)
+
+    def restore(self, history: list):
+        """恢复上次保存的播放历史，最后一首为当前歌曲，历史中的歌曲算作本轮已经播放过"""
+        self.restart()
+        self.history = [index for index in history if self.contains(index)][-self.HISTORY_SIZE:]
+        self.cursor = len(self.history) - 1
+        for index in self.history:
+            self.markPlayed(index)
+
+    def peek(self, current=-1):
+        """预测下一首，之后调用next会返回同一首"""
+        if self.cursor < len(self.history) - 1:
+            return self.history[self.cursor + 1]
+        if not self.bag:
+            return -1
+        if current < 0 and self.history:
+            current = self.history[self.cursor]
+        self.peeked = self.draw(current)
+        self.history.append(self.peeked)
+        return self.peeked
+
+    def next(self, current=-1):
+        index = self.peek(current)
+        if index >= 0:
+            self.cursor += 1
+            if index == self.peeked:
+                self.peeked = -1
+            if len(self.history) > self.HISTORY_SIZE:
+                del self.history[:len(self.history) - self.HISTORY_SIZE]
+                self.cursor = len(self.history) - 1
+        return index
+
+    def prev(self):
+        if self.cursor <= 0:
+            return -1
+        self.cursor -= 1
+        return self.history[self.cursor]
+
+
+class SearchIndex:
+    """曲库搜索索引：词内的三元组倒排索引用于子串匹配，词首的一两个字符用于短的查询，随曲库变化增量更新"""
+
+    PREFIX = '\x01'
+    SPLIT = re.compile(r'[\W_]+')
+
+    class Query:
+        """一次搜索：先求出升序的候选id，再分批校验，结果很多时不用在一帧之内校验完"""
+
+        def __init__(self, index, words: list, candidates, end: int):
+            self.index = index
+            # 三个字符以内的词直接对应一个gram，只需要校验更新过的歌曲；更长的需要确认是连续出现的
+            self.checks = [(word.encode('utf-8', 'surrogateescape'), len(word) > 3) for word in words]
+            self.candidates = candidates
+            self.position = 0
+            self.end = end  # 搜索了id小于end的歌曲，之后索引的需要另外搜索
+
+        def done(self):
+            return self.position >= len(self.candidates)
+
+        def take(self, count=None):
+            """校验接下来的count个候选，返回其中匹配的id数组（升序），count为None时校验剩下的全部"""
+            stop = len(self.candidates) if count is None else min(len(self.candidates), self.position + count)
+            batch = self.candidates[self.position:stop]
+            self.position = stop
+            keys, stale = self.index.keys, self.index.stale
+            blob, starts, lengths = keys.blob, keys.starts, keys.lengths
+            found = array('I')
+            for index in batch.tolist():
+                for data, always in self.checks:
+                    if (always or index in stale) and blob.find(data, starts[index], starts[index] + lengths[index]) < 0:
+                        break
+                else:
+                    found.append(index)
+            return found
+
+    def __init__(self):
+        self.postings = dict()  # gram -> 按加入顺序的id数组
+        self.keys = StringColumn()  # 每首歌规范化后的搜索文本，用来校验候选结果
+        self.stale = set()  # 更新过的id，倒排索引中可能还有旧的gram
+        self.removed = set()  # 删除了的id，倒排索引中不删除，查询时过滤掉
+
+    def clear(self):
+        self.postings.clear()
+        self.keys.clear()
+        self.stale.clear()
+        self.removed.clear()
+
+    @classmethod
+    def normalize(cls, text: str):
+        return ' '.join(cls.SPLIT.split(text.lower())).strip()
+
+    def grams(self, key: str):
+        grams = set()
+        for token in key.split():
+            grams.add(self.PREFIX + token[:1])
+            grams.add(self.PREFIX + token[:2])
+            for i in range(len(token) - 2):
+                grams.add(token[i:i + 3])
+            if not token.isascii():  # 中日韩文字之间没有空格，每个字都当作词首
+                for i, ch in enumerate(token):
+                    if ord(ch) > 0x7f:
+                        grams.add(self.PREFIX + token[i:i + 2])
+                        grams.add(self.PREFIX + ch)
+        return grams
+
+    def add(self, index: int, text: str):
+        """加入或者更新一首歌，旧的gram不删除，查询时由校验过滤掉"""
+        key = self.normalize(text)
+        while len(self.keys) < index:
+            self.keys.append('')
+        if index < len(self.keys):
+            self.keys.set(index, key)
+            self.stale.add(index)
+        else:
+            self.keys.append(key)
+        for gram in self.grams(key):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array('I')
+            posting.append(index)
+
+    def remove(self, index: int):
+        self.removed.add(index)
+
+    def wordGrams(self, word: str):
+        if len(word) < 3:  # 一两个字符的词只匹配词首
+            return [self.PREFIX + word]
+        return [word[i:i + 3] for i in range(len(word) - 2)]
+
+    def candidates(self, words: list, first: int):
+        """所有词的gram的倒排表的交集中id不小于first的，从最短的倒排表开始求交集，返回升序的id"""
+        postings = sorted((self.postings.get(gram, ()) for word in words for gram in self.wordGrams(word)), key=len)
+        end = len(self.keys)
+        if not postings[0] or first >= end:
+            return array('I')
+        if np is None:
+            found = set(index for index in postings[0] if index >= first)
+            for posting in postings[1:]:
+                if not found:
+                    break
+                found.intersection_update(posting)
+            found.difference_update(self.removed)
+            return array('I', sorted(found))
+        # 在按id的布尔数组上求交集，不建立集合，10万首时常见的词也只要几毫秒
+        found = np.zeros(end - first, bool)
+        mask = np.empty_like(found)
+        for i, posting in enumerate(postings):
+            ids = np.frombuffer(posting, np.uintc)
+            if first:
+                ids = ids[ids >= first] - first
+            if i == 0:
+                found[ids] = True
+                continue
+            mask.fill(False)
+            mask[ids] = True
+            found &= mask
+        for index in self.removed:
+            if first <= index < end:
+                found[index - first] = False
+        return np.flatnonzero(found) + first
+
+    def start(self, query: str, first=0):
+        """开始一次搜索，只搜索id不小于first的歌曲，查询为空时返回None"""
+        words = self.normalize(query).split()
+        if not words:
+            return None
+        return self.Query(self, words, self.candidates(words, first), len(self.keys))
+
+    def search(self, query: str):
+        """一次校验完，返回匹配的id数组（升序），查询为空时返回None"""
+        query = self.start(query)
+        return query.take() if query is not None else None
+
+
+class MusicCatalog:
+    """曲库目录，用sqlite持久化每个文件的路径/大小/修改时间/名称/时长/帧数，重新扫描时只处理有变化的目录和文件"""
+
+    SCHEMA_VERSION = 6
+    TABLES = ('dirs', 'tracks', 'seekindex', 'loudness', 'audiohash')
+    # 从上一个版本升级到这个版本的语句，新增的表由CREATE TABLE IF NOT EXISTS创建，不需要列出。
+    # 帧偏移表和响度的计算代价大，升级时保留，只重建结构变了的表
+    MIGRATIONS = {
+        2: ('DROP TABLE IF EXISTS dirs',),  # 增加了subdirs，目录表只是缓存，重新扫描
+        4: tuple(f'ALTER TABLE tracks ADD COLUMN {column}' for column in (
+            'title TEXT', 'artist TEXT', 'album TEXT', 'trackno INTEGER', 'bitrate INTEGER', 'artOffset INTEGER',
+            'artSize INTEGER', 'tagged INTEGER NOT NULL DEFAULT 0')),
+        5: tuple(f'ALTER TABLE tracks ADD COLUMN {column} REAL'
+                 for column in ('rgTrackGain', 'rgTrackPeak', 'rgAlbumGain', 'rgAlbumPeak')),
+    }
+    REFERENCE_LOUDNESS = -18.0  # ReplayGain 2.0的参考响度，LUFS
+
+    def __init__(self, dbFile=None):
+        if dbFile is None:
+            dbFile = os.path.join(configDir(), 'library.db')
+        os.makedirs(os.path.dirname(dbFile), exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(dbFile, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.createTables()
+
+    def createTables(self):
+        with self.lock, self.db:
+            version = self.db.execute('PRAGMA user_version').fetchone()[0]
+            if version > self.SCHEMA_VERSION:  # 更新的版本创建的，不知道表的结构，直接重建
+                for table in self.TABLES:
+                    self.db.execute(f'DROP TABLE IF EXISTS {table}')
+            elif 0 < version < self.SCHEMA_VERSION:
+                for step in range(version + 1, self.SCHEMA_VERSION + 1):
+                    for statement in self.MIGRATIONS.get(step, ()):
+                        self.db.execute(statement)
+            if version != self.SCHEMA_VERSION:
+                self.db.execute(f'PRAGMA user_version={self.SCHEMA_VERSION}')
+            self.db.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, '
+                            'subdirs TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, dir TEXT NOT NULL, '
+                            'name TEXT NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, '
+                            'duration REAL, frames INTEGER, title TEXT, artist TEXT, album TEXT, trackno INTEGER, '
+                            'bitrate INTEGER, artOffset INTEGER, artSize INTEGER, rgTrackGain REAL, rgTrackPeak REAL, '
+                            'rgAlbumGain REAL, rgAlbumPeak REAL, tagged INTEGER NOT NULL DEFAULT 0)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS tracks_dir ON tracks (dir)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS seekindex (path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                            'mtime INTEGER NOT NULL, rate INTEGER NOT NULL, samples INTEGER NOT NULL, '
+                            'step INTEGER NOT NULL, offsets BLOB NOT NULL)')
+            # 分析失败的文件integrated为NULL，避免每次都重试
+            self.db.execute('CREATE TABLE IF NOT EXISTS loudness (path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                            'mtime INTEGER NOT NULL, integrated REAL, peak REAL)')
+            # 没有音频数据的文件hash为NULL
+            self.db.execute('CREATE TABLE IF NOT EXISTS audiohash (path TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                            'mtime INTEGER NOT NULL, hash TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS audiohash_hash ON audiohash (hash)')
+
+    def tracksInDir(self, dd: str):
+        with self.lock:
+            return self.db.execute('SELECT dir, name, duration, title, artist, album, tagged FROM tracks '
+                                   'WHERE dir=? ORDER BY path', (dd,)).fetchall()
+
+    def scanDir(self, dd: str, mtime: int):
+        """返回目录dd中的歌曲列表（TrackTable.extend的格式）和子目录列表，目录mtime没变时直接使用缓存，不再列目录"""
+        with self.lock:
+            row = self.db.execute('SELECT mtime, subdirs FROM dirs WHERE path=?', (dd,)).fetchone()
+            if row is not None and row[0] == mtime:
+                return self.tracksInDir(dd), row[1].split('\n') if row[1] else []
+
+        _, _, subdirs = self.syncDir(dd, mtime)
+        return self.tracksInDir(dd), subdirs
+
+    def cachedTracks(self, roots: list, firstSize=256, batchSize=4096):
+        """分批生成上次扫描留下的roots下的歌曲（TrackTable.extend的格式），只读数据库不访问文件系统。
+        第一批较小，让界面尽快显示出来；每批单独查询，不长时间占着锁"""
+        dirs = set(self.dirTree(roots))
+        last = ''
+        size = firstSize
+        while dirs:
+            with self.lock:
+                rows = self.db.execute('SELECT path, dir, name, duration, title, artist, album, tagged FROM tracks '
+                                       'WHERE path>? ORDER BY path LIMIT ?', (last, size)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            size = batchSize
+            batch = [row[1:] for row in rows if row[1] in dirs]
+            if batch:
+                yield batch
+
+    def subdirs(self, dd: str):
+        with self.lock:
+            row = self.db.execute('SELECT subdirs FROM dirs WHERE path=?', (dd,)).fetchone()
+        return row[0].split('\n') if row is not None and row[0] else []
+
+    def dirMtime(self, dd: str):
+        with self.lock:
+            row = self.db.execute('SELECT mtime FROM dirs WHERE path=?', (dd,)).fetchone()
+        return row[0] if row is not None else None
+
+    def dirTree(self, roots: list):
+        """roots及其下所有扫描过的目录"""
+        with self.lock:
+            subdirs = dict(self.db.execute('SELECT path, subdirs FROM dirs'))
+        found = list()
+        pending = list(roots)
+        while pending:
+            dd = pending.pop()
+            sub = subdirs.pop(dd, None)  # pop同时防止重复
+            if sub is not None:
+                found.append(dd)
+                if sub:
+                    pending.extend(sub.split('\n'))
+        return found
+
+    def syncDir(self, dd: str, mtime: int):
+        """重新列目录，只对大小或修改时间变化了的文件重新探测，已经不存在的子目录连同其中的歌曲一起删除。
+        返回(删除的歌曲路径, 新增或变化的歌曲（TrackTable.extend的格式）, 子目录)"""
+        found = dict()
+        subdirs = list()
+        with os.scandir(dd) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(MUSIC_EXT) and entry.is_file():
+                    st = entry.stat()
+                    found[entry.path] = (os.path.splitext(entry.name)[0], st.st_size, st.st_mtime_ns)
+
+        with self.lock, self.db:
+            cached = {path: (size, mt) for path, size, mt in
+                      self.db.execute('SELECT path, size, mtime FROM tracks WHERE dir=?', (dd,))}
+            removed = [path for path in cached if path not in found]
+            changed = [(path, dd, name, size, mt) for path, (name, size, mt) in found.items()
+                       if cached.get(path) != (size, mt)]
+            row = self.db.execute('SELECT subdirs FROM dirs WHERE path=?', (dd,)).fetchone()
+            for sub in set(row[0].split('\n') if row and row[0] else ()).difference(subdirs):
+                prefix = sub + os.sep
+                where = 'dir=? OR substr(dir, 1, ?)=?'
+                removed.extend(path for path, in self.db.execute(f'SELECT path FROM tracks WHERE {where}',
+                                                                   (sub, len(prefix), prefix)))
+                self.db.execute(f'DELETE FROM tracks WHERE {where}', (sub, len(prefix), prefix))
+                self.db.execute('DELETE FROM dirs WHERE path=? OR substr(path, 1, ?)=?', (sub, len(prefix), prefix))
+            self.db.executemany('DELETE FROM tracks WHERE path=?', [(path,) for path in removed])
+            self.db.executemany('DELETE FROM seekindex WHERE path=?', [(path,) for path in removed])
+            self.db.executemany('DELETE FROM loudness WHERE path=?', [(path,) for path in removed])
+            self.db.executemany('DELETE FROM audiohash WHERE path=?', [(path,) for path in removed])
+            self.db.executemany('INSERT OR REPLACE INTO tracks (path, dir, name, size, mtime) VALUES (?, ?, ?, ?, ?)',
+                                changed)
+            self.db.execute('INSERT OR REPLACE INTO dirs (path, mtime, subdirs) VALUES (?, ?, ?)',
+                            (dd, mtime, '\n'.join(subdirs)))
+
+        changedPaths = set(path for path, _, _, _, _ in changed)
+        rows = [row for row in self.tracksInDir(dd) if os.path.join(row[0], row[1] + MUSIC_EXT) in changedPaths]
+        return removed, rows, subdirs
+
+    def seekIndex(self, path: str):
+        """取出缓存的帧偏移表，文件的大小或修改时间变了则返回None"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT rate, samples, step, offsets FROM seekindex '
+                                  'WHERE path=? AND size=? AND mtime=?', (path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row is None:
+            return None
+        offsets = array('q')
+        offsets.frombytes(row[3])
+        return SeekIndex(row[0], row[1], row[2], offsets)
+
+    def storeSeekIndex(self, path: str, index):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO seekindex (path, size, mtime, rate, samples, step, offsets) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)', (path, st.st_size, st.st_mtime_ns, index.rate,
+                                                             index.samples, index.step, index.offsets.tobytes()))
+            # 扫描得到的是准确的时长
+            self.db.execute('UPDATE tracks SET duration=? WHERE path=?', (index.duration, path))
+
+    def storeMetadata(self, results: list):
+        with self.lock, self.db:
+            self.db.executemany('UPDATE tracks SET title=?, artist=?, album=?, trackno=?, bitrate=?, artOffset=?, '
+                                'artSize=?, rgTrackGain=?, rgTrackPeak=?, rgAlbumGain=?, rgAlbumPeak=?, '
+                                'duration=COALESCE(duration, ?), frames=?, tagged=1 WHERE path=?',
+                                [(meta.get('title'), meta.get('artist'), meta.get('album'), meta.get('track'),
+                                  meta.get('bitrate'), meta.get('artOffset'), meta.get('artSize'),
+                                  meta.get('rgTrackGain'), meta.get('rgTrackPeak'), meta.get('rgAlbumGain'),
+                                  meta.get('rgAlbumPeak'), meta.get('duration'), meta.get('frames'), path)
+                                 for _, path, meta in results])
+
+    def replayGain(self, path: str):
+        """返回{'track': (增益dB, 峰值), 'album': (增益dB, 峰值)}，标签中没有的不包含，峰值可能为None"""
+        with self.lock:
+            row = self.db.execute('SELECT rgTrackGain, rgTrackPeak, rgAlbumGain, rgAlbumPeak FROM tracks WHERE path=?',
+                                  (path,)).fetchone()
+        gains = dict()
+        if row is not None:
+            if row[0] is not None:
+                gains['track'] = (row[0], row[1])
+            if row[2] is not None:
+                gains['album'] = (row[2], row[3])
+        if 'track' not in gains:  # 标签中没有时使用分析得到的响度
+            gains.update(self.analyzedGain(path))
+        return gains
+
+    def analyzedGain(self, path: str):
+        """专辑的响度为同一目录中同一专辑各曲目按时长加权的能量平均"""
+        gains = dict()
+        join = 'tracks t JOIN loudness l ON l.path=t.path AND l.size=t.size AND l.mtime=t.mtime'
+        with self.lock:
+            row = self.db.execute(f'SELECT l.integrated, l.peak, t.dir, t.album FROM {join} WHERE t.path=?',
+                                  (path,)).fetchone()
+            if row is None or row[0] is None:
+                return gains
+            gains['track'] = (self.REFERENCE_LOUDNESS - row[0], row[1])
+            if not row[3]:
+                return gains
+            album = self.db.execute(f'SELECT l.integrated, l.peak, t.duration FROM {join} '
+                                    'WHERE t.dir=? AND t.album=? AND l.integrated IS NOT NULL', (row[2], row[3])).fetchall()
+        weight = sum(duration or 1.0 for _, _, duration in album)
+        energy = sum((duration or 1.0) * 10 ** (integrated / 10) for integrated, _, duration in album) / weight
+        gains['album'] = (self.REFERENCE_LOUDNESS - 10 * math.log10(energy), max(peak or 0.0 for _, peak, _ in album))
+        return gains
+
+    def unanalyzed(self, paths: list):
+        """paths中还没有分析过响度，或者分析之后文件变了的"""
+        with self.lock:
+            analyzed = set(path for path, in self.db.execute(
+                'SELECT l.path FROM loudness l JOIN tracks t ON l.path=t.path AND l.size=t.size AND l.mtime=t.mtime'))
+        return [path for path in paths if path not in analyzed]
+
+    def storeLoudness(self, results: list):
+        """results为(path, size, mtime, 响度, 峰值)的列表"""
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO loudness (path, size, mtime, integrated, peak) '
+                                'VALUES (?, ?, ?, ?, ?)', results)
+
+    def unhashed(self, paths: list):
+        """paths中还没有计算音频哈希，或者计算之后文件变了、哈希算法换了的"""
+        with self.lock:
+            hashed = set(path for path, in self.db.execute(
+                'SELECT h.path FROM audiohash h JOIN tracks t ON h.path=t.path AND h.size=t.size AND h.mtime=t.mtime '
+                'WHERE h.hash IS NULL OR substr(h.hash, 1, ?)=?', (len(AUDIO_HASH) + 1, AUDIO_HASH + ':')))
+        return [path for path in paths if path not in hashed]
+
+    def storeAudioHashes(self, results: list):
+        """results为(path, size, mtime, hash)的列表"""
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO audiohash (path, size, mtime, hash) VALUES (?, ?, ?, ?)',
+                                results)
+
+    def duplicateGroups(self):
+        """音频哈希相同的歌曲的路径，每组按路径排序，只有一首的不返回"""
+        join = 'audiohash h JOIN tracks t ON h.path=t.path AND h.size=t.size AND h.mtime=t.mtime'
+        with self.lock:
+            rows = self.db.execute(f'SELECT h.hash, h.path FROM {join} WHERE h.hash IN '
+                                   f'(SELECT h.hash FROM {join} GROUP BY h.hash HAVING COUNT(*) > 1) '
+                                   'ORDER BY h.hash, h.path').fetchall()
+        groups = dict()
+        for digest, path in rows:
+            groups.setdefault(digest, list()).append(path)
+        return list(groups.values())
+
+
+class LibraryScanner:
+    """在线程池中递归扫描目录，每个子目录一个任务，扫描结果分批通过schedule送回主线程"""
+
+    BATCH_SIZE = 512
+    FLUSH_INTERVAL = 0.05  # 秒
+
+    class Job:
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.cancelled = False
+            self.outstanding = 0
+            self.visited = set()
+            self.pending = list()
+            self.lastFlush = 0.0
+            self.flushed = False
+            self.cached = False  # 送回的是曲库目录中缓存的歌曲，还没有和文件系统核对
+            self.started = time.monotonic()
+            self.files = 0
+
+    def __init__(self, catalog: MusicCatalog, callback, schedule, workers=8):
+        self.catalog = catalog
+        self.callback = callback  # callback(rows, isDone, cached)，在主线程中调用
+        self.schedule = schedule  # schedule(func, *args)，在任意线程中调用，让主线程执行func
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scanner')
+        self.job = None
+
+    def start(self, dirs: list, cached=False):
+        """cached为True时先送回曲库目录中缓存的歌曲，不访问文件系统，没有缓存时照常扫描"""
+        self.cancel()
+        job = self.job = self.Job()
+        if cached:
+            self.executor.submit(self.loadCached, job, dirs)
+            return
+        for dd in dirs:
+            self.submit(job, dd)
+        if not dirs:
+            self.emit(job, [], True)
+
+    def loadCached(self, job, dirs: list):
+        try:
+            for rows in self.catalog.cachedTracks(dirs):
+                if job.cancelled:
+                    return
+                job.cached = True
+                job.files += len(rows)
+                self.schedule(self.dispatch, job, rows, False)
+        except sqlite3.Error as error:
+            print(f'read cached library failed, error: {error}')
+        if job.cached:
+            self.schedule(self.dispatch, job, [], True)
+            return
+        for dd in dirs:  # 第一次运行或者换了目录
+            self.submit(job, dd)
+        if not dirs:
+            self.emit(job, [], True)
+
+    def cancel(self):
+        if self.job is not None:
+            self.job.cancelled = True
+            self.job = None
+
+    def submit(self, job, dd: str):
+        with job.lock:
+            job.outstanding += 1
+        self.executor.submit(self.scanOne, job, dd)
+
+    def scanOne(self, job, dd: str):
+        try:
+            if not job.cancelled:
+                st = os.stat(dd)
+                with job.lock:  # 防止符号链接造成循环
+                    seen = (st.st_dev, st.st_ino) in job.visited
+                    job.visited.add((st.st_dev, st.st_ino))
+                if not seen:
+                    rows, subdirs = self.catalog.scanDir(dd, st.st_mtime_ns)
+                    for sub in subdirs:
+                        self.submit(job, sub)
+                    self.emit(job, rows, False)
+        except OSError as error:
+            print(error)
+        finally:
+            with job.lock:
+                job.outstanding -= 1
+                isDone = job.outstanding == 0
+            if isDone:
+                self.emit(job, [], True)
+
+    def emit(self, job, rows: list, isDone: bool):
+        with job.lock:
+            job.pending.extend(rows)
+            job.files += len(rows)
+            now = time.monotonic()
+            # 第一批立即送出，之后攒够一批或者间隔足够长再送
+            if not isDone and job.flushed and len(job.pending) < self.BATCH_SIZE \
+                    and now - job.lastFlush < self.FLUSH_INTERVAL:
+                return
+            if not isDone and not job.pending:
+                return
+            batch, job.pending = job.pending, list()
+            job.flushed = True
+            job.lastFlush = now
+        self.schedule(self.dispatch, job, batch, isDone)
+
+    def dispatch(self, job, batch: list, isDone: bool):
+        if not job.cancelled:  # 取消发生在主线程，这里判断不会有竞争
+            self.callback(batch, isDone, job.cached)
+            if isDone:
+                self.job = None
+                if metrics.enabled:
+                    name = 'scan.cached' if job.cached else 'scan'
+                    elapsed = time.monotonic() - job.started
+                    metrics.add(name + '.files', job.files)
+                    metrics.gauge(name + '.filesPerSecond', job.files / max(elapsed, 1e-6))
+
+    def refresh(self, dirs: list, callback, deep=False):
+        """不管mtime，重新同步dirs中的目录，mtime变了的子目录和新出现的子目录也一并同步。
+        deep为True时检查dirs下的整个目录树，mtime没变的目录只stat不列目录，用于启动时校验缓存的曲库。
+        callback(removed, rows)在主线程中调用，removed为删除的歌曲路径，rows为新增或变化的歌曲"""
+        self.executor.submit(self.refreshRun, dirs, callback, deep)
+
+    def refreshRun(self, dirs: list, callback, deep=False):
+        started = time.monotonic()
+        removed = list()
+        rows = list()
+        visited = set()
+        pending = [(dd, not deep) for dd in dirs]
+        try:
+            while pending:
+                dd, force = pending.pop()
+                try:
+                    st = os.stat(dd)
+                    if (st.st_dev, st.st_ino) in visited:
+                        continue
+                    visited.add((st.st_dev, st.st_ino))
+                    if not force and self.catalog.dirMtime(dd) == st.st_mtime_ns:
+                        if deep:
+                            pending.extend((sub, False) for sub in self.catalog.subdirs(dd))
+                        continue
+                    gone, changed, subdirs = self.catalog.syncDir(dd, st.st_mtime_ns)
+                except OSError as error:  # 目录已经删除，由上级目录的同步处理
+                    print(error)
+                    continue
+                removed.extend(gone)
+                rows.extend(changed)
+                pending.extend((sub, False) for sub in subdirs)
+        finally:
+            if metrics.enabled:
+                metrics.observe('scan.refresh', time.monotonic() - started)
+                metrics.add('scan.refreshDirs', len(visited))
+            self.schedule(callback, removed, rows)
+
+
+ID3_TEXT_FRAMES = {'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album', 'TRCK': 'track',
+                   'TT2': 'title', 'TP1': 'artist', 'TAL': 'album', 'TRK': 'track'}
+ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+REPLAYGAIN_FIELDS = {'replaygain_track_gain': 'rgTrackGain', 'replaygain_track_peak': 'rgTrackPeak',
+                     'replaygain_album_gain': 'rgAlbumGain', 'replaygain_album_peak': 'rgAlbumPeak'}
+
+# MPEG音频帧头中的码率表(kbps)，按(是否MPEG1, layer)索引
+MPEG_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MPEG_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def syncsafe(data: bytes):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def decodeId3Text(data: bytes):
+    if not data:
+        return ''
+    encoding = ID3_ENCODINGS[data[0]] if data[0] < len(ID3_ENCODINGS) else 'latin-1'
+    return data[1:].decode(encoding, 'replace').split('\x00')[0].strip()
+
+
+def parseReplayGain(data: bytes, meta: dict):
+    """TXXX帧的内容为编码、描述和值，只取ReplayGain的四个字段"""
+    if not data:
+        return
+    encoding = ID3_ENCODINGS[data[0]] if data[0] < len(ID3_ENCODINGS) else 'latin-1'
+    parts = [part.strip('\ufeff ') for part in data[1:].decode(encoding, 'replace').split('\x00')]
+    key = REPLAYGAIN_FIELDS.get(parts[0].lower())
+    value = next((part for part in parts[1:] if part), '')
+    if key is not None and key not in meta:
+        try:
+            meta[key] = float(value.split()[0]) if value else None  # 例如"-6.54 dB"
+        except ValueError:
+            pass
+
+
+def id3Tag(fp):
+    """读文件开头的ID3v2标签头，返回(主版本号, 第一帧的偏移, 帧区域的结束, 标签之后音频数据的偏移)，没有标签时返回None"""
+    header = fp.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return None
+    major, flags, size = header[3], header[5], syncsafe(header[6:10])
+    end = 10 + size + (10 if flags & 0x10 else 0)
+    pos = 10
+    if major in (3, 4) and flags & 0x40:  # 扩展头
+        ext = fp.read(4)
+        if len(ext) == 4:  # 文件截断时后面读不到帧
+            pos += syncsafe(ext) if major == 4 else int.from_bytes(ext, 'big') + 4
+    return major, pos, 10 + size, end
+
+
+def id3Frames(fp, major: int, pos: int, limit: int):
+    """生成标签中每一帧的(帧ID, 内容的偏移, 内容的长度)，只读帧头，生成时文件位置在内容的开头"""
+    headerSize = 6 if major == 2 else 10
+    while pos + headerSize <= limit:
+        fp.seek(pos)
+        frameHeader = fp.read(headerSize)
+        if len(frameHeader) < headerSize:  # 标签头中的长度超出了文件
+            return
+        if major == 2:
+            frameId, frameSize = frameHeader[:3], int.from_bytes(frameHeader[3:6], 'big')
+        else:
+            frameId = frameHeader[:4]
+            frameSize = syncsafe(frameHeader[4:8]) if major == 4 else int.from_bytes(frameHeader[4:8], 'big')
+        if not frameId.strip(b'\x00') or frameSize <= 0:  # 到了padding
+            return
+        yield frameId.decode('latin-1'), pos + headerSize, frameSize
+        pos += headerSize + frameSize
+
+
+def parseId3v2(fp, meta: dict):
+    """解析ID3v2标签中需要的文本帧，只读帧头，跳过不需要的帧，返回标签之后音频数据的偏移"""
+    tag = id3Tag(fp)
+    if tag is None:
+        return 0
+    major, pos, limit, end = tag
+    if major not in (2, 3, 4):
+        return end
+
+    for frameId, body, frameSize in id3Frames(fp, major, pos, limit):
+        key = ID3_TEXT_FRAMES.get(frameId)
+        if key is not None and key not in meta and frameSize < 4096:
+            meta[key] = decodeId3Text(fp.read(frameSize))
+        elif frameId in ('TXXX', 'TXX') and frameSize < 256:
+            parseReplayGain(fp.read(frameSize), meta)
+        elif frameId in ('APIC', 'PIC') and 'artOffset' not in meta:  # 只记录封面所在的位置
+            meta['artOffset'] = body
+            meta['artSize'] = frameSize
+    return end
+
+
+def parseId3v1(fp, fileSize: int, meta: dict):
+    """ID3v1标签在文件最后128字节，只填充ID3v2中没有的字段，返回标签大小"""
+    if fileSize < 128:
+        return 0
+    fp.seek(fileSize - 128)
+    tag = fp.read(128)
+    if tag[:3] != b'TAG':
+        return 0
+    for key, start, end in (('title', 3, 33), ('artist', 33, 63), ('album', 63, 93)):
+        if not meta.get(key):
+            meta[key] = tag[start:end].split(b'\x00')[0].decode('latin-1').strip()
+    if not meta.get('track') and tag[125] == 0 and tag[126] != 0:  # ID3v1.1
+        meta['track'] = str(tag[126])
+    return 128
+
+
+def parseMpegHeader(data: bytes, pos: int):
+    """解析pos处的MPEG音频帧头，返回(mpeg1, layer, bitrate, rate, mono, frameSize, samplesPerFrame)"""
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+    version = (data[pos + 1] >> 3) & 3
+    layer = 4 - ((data[pos + 1] >> 1) & 3)
+    bitrateIndex = data[pos + 2] >> 4
+    rateIndex = (data[pos + 2] >> 2) & 3
+    if version == 1 or layer == 4 or bitrateIndex in (0, 15) or rateIndex == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = MPEG_BITRATES[(mpeg1, layer)][bitrateIndex] * 1000
+    rate = MPEG_SAMPLE_RATES[version][rateIndex]
+    padding = (data[pos + 2] >> 1) & 1
+    mono = (data[pos + 3] >> 6) == 3
+    if layer == 1:
+        samples = 384
+        frameSize = (12 * bitrate // rate + padding) * 4
+    else:
+        samples = 1152 if (layer == 2 or mpeg1) else 576
+        frameSize = samples // 8 * bitrate // rate + padding
+    return mpeg1, layer, bitrate, rate, mono, frameSize, samples
+
+
+def findFirstFrame(data: bytes):
+    """返回data中第一个音频帧的(偏移, parseMpegHeader的结果)，没有时返回None"""
+    for pos in range(max(0, len(data) - 4)):
+        header = parseMpegHeader(data, pos)
+        # 下一帧也能解析出来才认为找到了，避免误把数据当成帧头
+        if header is not None and (pos + header[5] + 4 > len(data) or parseMpegHeader(data, pos + header[5])):
+            return pos, header
+    return None
+
+
+def parseMpegInfo(fp, audioStart: int, audioEnd: int, meta: dict):
+    """找到第一个音频帧，从Xing/Info/LAME或VBRI头中读出帧数和编码延迟，计算时长和平均码率"""
+    fp.seek(audioStart)
+    data = fp.read(16384)
+    found = findFirstFrame(data)
+    if found is None:
+        return
+    pos, header = found
+    mpeg1, layer, bitrate, rate, mono, frameSize, samples = header
+
+    frames = totalBytes = 0
+    delay = padding = 0
+    xing = pos + ((21 if mono else 36) if mpeg1 else (13 if mono else 21))
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = int.from_bytes(data[xing + 4:xing + 8], 'big')
+        p = xing + 8
+        if flags & 1:
+            frames = int.from_bytes(data[p:p + 4], 'big')
+            p += 4
+        if flags & 2:
+            totalBytes = int.from_bytes(data[p:p + 4], 'big')
+            p += 4
+        p += (100 if flags & 4 else 0) + (4 if flags & 8 else 0)
+        if data[p:p + 4] in (b'LAME', b'Lavf', b'Lavc', b'GOGO') and p + 24 <= len(data):
+            delay = (data[p + 21] << 4) | (data[p + 22] >> 4)
+            padding = ((data[p + 22] & 0x0F) << 8) | data[p + 23]
+    elif data[pos + 36:pos + 40] == b'VBRI':
+        totalBytes = int.from_bytes(data[pos + 46:pos + 50], 'big')
+        frames = int.from_bytes(data[pos + 50:pos + 54], 'big')
+
+    if frames > 0:
+        meta['frames'] = frames
+        duration = max(0, frames * samples - delay - padding) / rate
+        meta['duration'] = duration
+        meta['bitrate'] = int(totalBytes * 8 / duration) if totalBytes and duration > 0 else bitrate
+    else:  # CBR，按文件大小估算
+        meta['frames'] = max(0, audioEnd - audioStart - pos) // frameSize if frameSize > 0 else None
+        meta['duration'] = max(0, audioEnd - audioStart - pos) * 8 / bitrate
+        meta['bitrate'] = bitrate
+
+
+def readMetadata(path: str):
+    """读取一个mp3文件的标签和时长信息，只读文件头尾需要的部分"""
+    meta = dict()
+    with open(path, 'rb') as fp:
+        fileSize = os.fstat(fp.fileno()).st_size
+        audioStart = parseId3v2(fp, meta)
+        audioEnd = fileSize - parseId3v1(fp, fileSize, meta)
+        parseMpegInfo(fp, audioStart, audioEnd, meta)
+    track = meta.get('track', '').split('/')[0].strip()
+    meta['track'] = int(track) if track.isdigit() else 0
+    return meta
+
+
+def readMetadataBatch(jobs: list):
+    """在工作进程中执行，jobs为(id, path)列表"""
+    results = list()
+    for index, path in jobs:
+        try:
+            results.append((index, path, readMetadata(path)))
+        except (OSError, ValueError, IndexError) as error:  # 一个损坏的文件不影响同一批的其它文件
+            print(f'read metadata from {path} failed, error: {error!r}')
+            results.append((index, path, dict()))
+    return results
+
+
+class MetadataService:
+    """在进程池中并行解析ID3v1/ID3v2和Xing/LAME头，结果存入曲库目录，并分批送回主线程"""
+
+    CHUNK_SIZE = 64
+
+    def __init__(self, catalog: MusicCatalog, callback, schedule, workers=None):
+        self.catalog = catalog
+        self.callback = callback  # callback(generation, results)，在主线程中调用
+        self.schedule = schedule
+        self.workers = workers
+        self.executor = None
+        self.futures = set()
+
+    def request(self, jobs: list, generation: int):
+        if self.executor is None:
+            # 不从带着GTK和音频线程的进程fork工作进程
+            self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('forkserver'))
+        for i in range(0, len(jobs), self.CHUNK_SIZE):
+            future = self.executor.submit(readMetadataBatch, jobs[i:i + self.CHUNK_SIZE])
+            self.futures.add(future)
+            future.add_done_callback(functools.partial(self.onDone, generation))
+
+    def cancel(self):
+        for future in list(self.futures):
+            future.cancel()
+
+    def onDone(self, generation: int, future):
+        """在进程池的管理线程中调用"""
+        self.futures.discard(future)
+        if future.cancelled():
+            return
+        try:
+            results = future.result()
+        except (OSError, ValueError, IndexError, BrokenProcessPool) as error:
+            print(f'metadata worker failed, error: {error!r}')
+            return
+        self.catalog.storeMetadata(results)
+        if metrics.enabled:
+            metrics.add('metadata.files', len(results))
+        self.schedule(self.callback, generation, results)
+
+
+LRC_TAG = re.compile(r'\[(\d+):(\d+(?:[.:]\d+)?)\]')
+LRC_OFFSET = re.compile(r'\[offset:\s*([+-]?\d+)\s*\]', re.IGNORECASE)
+LRC_INFO = re.compile(r'\[[a-zA-Z]+:.*\]$')  # [ar:歌手]这样的信息标签
+LYRICS_MAX_SIZE = 512 * 1024
+
+
+class Lyrics:
+    """解析后的歌词，times升序，第i行从times[i]秒开始。没有时间标签的歌词synced为False，只能整体显示"""
+
+    def __init__(self, times, lines: list, synced=True):
+        self.times = array('d', times)
+        self.lines = lines
+        self.synced = synced
+
+    def __len__(self):
+        return len(self.lines)
+
+    def lineAt(self, seconds: float):
+        """seconds时正在唱的行，第一行之前和不同步的歌词返回-1"""
+        return bisect_right(self.times, seconds) - 1 if self.synced else -1
+
+    def nextChange(self, line: int):
+        """line的下一行开始的时间，没有下一行时返回None"""
+        return self.times[line + 1] if self.synced and line + 1 < len(self.times) else None
+
+    @classmethod
+    def parseLrc(cls, text: str):
+        """LRC格式，一行可以有多个时间标签；没有时间标签的文本作为不同步的歌词，都没有时返回None"""
+        entries = list()
+        plain = list()
+        offset = 0.0
+        for line in text.splitlines():
+            line = line.strip()
+            match = LRC_OFFSET.match(line)
+            if match:  # 毫秒，正数表示歌词提前
+                offset = int(match.group(1)) / 1000
+                continue
+            stamps = list()
+            pos = 0
+            while True:
+                match = LRC_TAG.match(line, pos)
+                if match is None:
+                    break
+                stamps.append(int(match.group(1)) * 60 + float(match.group(2).replace(':', '.')))
+                pos = match.end()
+            content = line[pos:].strip()
+            if stamps:
+                entries.extend((stamp, content) for stamp in stamps)
+            elif content and not LRC_INFO.match(content):
+                plain.append(content)
+        if entries:
+            entries.sort(key=lambda entry: entry[0])
+            return cls([max(0.0, stamp - offset) for stamp, _ in entries], [content for _, content in entries])
+        return cls([], plain, synced=False) if plain else None
+
+
+def decodeLrc(data: bytes):
+    """.lrc文件没有声明编码，依次尝试UTF-8和GB18030"""
+    for encoding in ('utf-8-sig', 'gb18030'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return data.decode('latin-1')
+
+
+def splitId3String(data: bytes, encoding: int):
+    """取出以0结尾的字符串，返回(字符串, 剩下的数据)，UTF-16以两个字节的0结尾"""
+    if encoding in (1, 2):
+        end = 0
+        while True:
+            end = data.find(b'\x00\x00', end)
+            if end < 0 or end % 2 == 0:
+                break
+            end += 1
+        width = 2
+    else:
+        end = data.find(b'\x00')
+        width = 1
+    if end < 0:
+        end, width = len(data), 0
+    codec = ID3_ENCODINGS[encoding] if encoding < len(ID3_ENCODINGS) else 'latin-1'
+    return data[:end].decode(codec, 'replace').lstrip('\ufeff'), data[end + width:]
+
+
+def parseSylt(data: bytes):
+    """SYLT帧：编码、语言、时间格式、内容类型、描述，之后是(文本, 4字节时间)的序列，只支持毫秒的时间格式"""
+    if len(data) < 6 or data[4] != 2:
+        return None
+    encoding = data[0]
+    _, rest = splitId3String(data[6:], encoding)
+    times = list()
+    lines = list()
+    while len(rest) > 4:
+        text, rest = splitId3String(rest, encoding)
+        if len(rest) < 4:
+            break
+        times.append(int.from_bytes(rest[:4], 'big') / 1000)
+        lines.append(text.strip('\r\n'))
+        rest = rest[4:]
+    if not lines:
+        return None
+    order = sorted(range(len(times)), key=times.__getitem__)
+    return Lyrics([times[i] for i in order], [lines[i] for i in order])
+
+
+def parseUslt(data: bytes):
+    """USLT帧：编码、语言、描述、歌词文本，文本有时就是LRC格式"""
+    if len(data) < 5:
+        return None
+    _, rest = splitId3String(data[4:], data[0])
+    text, _ = splitId3String(rest, data[0])
+    return Lyrics.parseLrc(text)
+
+
+def readId3Lyrics(fp):
+    """ID3v2中内嵌的歌词，同步的SYLT优先"""
+    tag = id3Tag(fp)
+    if tag is None or tag[0] not in (2, 3, 4):
+        return None
+    frames = dict()
+    for frameId, body, frameSize in id3Frames(fp, *tag[:3]):
+        if frameId in ('SYLT', 'SLT', 'USLT', 'ULT') and frameId[0] not in frames and frameSize <= LYRICS_MAX_SIZE:
+            frames[frameId[0]] = fp.read(frameSize)
+    lyrics = parseSylt(frames['S']) if 'S' in frames else None
+    if lyrics is None and 'U' in frames:
+        lyrics = parseUslt(frames['U'])
+    return lyrics
+
+
+def loadLyrics(path: str):
+    """先找同名的.lrc文件，没有时找ID3v2中的SYLT/USLT帧，都没有时返回None"""
+    base = os.path.splitext(path)[0]
+    for lrc in (base + '.lrc', base + '.LRC'):
+        try:
+            with open(lrc, 'rb') as fp:
+                return Lyrics.parseLrc(decodeLrc(fp.read(LYRICS_MAX_SIZE)))
+        except FileNotFoundError:
+            continue
+        except OSError as error:
+            print(f'read lyrics {lrc} failed, error: {error}')
+    try:
+        with open(path, 'rb') as fp:
+            return readId3Lyrics(fp)
+    except OSError as error:
+        print(f'read lyrics from {path} failed, error: {error}')
+        return None
+
+
+class LyricsService:
+    """歌词在后台线程中读取和解析，结果按路径放在LRU缓存中，没有歌词的也缓存，不会反复查找。
+    get和加载完后的callback(path, lyrics)都在主线程中"""
+
+    CACHE_SIZE = 32
+
+    def __init__(self, callback, schedule):
+        self.callback = callback
+        self.schedule = schedule
+        self.cache = OrderedDict()
+        self.loading = set()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lyrics')
+
+    def get(self, path: str):
+        """返回(是否已经加载, 歌词)，还没有加载时在后台加载"""
+        if path in self.cache:
+            self.cache.move_to_end(path)
+            return True, self.cache[path]
+        if path not in self.loading:
+            self.loading.add(path)
+            self.executor.submit(self.load, path)
+        return False, None
+
+    def load(self, path: str):
+        self.schedule(self.onLoaded, path, loadLyrics(path))
+
+    def onLoaded(self, path: str, lyrics):
+        self.loading.discard(path)
+        self.cache[path] = lyrics
+        while len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+        self.callback(path, lyrics)
+
+    def forget(self, path: str):
+        """文件变了，下次重新读取"""
+        self.cache.pop(path, None)
+
+
+def kWeighting(rate: int, size: int):
+    """EBU R128（ITU-R BS.1770）K计权两级滤波器在长度为size的rfft各个频点上的功率响应|H|^2"""
+    k = np.tan(np.pi * 1681.974450955533 / rate)  # 高频搁架
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+    k = np.tan(np.pi * 38.13547087602444 / rate)  # 高通
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    highPass = (1.0, -2.0, 1.0, 1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+
+    z = np.exp(-2j * np.pi * np.arange(size // 2 + 1) / size)  # 各频点的z^-1
+    response = np.ones(size // 2 + 1)
+    for b0, b1, b2, _, a1, a2 in (shelf, highPass):
+        response *= np.abs((b0 + b1 * z + b2 * z * z) / (1 + a1 * z + a2 * z * z)) ** 2
+    return response
+
+
+def measureLoudness(path: str):
+    """解码整个文件，返回(响度LUFS, 采样峰值)，太短或者静音时响度为None。
+    按100ms分段做rfft，用Parseval在频域求K计权后的能量，400ms、75%重叠的块做绝对(-70LUFS)和相对(-10LU)门限"""
+    stream = Mpg123Stream(path)
+    rate, channels, encoding = stream.format
+    pcm = pcmType(encoding)
+    if pcm is None:
+        raise Mpg123.FormatException(f'unsupported encoding {encoding}')
+    dtype, scale = pcm
+    segment = rate // 10 * channels  # 100ms的样本数（交织的）
+    buf = bytearray(segment * np.dtype(dtype).itemsize * 32)
+    view = memoryview(buf)
+    pending = np.empty(0, np.float32)
+    weights = None
+    energies = list()
+    peak = 0.0
+    while True:
+        size = stream.decodeInto(view)
+        if size == 0:
+            break
+        samples = np.frombuffer(buf, dtype, size // np.dtype(dtype).itemsize).astype(np.float32)
+        samples /= scale
+        if len(samples):
+            peak = max(peak, float(np.abs(samples).max()))
+        if len(pending):
+            samples = np.concatenate((pending, samples))
+        whole = len(samples) // segment * segment
+        pending = samples[whole:].copy()
+        if whole == 0:
+            continue
+        # (段, 声道, 样本)
+        blocks = samples[:whole].reshape(-1, segment // channels, channels).transpose(0, 2, 1)
+        spectrum = np.fft.rfft(blocks, axis=2)
+        if weights is None:
+            # 单边谱，除直流和奈奎斯特外的频点计两次，再除以N^2得到均方值
+            count = segment // channels
+            weights = kWeighting(rate, count) * 2 / count ** 2
+            weights[0] /= 2
+            if count % 2 == 0:
+                weights[-1] /= 2
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) @ weights
+        energies.append(power.sum(axis=1))  # 左右声道权重都为1
+
+    if not energies:
+        return None, peak
+    energy = np.concatenate(energies)
+    if len(energy) < 4:
+        return None, peak
+    gating = np.convolve(energy, np.full(4, 0.25), mode='valid')  # 400ms块
+    gating = gating[gating > 10 ** ((-70 + 0.691) / 10)]
+    if not len(gating):
+        return None, peak
+    relative = -0.691 + 10 * np.log10(gating.mean()) - 10
+    gating = gating[gating > 10 ** ((relative + 0.691) / 10)]
+    return -0.691 + 10 * float(np.log10(gating.mean())), peak
+
+
+def analyzeLoudness(path: str):
+    """在工作进程中执行，返回(path, size, mtime, 响度, 峰值)，失败时响度和峰值为None"""
+    st = os.stat(path)
+    try:
+        loudness, peak = measureLoudness(path)
+    except (Mpg123.OpenFileException, Mpg123.FormatException, Mpg123.NeedMoreException,
+            Mpg123.DecodeException) as error:
+        print(f'analyze {path} failed, error: {error}')
+        loudness, peak = None, None
+    return path, st.st_size, st.st_mtime_ns, loudness, peak
+
+
+def collectTracks(catalog: MusicCatalog, roots: list):
+    """同步扫描roots，顺便更新曲库目录，返回其中所有歌曲的路径，给不启动界面的批量处理用"""
+    paths = list()
+    pending = list(roots)
+    visited = set()
+    while pending:
+        dd = pending.pop()
+        try:
+            st = os.stat(dd)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            rows, subdirs = catalog.scanDir(dd, st.st_mtime_ns)
+        except OSError as error:
+            print(error)
+            continue
+        paths.extend(os.path.join(row[0], row[1] + MUSIC_EXT) for row in rows)
+        pending.extend(subdirs)
+    return paths
+
+
+class LoudnessAnalyzer:
+    """批量分析曲库的响度，每个文件一个任务，在所有核心的进程池中解码。
+    结果按文件的路径、大小和修改时间存入曲库目录，中断后再运行只分析还没有结果的文件"""
+
+    def __init__(self, catalog: MusicCatalog, workers=None):
+        self.catalog = catalog
+        self.workers = workers or os.cpu_count() or 1
+
+    def run(self, roots: list):
+        if np is None:
+            print('numpy is required for loudness analysis')
+            return 1
+        paths = self.catalog.unanalyzed(collectTracks(self.catalog, roots))
+        total = len(paths)
+        print(f'{total} files to analyze with {self.workers} workers')
+        done = 0
+        started = time.monotonic()
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+        running = set()
+        try:
+            while paths or running:
+                # 同时只提交有限的任务，中断时不需要取消大量排队的任务
+                while paths and len(running) < self.workers * 2:
+                    running.add(executor.submit(analyzeLoudness, paths.pop()))
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                results = list()
+                for future in finished:
+                    try:
+                        results.append(future.result())
+                    except (OSError, BrokenProcessPool) as error:
+                        print(f'loudness worker failed, error: {error}')
+                self.catalog.storeLoudness(results)
+                done += len(finished)
+                elapsed = time.monotonic() - started
+                print(f'\ranalyzed {done}/{total}, {done / elapsed:.1f} files/s', end='', flush=True)
+        except KeyboardInterrupt:
+            print('\ninterrupted, run again to resume')
+            executor.shutdown(wait=False, cancel_futures=True)
+            return 130
+        executor.shutdown()
+        print()
+        return 0
+
+
+AUDIO_HASH = 'xxh3' if xxhash is not None else 'blake2b'  # 存入曲库目录的哈希带着算法名，换了算法时重新计算
+
+
+def audioExtent(fp, fileSize: int):
+    """MPEG音频数据在文件中的范围(开始, 结束)，去掉开头的ID3v2和第一帧之前的填充，以及结尾的ID3v1和APEv2标签，
+    同一首歌只是标签不同时范围内的数据相同"""
+    fp.seek(0)
+    tag = id3Tag(fp)
+    start = tag[3] if tag is not None else 0
+    end = fileSize
+    if end - start >= 128:
+        fp.seek(end - 128)
+        if fp.read(3) == b'TAG':
+            end -= 128
+    if end - start >= 32:
+        fp.seek(end - 32)
+        footer = fp.read(32)
+        if footer[:8] == b'APETAGEX':
+            size = int.from_bytes(footer[12:16], 'little')  # 包括尾部，不包括头部
+            flags = int.from_bytes(footer[20:24], 'little')
+            end -= size + (32 if flags & 0x80000000 else 0)
+    fp.seek(start)
+    found = findFirstFrame(fp.read(16384))
+    if found is not None:
+        start += found[0]
+    return start, max(start, end)
+
+
+def hashAudio(path: str):
+    """返回(path, size, mtime, hash)，音频数据用mmap映射后整块交给哈希函数，不复制到Python对象中"""
+    with open(path, 'rb') as fp:
+        st = os.fstat(fp.fileno())
+        start, end = audioExtent(fp, st.st_size)
+        if end <= start:
+            return path, st.st_size, st.st_mtime_ns, None
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            buffer.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(buffer) as view, view[start:end] as payload:
+                if xxhash is not None:
+                    digest = xxhash.xxh3_128_hexdigest(payload)
+                else:
+                    digest = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    return path, st.st_size, st.st_mtime_ns, f'{AUDIO_HASH}:{digest}'
+
+
+def hashAudioBatch(paths: list):
+    """在工作进程中执行，读取失败的文件不返回，下次再试"""
+    results = list()
+    for path in paths:
+        try:
+            results.append(hashAudio(path))
+        except (OSError, ValueError) as error:
+            print(f'hash {path} failed, error: {error}')
+    return results
+
+
+class DuplicateFinder:
+    """找出音频数据相同、只是标签不同或者放在不同目录中的重复歌曲。
+    在进程池中对去掉标签的MPEG数据做非加密哈希，结果按路径、大小和修改时间存入曲库目录，之后只处理新增或变化的文件"""
+
+    CHUNK_SIZE = 16
+
+    def __init__(self, catalog: MusicCatalog, callback=None, schedule=None, workers=None):
+        self.catalog = catalog
+        self.callback = callback  # callback(generation, groups)，在主线程中调用，groups为路径的列表
+        self.schedule = schedule
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+        self.futures = set()
+        self.lock = threading.Lock()
+        self.serial = 0  # 每次cancel加一，之前的请求剩下的任务完成时不再回调
+        self.remaining = 0
+
+    def busy(self):
+        return self.remaining > 0
+
+    def request(self, paths: list, generation: int):
+        """在后台计算paths中新增或变化的文件的哈希，都完成后送回所有重复的组"""
+        self.cancel()
+        jobs = self.catalog.unhashed(paths)
+        chunks = [jobs[i:i + self.CHUNK_SIZE] for i in range(0, len(jobs), self.CHUNK_SIZE)]
+        with self.lock:
+            self.remaining = len(chunks)
+        if not chunks:
+            self.schedule(self.callback, generation, self.catalog.duplicateGroups())
+            return
+        if self.executor is None:
+            # 第一次要读整个曲库，放在低优先级的进程中
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=os.nice, initargs=(10,),
+                                                mp_context=multiprocessing.get_context('forkserver'))
+        for chunk in chunks:
+            future = self.executor.submit(hashAudioBatch, chunk)
+            self.futures.add(future)
+            future.add_done_callback(functools.partial(self.onDone, self.serial, generation))
+
+    def cancel(self):
+        for future in list(self.futures):
+            future.cancel()
+        with self.lock:
+            self.serial += 1
+            self.remaining = 0
+
+    def onDone(self, serial: int, generation: int, future):
+        """在进程池的管理线程中调用"""
+        self.futures.discard(future)
+        if future.cancelled():
+            return
+        try:
+            results = future.result()
+        except (OSError, BrokenProcessPool) as error:
+            print(f'hash worker failed, error: {error}')
+            results = list()
+        self.catalog.storeAudioHashes(results)  # 过时的请求算出的哈希也是对的
+        if metrics.enabled:
+            metrics.add('duplicates.files', len(results))
+        with self.lock:
+            if serial != self.serial:
+                return
+            self.remaining -= 1
+            if self.remaining > 0:
+                return
+        self.schedule(self.callback, generation, self.catalog.duplicateGroups())
+
+    def run(self, roots: list):
+        """同步检查roots中的歌曲并打印重复的组，可以中断后继续"""
+        paths = collectTracks(self.catalog, roots)
+        jobs = self.catalog.unhashed(paths)
+        total = len(jobs)
+        print(f'{total} of {len(paths)} files to hash with {self.workers} workers')
+        done = 0
+        started = time.monotonic()
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('forkserver'))
+        try:
+            chunks = [jobs[i:i + self.CHUNK_SIZE] for i in range(0, total, self.CHUNK_SIZE)]
+            for results in executor.map(hashAudioBatch, chunks):
+                self.catalog.storeAudioHashes(results)
+                done += len(results)
+                elapsed = time.monotonic() - started
+                print(f'\rhashed {done}/{total}, {done / elapsed:.1f} files/s', end='', flush=True)
+        except KeyboardInterrupt:
+            print('\ninterrupted, run again to resume')
+            executor.shutdown(wait=False, cancel_futures=True)
+            return 130
+        except BrokenProcessPool as error:
+            print(f'\nhash worker failed, error: {error}')
+            return 1
+        executor.shutdown()
+        if total:
+            print()
+        found = set(paths)
+        groups = [group for group in ([path for path in group if path in found]
+                                      for group in self.catalog.duplicateGroups()) if len(group) > 1]
+        print(f'{len(groups)} duplicate groups, {sum(len(group) - 1 for group in groups)} redundant files')
+        for group in groups:
+            print()
+            print('\n'.join(group))
+        return 0
+
+
+PEAK_RATE = 100  # 波形第0级每秒的峰值对数
+
+
+def computePeaks(path: str):
+    """解码整个文件，返回(每秒峰值对数, 峰值)。峰值是min/max包络：每1/PEAK_RATE秒的交织样本中
+    所有声道一起取最小和最大值，声道之间不相加也不平均，按满幅量化为int8，形状为(n, 2)。
+    整块解码数据一次reshape求min/max，不逐个样本循环"""
+    stream = Mpg123Stream(path)
+    rate, channels, encoding = stream.format
+    pcm = pcmType(encoding)
+    if pcm is None:
+        raise Mpg123.FormatException(f'unsupported encoding {encoding}')
+    dtype, scale = pcm
+    bucket = max(1, round(rate / PEAK_RATE)) * channels  # 每对峰值的样本数（交织的）
+    itemSize = np.dtype(dtype).itemsize
+    buf = bytearray(bucket * itemSize * 256)
+    view = memoryview(buf)
+    pending = np.empty(0, dtype)
+    blocks = list()
+    while True:
+        size = stream.decodeInto(view)
+        if size == 0:
+            break
+        samples = np.frombuffer(buf, dtype, size // itemSize)
+        if len(pending):
+            samples = np.concatenate((pending, samples))
+        whole = len(samples) // bucket * bucket
+        pending = samples[whole:].copy()
+        if whole == 0:
+            continue
+        frames = samples[:whole].reshape(-1, bucket)
+        blocks.append(np.stack((frames.min(axis=1), frames.max(axis=1)), axis=1))
+    if len(pending):
+        blocks.append(np.array([[pending.min(), pending.max()]], dtype))
+    peaks = np.concatenate(blocks) if blocks else np.zeros((0, 2), dtype)
+    peaks = np.clip(np.round(peaks.astype(np.float32) * (127 / scale)), -127, 127).astype(np.int8)
+    return rate * channels / bucket, peaks
+
+
+def peakLevels(peaks):
+    """第0级为peaks，之后每级把相邻两对合并为一对，直到只剩一对"""
+    levels = [peaks]
+    while len(levels[-1]) > 1:
+        last = levels[-1]
+        if len(last) % 2:
+            last = np.concatenate((last, last[-1:]))
+        pairs = last.reshape(-1, 2, 2)
+        levels.append(np.stack((pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)), axis=1))
+    return levels
+
+
+class Waveform:
+    """波形峰值的缓存文件，用mmap只读打开，各级峰值都是numpy在mmap上的视图，不复制也不整个读进内存。
+    文件为头部和逐级排列的(min, max) int8对：第0级每1/rate秒一对，之后每级把相邻两对合并，
+    所以不论显示多长的时间范围，画一次都只读取和像素列数差不多的峰值"""
+
+    MAGIC = b'MPGPEAK1'
+    HEADER = struct.Struct('<8sqqdq')  # magic, 音频文件大小, 修改时间ns, 每秒峰值对数, 第0级的对数
+
+    def __init__(self, buffer, rate: float, count: int):
+        self.buffer = buffer
+        self.rate = rate
+        self.levels = list()
+        offset = self.HEADER.size
+        for size in self.levelSizes(count):
+            self.levels.append(np.frombuffer(buffer, np.int8, size * 2, offset).reshape(size, 2))
+            offset += size * 2
+
+    @staticmethod
+    def levelSizes(count: int):
+        sizes = [count]
+        while sizes[-1] > 1:
+            sizes.append((sizes[-1] + 1) // 2)
+        return sizes
+
+    @classmethod
+    def write(cls, path: str, size: int, mtime: int, rate: float, peaks):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = [cls.HEADER.pack(cls.MAGIC, size, mtime, rate, len(peaks))]
+        data += [level.tobytes() for level in peakLevels(peaks)]
+        writeAtomic(path, b''.join(data))
+
+    @classmethod
+    def open(cls, path: str, size: int, mtime: int):
+        """缓存文件不存在、不完整或者对应的不是这个大小和修改时间的音频文件时返回None"""
+        try:
+            with open(path, 'rb') as fp:
+                header = fp.read(cls.HEADER.size)
+                if len(header) < cls.HEADER.size:
+                    return None
+                magic, fileSize, fileMtime, rate, count = cls.HEADER.unpack(header)
+                if magic != cls.MAGIC or (fileSize, fileMtime) != (size, mtime) or count <= 0 or rate <= 0:
+                    return None
+                if os.fstat(fp.fileno()).st_size != cls.HEADER.size + 2 * sum(cls.levelSizes(count)):
+                    return None
+                buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            print(f'open waveform cache {path} failed, error: {error}')
+            return None
+        return cls(buffer, rate, count)
+
+    def duration(self):
+        return len(self.levels[0]) / self.rate
+
+    def columns(self, start: float, end: float, width: int):
+        """[start, end)秒之间每个像素列的(最小值, 最大值)，两个长度为width的int8数组，超出结尾的列为0。
+        选每列至少一对峰值的最细一级，每列最多合并两对"""
+        mins = np.zeros(width, np.int8)
+        maxs = np.zeros(width, np.int8)
+        start = max(0.0, start)
+        if width <= 0 or end <= start:
+            return mins, maxs
+        perColumn = (end - start) * self.rate / width
+        level = min(len(self.levels) - 1, int(math.log2(perColumn))) if perColumn >= 2 else 0
+        data = self.levels[level]
+        scale = self.rate / (1 << level)
+        edges = (start * scale + np.arange(width + 1) * ((end - start) * scale / width)).astype(np.int64)
+        count = int(np.searchsorted(edges[:-1], len(data)))  # 结尾之前的列数
+        if count == 0:
+            return mins, maxs
+        first = int(edges[0])
+        stop = min(len(data), max(int(edges[count]), int(edges[count - 1]) + 1))
+        chunk = data[first:stop]
+        indices = edges[:count] - first
+        mins[:count] = np.minimum.reduceat(chunk[:, 0], indices)  # 放大时相邻列的索引相同，取的就是那一对
+        maxs[:count] = np.maximum.reduceat(chunk[:, 1], indices)
+        return mins, maxs
+
+
+def buildPeaks(path: str, cachePath: str):
+    """在工作进程中执行，解码path生成峰值写入cachePath，返回是否成功"""
+    st = os.stat(path)  # 解码前取得，解码中文件变了的话下次打开时对不上，会重新生成
+    try:
+        rate, peaks = computePeaks(path)
+    except (Mpg123.LibInitializationException, Mpg123.OpenFileException, Mpg123.FormatException,
+            Mpg123.NeedMoreException, Mpg123.DecodeException) as error:
+        print(f'build waveform of {path} failed, error: {error}')
+        return False
+    if not len(peaks):
+        return False
+    Waveform.write(cachePath, st.st_size, st.st_mtime_ns, rate, peaks)
+    return True
+
+
+class WaveformService:
+    """波形峰值的缓存，每个音频文件一个缓存文件，按路径的哈希命名，头部记录文件大小和修改时间，文件变了重新生成。
+    没有缓存时在低优先级的工作进程中解码生成，缓存目录超过MAX_BYTES时删除最久没用的。
+    打开的Waveform按路径放在LRU中，get和callback(path, waveform)都在主线程中"""
+
+    CACHE_SIZE = 4
+    MAX_BYTES = 512 * 1024 * 1024
+
+    def __init__(self, callback, schedule, directory=None):
+        self.callback = callback
+        self.schedule = schedule
+        self.directory = directory or os.path.join(cacheDir(), 'peaks')
+        self.cache = OrderedDict()
+        self.loading = set()
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='waveform')
+        self.executor = None  # 生成峰值的进程池，第一次需要时才创建，只在loader线程中使用
+
+    @staticmethod
+    def available():
+        return np is not None
+
+    def cachePath(self, path: str):
+        return os.path.join(self.directory, hashlib.blake2b(os.fsencode(path), digest_size=16).hexdigest() + '.peaks')
+
+    def get(self, path: str):
+        """返回(是否已经加载, 波形)，还没有加载时在后台打开或者生成，失败时波形为None"""
+        if path in self.cache:
+            self.cache.move_to_end(path)
+            return True, self.cache[path]
+        if path not in self.loading and self.available():
+            self.loading.add(path)
+            self.loader.submit(self.load, path)
+        return False, None
+
+    def load(self, path: str):
+        waveform = None
+        try:
+            st = os.stat(path)
+            cachePath = self.cachePath(path)
+            waveform = Waveform.open(cachePath, st.st_size, st.st_mtime_ns)
+            if waveform is not None:
+                os.utime(cachePath)  # 按修改时间淘汰，打开也算用过
+            else:
+                started = time.perf_counter()
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(max_workers=1, initializer=os.nice, initargs=(10,),
+                                                        mp_context=multiprocessing.get_context('forkserver'))
+                if self.executor.submit(buildPeaks, path, cachePath).result():
+                    waveform = Waveform.open(cachePath, st.st_size, st.st_mtime_ns)
+                    self.prune()
+                if metrics.enabled:
+                    metrics.observe('waveform.build', time.perf_counter() - started)
+        except BrokenProcessPool as error:
+            print(f'waveform worker failed, error: {error}')
+            self.executor = None
+        except OSError as error:
+            print(f'load waveform of {path} failed, error: {error}')
+        finally:  # 其它异常也要结束加载，否则这个文件再也不会重试
+            self.schedule(self.onLoaded, path, waveform)
+
+    def prune(self):
+        """缓存目录超过MAX_BYTES时按修改时间删除最旧的，直到不超过3/4"""
+        entries = list()
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith('.peaks'):
+                        st = entry.stat()
+                        entries.append((st.st_mtime, st.st_size, entry.path))
+        except OSError as error:
+            print(error)
+            return
+        total = sum(size for _, size, _ in entries)
+        if total <= self.MAX_BYTES:
+            return
+        for _, size, path in sorted(entries):
+            if total <= self.MAX_BYTES * 3 // 4:
+                break
+            try:
+                os.unlink(path)  # 已经mmap打开的不受影响
+            except OSError as error:
+                print(error)
+                continue
+            total -= size
+
+    def onLoaded(self, path: str, waveform):
+        self.loading.discard(path)
+        self.cache[path] = waveform
+        while len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)  # 界面可能还在用，mmap在没有引用后才关闭
+        self.callback(path, waveform)
+
+    def forget(self, path: str):
+        """文件变了，下次重新打开，缓存文件的头部对不上时重新生成"""
+        self.cache.pop(path, None)
+
+
+class SeekIndex:
+    """文件的帧偏移表，由mpg123_scan扫描一次得到，交给mpg123_set_index后seek不需要再读文件"""
+
+    MAX_ENTRIES = 8192  # 表项太多时抽稀，seek时最多向前跳过step帧
+
+    def __init__(self, rate: int, samples: int, step: int, offsets: array):
+        self.rate = rate
+        self.samples = samples
+        self.step = step
+        self.offsets = offsets
+
+    @property
+    def duration(self):
+        return self.samples / self.rate if self.rate > 0 else 0.0
+
+    @classmethod
+    def build(cls, filePath: str):
+        mpg = Mpg123(filePath)
+        lib = mpg._lib
+        lib.mpg123_length.restype = ctypes.c_long
+        # 索引大小为负数表示按需增长，保存每一帧的位置
+        lib.mpg123_param(mpg.handle, MPG123_INDEX_SIZE, ctypes.c_long(-1000), ctypes.c_double(0))
+        if lib.mpg123_scan(mpg.handle) != OK:
+            raise Mpg123.LengthException(f'scan {filePath} failed')
+
+        offsets = ctypes.POINTER(ctypes.c_long)()
+        step = ctypes.c_long(0)
+        fill = ctypes.c_size_t(0)
+        if lib.mpg123_index(mpg.handle, ctypes.byref(offsets), ctypes.byref(step), ctypes.byref(fill)) != OK:
+            raise Mpg123.LengthException(f'index {filePath} failed')
+
+        every = max(1, -(-fill.value // cls.MAX_ENTRIES))
+        table = array('q', offsets[:fill.value:every])
+        rate, _, _ = mpg.get_format()
+        return cls(rate, lib.mpg123_length(mpg.handle), step.value * every, table)
+
+    def apply(self, mpg: Mpg123):
+        offsets = (ctypes.c_long * len(self.offsets)).from_buffer(self.offsets)
+        mpg._lib.mpg123_set_index(mpg.handle, offsets, ctypes.c_long(self.step), ctypes.c_size_t(len(self.offsets)))
+
+
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', 'ceph', '9p', 'glusterfs',
+                       'fuse.sshfs', 'fuse.rclone', 'fuse.glusterfs', 'fuse.davfs2'}
+
+
+def isNetworkPath(path: str):
+    """path是否在网络文件系统上，按/proc/self/mounts中最长的挂载点判断，读不到挂载表时当作本地磁盘"""
+    try:
+        with open('/proc/self/mounts') as fp:
+            mounts = [line.split()[1:3] for line in fp if len(line.split()) >= 3]
+    except OSError:
+        return False
+    path = os.path.realpath(path)
+    best, network = -1, False
+    for mountPoint, fsType in mounts:
+        mountPoint = re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), mountPoint)  # 空格等被转义
+        if len(mountPoint) > best and (path == mountPoint or path.startswith(mountPoint.rstrip('/') + '/')):
+            best, network = len(mountPoint), fsType in NETWORK_FILESYSTEMS
+    return network
+
+
+class ReadStats:
+    """一个文件的读取统计，read为每次读文件的耗时，stall为解码线程等待后台读取的时间"""
+
+    def __init__(self, path: str, network: bool):
+        self.path = path
+        self.network = network
+        self.reads = 0
+        self.bytes = 0
+        self.readTime = 0.0
+        self.maxRead = 0.0
+        self.stalls = 0
+        self.stallTime = 0.0
+        self.errors = 0
+
+    def timedRead(self, fd: int, size: int, offset: int):
+        began = time.perf_counter()
+        data = os.pread(fd, size, offset)
+        elapsed = time.perf_counter() - began
+        self.reads += 1
+        self.bytes += len(data)
+        self.readTime += elapsed
+        self.maxRead = max(self.maxRead, elapsed)
+        if metrics.enabled:
+            metrics.observe('io.read', elapsed)
+            metrics.add('io.bytes', len(data))
+        return data
+
+    def stalled(self, elapsed: float):
+        self.stalls += 1
+        self.stallTime += elapsed
+        if metrics.enabled:
+            metrics.observe('io.stall', elapsed)
+
+    def snapshot(self):
+        return {'path': self.path, 'network': self.network, 'reads': self.reads, 'bytes': self.bytes,
+                'meanRead': self.readTime / self.reads if self.reads else 0.0, 'maxRead': self.maxRead,
+                'stalls': self.stalls, 'stallTime': self.stallTime, 'errors': self.errors}
+
+
+class FileSource(ABC):
+    """交给mpg123读取的文件，mpg123通过read和seek两个回调读数据，都在解码线程中调用"""
+
+    def __init__(self, path: str, network=False):
+        self.path = path
+        self.fd = -1
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.position = 0
+        self.stats = ReadStats(path, network)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def seek(self, offset: int, whence: int):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}.get(whence)
+        if base is None or base + offset < 0:
+            return -1
+        self.position = base + offset
+        return self.position
+
+    @abstractmethod
+    def read(self, size: int):
+        """返回从当前位置开始最多size字节，空bytes表示文件结束"""
+
+
+class LocalSource(FileSource):
+    """本地磁盘上的文件，解码线程直接pread，用posix_fadvise(WILLNEED)让内核提前异步读入后面的WINDOW字节"""
+
+    WINDOW = 4 << 20
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.advised = 0  # 已经提示过内核的范围的末尾
+
+    def read(self, size: int):
+        position = self.position
+        # 读到提示范围的后一半或者往回seek了，再提示一次
+        if hasattr(os, 'posix_fadvise') and not self.advised - self.WINDOW <= position < self.advised - self.WINDOW // 2:
+            os.posix_fadvise(self.fd, position, self.WINDOW, os.POSIX_FADV_WILLNEED)
+            self.advised = position + self.WINDOW
+        data = self.stats.timedRead(self.fd, size, position)
+        self.position += len(data)
+        return data
+
+
+class ReadAheadSource(FileSource):
+    """网络文件系统上的文件，后台线程把解码位置之后最多WINDOW字节读到内存中，解码线程只从内存取数据，
+    NFS/SMB卡住几秒时窗口中还有几分钟的音频。窗口外的读取（例如打开时检查文件末尾的ID3v1）直接读文件，
+    连续两次读到窗口外的同一处时认为是seek了，把窗口移过去"""
+
+    WINDOW = 8 << 20
+    CHUNK = 256 << 10
+    KEEP = 64 << 10  # 解码位置之前保留的数据，mpg123重新同步时会往回读一点
+    STALL_TIMEOUT = 30.0  # 等待后台读取的最长时间，超过后当作读取失败
+    RETRIES = 3
+
+    def __init__(self, path: str):
+        self.cond = threading.Condition()
+        super().__init__(path, network=True)
+        self.chunks = deque()  # (offset, bytes)，连续覆盖[base, end)
+        self.base = 0
+        self.end = 0
+        self.generation = 0  # 窗口移动时加一，丢弃后台线程正在读的旧数据
+        self.failed = None
+        self.directEnd = -1  # 上一次窗口外读取的末尾
+        # 线程只持有弱引用，流不再使用时自动结束
+        threading.Thread(target=self.fill, args=(weakref.ref(self),), name='readahead', daemon=True).start()
+
+    def close(self):
+        with self.cond:
+            super().close()
+            self.cond.notify_all()
+
+    @staticmethod
+    def fill(ref):
+        while True:
+            source = ref()
+            if source is None or not source.fillOnce():
+                return
+            del source
+
+    def fillOnce(self):
+        """读一块数据，窗口满或者读完时最多等一秒，返回False表示文件已经关闭"""
+        with self.cond:
+            if self.fd < 0:
+                return False
+            if self.failed is not None or self.end >= self.size or self.end - self.position >= self.WINDOW:
+                self.cond.wait(1.0)
+                return True
+            offset, generation, fd = self.end, self.generation, self.fd
+        for attempt in range(self.RETRIES):
+            try:
+                data = self.stats.timedRead(fd, min(self.CHUNK, self.size - offset), offset)
+                break
+            except OSError as error:  # soft挂载的NFS超时后返回EIO
+                self.stats.errors += 1
+                print(f'read {self.path} at {offset} failed, error: {error}')
+                with self.cond:
+                    self.cond.wait(1.0)
+        else:
+            data = None
+        with self.cond:
+            if generation != self.generation or self.fd < 0:
+                return True
+            if data is None:
+                self.failed = f'read {self.path} failed'
+            elif not data:  # 文件变短了
+                self.size = offset
+            else:
+                self.chunks.append((offset, data))
+                self.end += len(data)
+            self.cond.notify_all()
+        return True
+
+    def seek(self, offset: int, whence: int):
+        position = super().seek(offset, whence)
+        if position >= 0:
+            with self.cond:
+                self.cond.notify_all()
+        return position
+
+    def restart(self, position: int):
+        with self.cond:
+            self.generation += 1
+            self.chunks.clear()
+            self.base = self.end = position
+            self.failed = None
+            self.cond.notify_all()
+
+    def read(self, size: int):
+        position = self.position
+        if position >= self.size:
+            return b''
+        with self.cond:
+            data = self.take(position, size) if self.base <= position <= self.end else None
+        if data is None:
+            data = self.stats.timedRead(self.fd, size, position)
+            if position == self.directEnd:
+                self.restart(position + len(data))
+            self.directEnd = position + len(data)
+        self.position += len(data)
+        return data
+
+    def take(self, position: int, size: int):
+        """在持有锁时调用，从窗口中取数据，窗口还没读到这里时等待后台线程"""
+        if position == self.end:
+            began = time.perf_counter()
+            while position == self.end < self.size and self.failed is None and self.fd >= 0:
+                if time.perf_counter() - began > self.STALL_TIMEOUT:
+                    raise OSError(f'read {self.path} timed out')
+                self.cond.wait(1.0)
+            self.stats.stalled(time.perf_counter() - began)
+            if self.failed is not None:
+                raise OSError(self.failed)
+            if position >= self.end:
+                return b''
+        while self.chunks and self.chunks[0][0] + len(self.chunks[0][1]) <= position - self.KEEP:
+            offset, data = self.chunks.popleft()
+            self.base = offset + len(data)
+        self.cond.notify_all()  # 解码位置前进了，窗口有空位
+        for offset, data in self.chunks:
+            if offset <= position < offset + len(data):
+                return data[position - offset:position - offset + size]
+        return b''
+
+
+def openSource(path: str):
+    """网络文件系统上的文件用后台预读，本地磁盘直接读"""
+    try:
+        return ReadAheadSource(path) if isNetworkPath(path) else LocalSource(path)
+    except OSError as error:
+        raise Mpg123.OpenFileException(str(error))
+
+
+MPG123_READ = ctypes.CFUNCTYPE(ctypes.c_ssize_t, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t)
+MPG123_LSEEK = ctypes.CFUNCTYPE(ctypes.c_long, ctypes.c_void_p, ctypes.c_long, ctypes.c_int)
+
+
+def openReaderHandle(source: FileSource):
+    """创建从source读取数据的Mpg123，mpg123_replace_reader_handle替换掉mpg123自己的文件读取"""
+
+    def read(_, buf, size):
+        try:
+            data = source.read(size)
+        except OSError as error:
+            print(f'read {source.path} failed, error: {error}')
+            return -1
+        ctypes.memmove(buf, data, len(data))
+        return len(data)
+
+    def lseek(_, offset, whence):
+        return source.seek(offset, whence)
+
+    mpg = Mpg123()  # 没有文件名时以feed模式打开，关闭后换成自定义读取再打开
+    lib = mpg._lib
+    lib.mpg123_close(mpg.handle)
+    mpg.is_feed = False
+    # 回调和source跟着Mpg123对象，关闭句柄之前不会被回收
+    mpg.reader = (MPG123_READ(read), MPG123_LSEEK(lseek), source)
+    errcode = lib.mpg123_replace_reader_handle(mpg.handle, mpg.reader[0], mpg.reader[1], None)
+    if errcode == OK:
+        errcode = lib.mpg123_open_handle(mpg.handle, ctypes.c_void_p(id(source)))
+    if errcode != OK:
+        raise Mpg123.OpenFileException(f'{source.path}: {mpg.plain_strerror(errcode)}')
+    return mpg
+
+
+class Mpg123Stream:
+    """对Mpg123的封装，用mpg123_read直接解码到调用者提供的缓冲区中，文件数据经过source读取"""
+
+    def __init__(self, filePath: str):
+        self.path = filePath
+        self.source = openSource(filePath)
+        self.mpg = openReaderHandle(self.source)
+        self.done = ctypes.c_size_t(0)
+        self.format = self.mpg.get_format()  # (rate, channels, encoding)
+        self.sampleSize = self.format[1] * self.mpg.get_width_by_encoding(self.format[2])
+        self.prefetched = None  # 预解码的开头部分
+        self.successor = None  # 无缝衔接在这个流之后的流
+        self.decoded = 0  # 下一次解码的起始样本
+        self.seekIndex = None
+        self.pendingIndex = None  # 其它线程设置，解码线程在下一次解码前交给mpg123
+        self.gains = dict()  # ReplayGain，见MusicCatalog.replayGain
+
+    @property
+    def rate(self):
+        return self.format[0]
+
+    def duration(self):
+        samples = self.length()
+        return samples / self.rate if samples > 0 and self.rate > 0 else 0.0
+
+    def length(self):
+        """总样本数，不知道时返回0"""
+        index = self.seekIndex or self.pendingIndex
+        if index is not None:
+            return index.samples
+        self.mpg._lib.mpg123_length.restype = ctypes.c_long
+        return max(0, self.mpg._lib.mpg123_length(self.mpg.handle))  # 没有索引时是估计值，不会扫描文件
+
+    def useIndex(self, index: SeekIndex):
+        self.pendingIndex = index
+
+    def applyIndex(self):
+        index, self.pendingIndex = self.pendingIndex, None
+        if index is not None:
+            index.apply(self.mpg)
+            self.seekIndex = index
+
+    def seek(self, sample: int):
+        """只能在解码线程中调用"""
+        self.applyIndex()
+        self.prefetched = None
+        self.mpg._lib.mpg123_seek.restype = ctypes.c_long
+        position = self.mpg._lib.mpg123_seek(self.mpg.handle, ctypes.c_long(sample), os.SEEK_SET)
+        if position >= 0:
+            self.decoded = position
+
+    def prefetch(self, size: int):
+        """预先解码开头的一部分，切换到这个流时可以立即输出"""
+        buf = memoryview(bytearray(size))
+        self.prefetched = buf[:self.decodeInto(buf)]
+
+    def readInto(self, view: memoryview):
+        """解码到view中，返回写入的字节数，0表示已经结束"""
+        if self.pendingIndex is not None:
+            self.applyIndex()
+        if self.prefetched:
+            size = min(len(view) - len(view) % self.sampleSize, len(self.prefetched))
+            view[:size] = self.prefetched[:size]
+            self.prefetched = self.prefetched[size:]
+        else:
+            size = self.decodeInto(view)
+        self.decoded += size // self.sampleSize
+        return size
+
+    def decodeInto(self, view: memoryview):
+        while True:
+            size = len(view) - len(view) % self.sampleSize
+            buf = (ctypes.c_char * size).from_buffer(view)
+            errcode = self.mpg._lib.mpg123_read(self.mpg.handle, buf, size, ctypes.byref(self.done))
+            if errcode == NEW_FORMAT:  # 例如中途从单声道变成立体声，输出线程按槽位的格式重新打开设备
+                self.format = self.mpg.get_format()
+                self.sampleSize = self.format[1] * self.mpg.get_width_by_encoding(self.format[2])
+                if self.done.value == 0:
+                    continue
+            elif errcode not in (OK, DONE):
+                raise Mpg123.DecodeException(self.mpg.plain_strerror(errcode))
+            return self.done.value
+
+
+class Out123Device:
+    """out123输出设备，直接把槽位的内存交给out123_play，不经过Out123.play中的tobytes复制，只在输出线程中使用"""
+
+    def __init__(self):
+        self.out123 = Out123()
+
+    def start(self, rate: int, channels: int, encoding: int):
+        self.out123.start(rate, channels, encoding)
+
+    def play(self, view: memoryview, size: int):
+        buf = (ctypes.c_char * size).from_buffer(view)
+        self.out123._lib.out123_play(self.out123.handle, buf, size)
+
+    def drop(self):
+        """丢弃设备中还没播放的数据"""
+        self.out123._lib.out123_drop(self.out123.handle)
+
+
+class Mpg123Backend:
+    """Player的解码和输出后端。其它实现需要提供同样的三个方法，例如基准测试中生成合成数据、不需要libmpg123和声卡的后端"""
+
+    def openStream(self, filePath: str):
+        """返回和Mpg123Stream接口一样的流，其中source为读取文件的FileSource，不读文件时为None"""
+        return Mpg123Stream(filePath)
+
+    def buildIndex(self, filePath: str):
+        """扫描文件生成SeekIndex，不支持时返回None"""
+        return SeekIndex.build(filePath)
+
+    def openOutput(self):
+        """返回和Out123Device接口一样的输出设备"""
+        return Out123Device()
+
+
+class PcmRingBuffer:
+    """预分配的PCM环形缓冲区，解码线程写入，输出线程读出，每个槽位都是同一块内存上的memoryview"""
+
+    def __init__(self, slotCount=96, slotSize=8192):
+        self.count = slotCount
+        self.memory = bytearray(slotCount * slotSize)
+        view = memoryview(self.memory)
+        self.slots = [view[i * slotSize:(i + 1) * slotSize] for i in range(slotCount)]
+        self.sizes = array('I', [0]) * slotCount
+        self.tags = [None] * slotCount  # 槽位中的数据属于哪个流，size为0表示流结束
+        self.starts = array('q', [0]) * slotCount  # 槽位中第一个样本在流中的位置
+        self.formats = [None] * slotCount  # 槽位中数据的(format, sampleSize)，同一个流中途也可能变化
+        self.head = 0  # 写入计数
+        self.tail = 0  # 读出计数
+        self.generation = 0  # 每次清空加一，之前取得的槽位全部作废
+        self.cond = threading.Condition()
+
+    def fill(self):
+        return (self.head - self.tail) / self.count
+
+    def clear(self):
+        with self.cond:
+            self.tail = self.head
+            self.generation += 1
+            self.cond.notify_all()
+            return self.generation
+
+    def acquireWrite(self, generation: int):
+        """等待一个空闲槽位，缓冲区被清空时返回-1"""
+        with self.cond:
+            while self.head - self.tail >= self.count and generation == self.generation:
+                self.cond.wait()
+            return self.head % self.count if generation == self.generation else -1
+
+    def commitWrite(self, size: int, tag, start: int, generation: int, format=None):
+        with self.cond:
+            if generation == self.generation:
+                index = self.head % self.count
+                self.sizes[index] = size
+                self.tags[index] = tag
+                self.starts[index] = start
+                self.formats[index] = format
+                self.head += 1
+                self.cond.notify_all()
+
+    def acquireRead(self, timeout: float):
+        """等待一个有数据的槽位，返回(index, generation)，超时返回(-1, generation)"""
+        with self.cond:
+            if self.head == self.tail:
+                self.cond.wait(timeout)
+            if self.head == self.tail:
+                return -1, self.generation
+            return self.tail % self.count, self.generation
+
+    def releaseRead(self, generation: int):
+        with self.cond:
+            if generation == self.generation:
+                self.tail += 1
+                self.cond.notify_all()
+
+
+class PcmDsp:
+    """输出前的处理：音量、ReplayGain和软限幅，用numpy在槽位的内存上原地计算，不逐个样本循环，不分配内存"""
+
+    LIMIT_THRESHOLD = 0.89  # 约-1dBFS，超过的部分平滑地压缩到满幅以内
+    REPLAYGAIN_MODES = ('off', 'track', 'album')
+
+    def __init__(self, maxSamples: int):
+        self.volume = 1.0
+        self.mode = 'track'
+        self.preamp = 0.0  # dB
+        self.gains = dict()  # 当前流的ReplayGain
+        self.gain = 1.0  # 总的线性增益，其它线程修改后下一个槽位就生效
+        self.limited = 0  # 触发了限幅的槽位数
+        if np is None:
+            print('numpy not found, volume and ReplayGain disabled')
+            return
+        self.work = np.empty(maxSamples, np.float32)
+        self.excess = np.empty(maxSamples, np.float32)
+        self.curve = np.empty(maxSamples, np.float32)
+
+    def setVolume(self, volume: float):
+        self.volume = max(0.0, volume)
+        self.updateGain()
+
+    def setReplayGain(self, mode: str, preamp=0.0):
+        self.mode = mode if mode in self.REPLAYGAIN_MODES else 'off'
+        self.preamp = preamp
+        self.updateGain()
+
+    def setStream(self, stream):
+        """输出切换到了新的流"""
+        self.gains = stream.gains
+        self.updateGain()
+
+    def updateGain(self):
+        gain = 1.0
+        if self.mode != 'off':
+            # 专辑模式下没有专辑增益的用曲目增益
+            db, _ = self.gains.get(self.mode) or self.gains.get('track') or (0.0, None)
+            gain = 10 ** ((db + self.preamp) / 20)
+        self.gain = self.volume * gain
+
+    def process(self, view: memoryview, size: int, encoding: int):
+        gain = self.gain
+        pcm = pcmType(encoding) if gain != 1.0 else None
+        if pcm is None:
+            return
+        dtype, scale = pcm
+        samples = np.frombuffer(view, dtype, size // np.dtype(dtype).itemsize)
+        count = len(samples)
+        if dtype is np.float32:
+            x = samples
+            np.multiply(x, gain, out=x)
+        else:  # 整数样本转换到[-1, 1)的浮点数计算
+            x = self.work[:count]
+            np.multiply(samples, gain / scale, out=x, dtype=np.float32)
+
+        if gain > 1.0 or dtype is np.float32:
+            peak = max(x.max(initial=0.0), -x.min(initial=0.0))
+            if peak > self.LIMIT_THRESHOLD:
+                self.limit(x, count)
+
+        if dtype is not np.float32:
+            np.multiply(x, scale, out=x)
+            np.rint(x, out=x)
+            # int32的满幅减1在float32中舍入为2**31，转换时会变成负的满幅，上限取小于满幅的最大float32
+            np.clip(x, -scale, min(scale - 1, np.nextafter(np.float32(scale), np.float32(0))), out=x)
+            np.copyto(samples, x, casting='unsafe')
+
+    def limit(self, x, count: int):
+        """超过阈值的部分e压缩为k*tanh(e/k)，k为阈值到满幅的距离，输出不会超过满幅"""
+        self.limited += 1
+        knee = 1.0 - self.LIMIT_THRESHOLD
+        excess, curve = self.excess[:count], self.curve[:count]
+        np.abs(x, out=excess)
+        np.subtract(excess, self.LIMIT_THRESHOLD, out=excess)
+        np.maximum(excess, 0.0, out=excess)
+        np.divide(excess, knee, out=excess)
+        np.tanh(excess, out=curve)
+        np.subtract(excess, curve, out=excess)
+        np.multiply(excess, knee, out=excess)  # 需要从幅度中减去的部分
+        np.copysign(excess, x, out=excess)
+        np.subtract(x, excess, out=x)
+
+
+class Crossfade:
+    """两首歌之间等功率的交叉淡入淡出，在解码线程中把后一首混入前一首的槽位：前一首乘cos，后一首乘sin。
+    后一首的格式不同时，淡入期间转换为前一首的格式（线性插值重采样、声道混合），之后按它自己的格式输出"""
+
+    def __init__(self, incoming: Mpg123Stream, length: int, rate: int):
+        self.incoming = incoming
+        self.length = max(1, length)  # 以前一首的样本计
+        self.rate = rate  # 前一首的采样率
+        self.position = 0
+        self.scratch = bytearray()
+        self.pending = np.empty((0, incoming.format[1]), np.float32)  # 读出来还没用完的后一首的样本
+        self.consumed = 0  # pending之前已经用掉的后一首的样本数
+        self.mixTime = 0.0
+        self.slots = 0
+
+    def done(self):
+        return self.position >= self.length
+
+    def curve(self, count: int):
+        theta = np.minimum(np.arange(self.position, self.position + count, dtype=np.float32) / self.length, 1.0)
+        theta *= np.pi / 2
+        self.position += count
+        return np.cos(theta)[:, None], np.sin(theta)[:, None]
+
+    def readIncoming(self, frames: int):
+        """从后一首读出frames帧，不够时补零，返回(帧, 声道)的浮点数组"""
+        stream = self.incoming
+        pcm = pcmType(stream.format[2])
+        size = frames * stream.sampleSize
+        if len(self.scratch) < size:
+            self.scratch = bytearray(size)
+        view = memoryview(self.scratch)[:size]
+        filled = 0
+        while filled < size:
+            try:
+                count = stream.readInto(view[filled:])
+            except Mpg123.DecodeException:
+                count = 0
+            if count == 0 or pcm is None:
+                break
+            filled += count
+        view[filled:] = bytes(size - filled)
+        if pcm is None:
+            return np.zeros((frames, stream.format[1]), np.float32)
+        dtype, scale = pcm
+        return (np.frombuffer(self.scratch, dtype, size // np.dtype(dtype).itemsize).astype(np.float32) /
+                scale).reshape(frames, stream.format[1])
+
+    def convert(self, frames: int, rate: int, channels: int):
+        """后一首接下来的frames帧，转换为rate和channels"""
+        incomingRate, incomingChannels, _ = self.incoming.format
+        if incomingRate == rate:
+            x = self.readIncoming(frames)
+        else:
+            ratio = incomingRate / rate
+            # 输出的第i帧对应后一首的第(position + i) * ratio帧
+            first = self.position * ratio - self.consumed
+            last = first + (frames - 1) * ratio
+            need = int(last) + 2 - len(self.pending)
+            if need > 0:
+                self.pending = np.concatenate((self.pending, self.readIncoming(need)))
+            where = first + np.arange(frames) * ratio
+            index = np.arange(len(self.pending))
+            x = np.stack([np.interp(where, index, self.pending[:, c]) for c in range(incomingChannels)], axis=1)
+            drop = int(last)
+            self.pending = self.pending[drop:]
+            self.consumed += drop
+        if incomingChannels != channels:
+            x = x.mean(axis=1, keepdims=True) if channels == 1 else np.repeat(x[:, :1], channels, axis=1)
+        return x
+
+    def mix(self, view: memoryview, size: int, outgoing: Mpg123Stream):
+        """把后一首混入前一首解码出来的槽位"""
+        started = time.perf_counter()
+        rate, channels, encoding = outgoing.format
+        pcm = pcmType(encoding)
+        if pcm is None:
+            return
+        dtype, scale = pcm
+        frames = size // outgoing.sampleSize
+        samples = np.frombuffer(view, dtype, frames * channels).reshape(frames, channels)
+        incoming = self.convert(frames, rate, channels)
+        fadeOut, fadeIn = self.curve(frames)
+        mixed = samples * (fadeOut / scale) + incoming * fadeIn
+        self.store(samples, mixed, scale)
+        self.mixTime += time.perf_counter() - started
+        self.slots += 1
+
+    def fadeIn(self, view: memoryview, size: int, stream: Mpg123Stream):
+        """前一首已经结束，后一首在自己的槽位中继续淡入"""
+        started = time.perf_counter()
+        pcm = pcmType(stream.format[2])
+        if pcm is None:
+            self.position = self.length
+            return
+        dtype, scale = pcm
+        channels = stream.format[1]
+        frames = size // stream.sampleSize
+        samples = np.frombuffer(view, dtype, frames * channels).reshape(frames, channels)
+        _, fadeIn = self.curve(frames)
+        self.store(samples, samples * (fadeIn / scale), scale)
+        self.mixTime += time.perf_counter() - started
+        self.slots += 1
+
+    @staticmethod
+    def store(samples, mixed, scale: float):
+        if scale != 1.0:
+            np.multiply(mixed, scale, out=mixed)
+            np.rint(mixed, out=mixed)
+            np.clip(mixed, -scale, scale - 1, out=mixed)
+        np.copyto(samples, mixed, casting='unsafe')
+
+
+class PcmTap:
+    """输出线程把交给设备的PCM数据复制一份给频谱分析，不加锁：两个缓冲区轮流写，写之前先增加序号，
+    读的一方复制完后序号增加了两次以上说明复制时同一个缓冲区被重写了，丢弃这次的数据。
+    没有读者时active为False，输出线程只多一次属性判断"""
+
+    def __init__(self, size: int):
+        self.buffers = (bytearray(size), bytearray(size))
+        self.active = False
+        self.seq = 0
+        self.snapshot = None  # (序号, 字节数, 格式)
+
+    def write(self, view: memoryview, size: int, format: tuple):
+        seq = self.seq + 1
+        self.seq = seq
+        self.buffers[seq & 1][:size] = view[:size]
+        self.snapshot = (seq, size, format)
+
+    def read(self):
+        """返回最新的(序号, PCM数据, 格式)，没有数据或者数据被覆盖了返回None"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None
+        seq, size, format = snapshot
+        data = bytes(self.buffers[seq & 1][:size])
+        if self.seq - seq >= 2:
+            return None
+        return seq, data, format
+
+
+class SpectrumAnalyzer(threading.Thread):
+    """频谱和电平分析，每秒RATE次从PcmTap取最新的数据，用numpy做加汉宁窗的FFT，按对数频率分成BANDS段，
+    再算各声道的RMS和峰值，结果都换算到FLOOR dB到0 dB之间的0到1。只在界面显示时运行，其它时候等待，需要numpy"""
+
+    RATE = 30
+    FFT_SIZE = 2048
+    BANDS = 24
+    LOW = 40.0  # Hz
+    HIGH = 16000.0
+    FLOOR = -60.0  # dB
+    STALE = 0.2  # 秒，这么久没有新数据（暂停或者停止了）时清空结果
+
+    def __init__(self, tap: PcmTap):
+        threading.Thread.__init__(self, name='spectrum', daemon=True)
+        self.tap = tap
+        self.active = threading.Event()
+        self.result = None  # (bands, rms, peak)，numpy数组
+        self.lastSeq = 0
+        self.lastData = 0.0
+        self.window = None
+        self.edges = None  # (采样率, 每段的起始bin)
+
+    @staticmethod
+    def available():
+        return np is not None
+
+    def setActive(self, active: bool):
+        self.tap.active = active
+        if active:
+            self.active.set()
+        else:
+            self.active.clear()
+            self.result = None
+
+    def run(self):
+        interval = 1 / self.RATE
+        while True:
+            self.active.wait()
+            began = time.perf_counter()
+            snapshot = self.tap.read()
+            if snapshot is not None and snapshot[0] != self.lastSeq:
+                self.lastSeq, self.lastData = snapshot[0], began
+                self.result = self.analyze(snapshot[1], snapshot[2])
+                if metrics.enabled:
+                    metrics.observe('spectrum.analyze', time.perf_counter() - began)
+            elif began - self.lastData > self.STALE:
+                self.result = None
+            time.sleep(max(0.0, interval - (time.perf_counter() - began)))
+
+    def scale(self, amplitude):
+        """振幅换算为dB后映射到0到1"""
+        db = 20 * np.log10(np.maximum(amplitude, 1e-9))
+        return np.clip(1 - db / self.FLOOR, 0.0, 1.0)
+
+    def bandStarts(self, rate: int):
+        if self.edges is None or self.edges[0] != rate:
+            edges = np.geomspace(self.LOW, min(self.HIGH, rate / 2), self.BANDS + 1)[:-1]
+            starts = np.minimum((edges * self.FFT_SIZE / rate).astype(np.int64), self.FFT_SIZE // 2)
+            self.edges = (rate, np.maximum(starts, np.arange(self.BANDS) + 1))  # 低频段至少一个bin
+        return self.edges[1]
+
+    def analyze(self, data: bytes, format: tuple):
+        rate, channels, encoding = format
+        pcm = pcmType(encoding)
+        if pcm is None or rate <= 0 or channels <= 0:
+            return None
+        dtype, fullScale = pcm
+        samples = np.frombuffer(data, dtype=dtype)
+        frames = len(samples) // channels
+        if frames == 0:
+            return None
+        samples = samples[:frames * channels].reshape(frames, channels).astype(np.float32) / fullScale
+        rms = np.sqrt(np.mean(samples * samples, axis=0))
+        peak = np.max(np.abs(samples), axis=0)
+
+        mono = samples.mean(axis=1)[-self.FFT_SIZE:]
+        if self.window is None or len(self.window) != len(mono):
+            self.window = np.hanning(len(mono)).astype(np.float32)
+        # 除以窗函数和的一半，满幅正弦波为0 dB
+        spectrum = np.abs(np.fft.rfft(mono * self.window, n=self.FFT_SIZE)) / max(1e-9, self.window.sum() / 2)
+        bands = np.maximum.reduceat(spectrum, self.bandStarts(rate))
+        return self.scale(bands), self.scale(rms), self.scale(peak)
+
+
+class Player:
+    """使用mpg123的python wrapper包封装一个播放器，解码和输出分别在两个线程中，通过PcmRingBuffer连接"""
+
+    class PlayState(Enum):
+        playing = 0
+        stop = 1
+        pause = 2
+
+    class DecodeThread(threading.Thread):
+        """解码线程，把当前流解码到环形缓冲区，缓冲区满时阻塞"""
+
+        def __init__(self, ring: PcmRingBuffer):
+            threading.Thread.__init__(self, name='decoder', daemon=True)
+            self.ring = ring
+            self.cond = threading.Condition()
+            self.stream = None
+            self.next = None  # 预先打开的下一首，当前流结束时无缝接上
+            self.taken = None  # (流, 从next取走接在它后面的流)，输出还没切换过去时在这个流中seek要把后者放回next
+            self.generation = 0
+            self.seekTo = None
+            self.crossfade = 0.0  # 交叉淡入淡出的秒数，0为无缝衔接
+            self.fadeStats = None  # 上一次交叉淡入淡出的耗时
+
+        def load(self, stream: Mpg123Stream, generation: int, seekTo=None):
+            with self.cond:
+                self.stream = stream
+                self.generation = generation
+                self.seekTo = seekTo
+                self.cond.notify()
+
+        def setNext(self, stream):
+            with self.cond:
+                self.next = stream
+                self.taken = None  # 预测变了，取走的那首不再放回
+
+        def run(self):
+            while True:
+                with self.cond:
+                    while self.stream is None:
+                        self.cond.wait()
+                    stream, generation, seekTo = self.stream, self.generation, self.seekTo
+                    self.stream = None
+                    if seekTo is not None and self.taken is not None and self.taken[0] is stream and self.next is None:
+                        # 下一首已经接上并解码了开头，这些数据随seek丢弃了，倒回开头重新作为下一首
+                        self.next = self.taken[1]
+                        self.next.seek(0)
+                    self.taken = None
+                if seekTo is not None:
+                    stream.seek(seekTo)
+                self.decode(stream, generation)
+
+        def decode(self, stream: Mpg123Stream, generation: int):
+            fade = None
+            while stream is not None:
+                index = self.ring.acquireWrite(generation)
+                if index < 0:  # 停止或者切歌
+                    return
+                if fade is None:
+                    fade = self.startFade(stream)
+                slot = self.ring.slots[index]
+                start = stream.decoded
+                if fade is not None and stream is not fade.incoming and fade.done():
+                    size = 0  # 已经完全淡出，前一首剩下的部分不再输出
+                else:
+                    try:
+                        began = metrics.enabled and time.perf_counter()
+                        size = stream.readInto(slot)
+                        if began:
+                            metrics.observe('decode.slot', time.perf_counter() - began)
+                    except Mpg123.DecodeException as error:
+                        print(f'decode {stream.path} failed, error: {error}')
+                        size = 0
+                    if size > 0 and fade is not None:
+                        if stream is fade.incoming:
+                            fade.fadeIn(slot, size, stream)
+                        else:
+                            fade.mix(slot, size, stream)
+                if size == 0:
+                    # 有预先打开的下一首时紧接着写入缓冲区，样本之间没有间隙
+                    with self.cond:
+                        if fade is not None and stream is not fade.incoming:
+                            stream.successor = fade.incoming
+                        else:
+                            stream.successor, self.next = self.next, None
+                            if stream.successor is not None:
+                                self.taken = (stream, stream.successor)
+                    self.ring.commitWrite(0, stream, start, generation)
+                    stream = stream.successor
+                else:
+                    self.ring.commitWrite(size, stream, start, generation, (stream.format, stream.sampleSize))
+                if fade is not None and fade.done() and stream is fade.incoming:
+                    self.finishFade(fade)
+                    fade = None
+
+        def startFade(self, stream: Mpg123Stream):
+            """当前流剩下的样本不超过淡入淡出的长度，并且下一首已经准备好时开始交叉淡入淡出"""
+            if self.crossfade <= 0 or np is None or self.next is None:
+                return None
+            remaining = stream.length() - stream.decoded
+            # 总长度是估计值时可能偏短，剩余为负时不淡出，由无缝衔接处理
+            if remaining <= 0 or remaining > self.crossfade * stream.rate:
+                return None
+            with self.cond:
+                incoming, self.next = self.next, None
+                self.taken = (stream, incoming) if incoming is not None else None
+            return Crossfade(incoming, remaining, stream.rate) if incoming is not None else None
+
+        def finishFade(self, fade: Crossfade):
+            duration = fade.length / fade.rate
+            self.fadeStats = {'duration': duration, 'slots': fade.slots, 'mixTime': fade.mixTime}
+            if metrics.enabled:
+                metrics.observe('crossfade.mix', fade.mixTime)
+
+    class OutputThread(threading.Thread):
+        """输出线程，从环形缓冲区取出PCM数据交给输出设备，暂停时不再取数据"""
+
+        def __init__(self, ring: PcmRingBuffer, dsp: PcmDsp, output: Out123Device, playing: threading.Event,
+                     callback, tap: PcmTap):
+            threading.Thread.__init__(self, name='output', daemon=True)
+            self.ring = ring
+            self.dsp = dsp
+            self.tap = tap
+            self.output = output
+            self.playing = playing
+            self.callback = callback
+            self.format = None
+            self.underruns = 0
+            self.current = None  # 正在输出的流和输出到的样本位置
+            self.samples = 0
+
+        def drop(self):
+            """丢弃设备中还没播放的数据，out123不是线程安全的，只在输出线程中调用"""
+            if self.format is not None:
+                self.output.drop()
+
+        def play(self, view: memoryview, size: int):
+            began = metrics.enabled and time.perf_counter()
+            self.output.play(view, size)
+            if began:  # 设备缓冲区满时阻塞的时间
+                metrics.observe('output.play', time.perf_counter() - began)
+
+        def run(self):
+            current = None
+            starved = False
+            lastGeneration = self.ring.generation
+            while True:
+                if not self.playing.is_set():
+                    if self.ring.generation != lastGeneration:  # 停止了
+                        lastGeneration = self.ring.generation
+                        current = None
+                        self.drop()
+                    self.playing.wait()
+                index, generation = self.ring.acquireRead(0.1)
+                if generation != lastGeneration:  # 切歌了
+                    lastGeneration = generation
+                    current = None
+                    self.drop()
+                if index < 0:
+                    if current is not None and not starved:  # 正在播放的流读不到数据
+                        self.underruns += 1
+                        starved = True
+                    continue
+                starved = False
+
+                stream, size = self.ring.tags[index], self.ring.sizes[index]
+                if stream is not current:
+                    current = stream
+                    self.dsp.setStream(stream)
+                if size > 0:
+                    # 按槽位记录的格式比较，解码线程可能已经解码到了后面格式不同的部分
+                    format, sampleSize = self.ring.formats[index]
+                    if format != self.format:
+                        self.output.start(*format)
+                        self.format = format
+                    began = metrics.enabled and time.perf_counter()
+                    self.dsp.process(self.ring.slots[index][:size], size, self.format[2])
+                    if began:
+                        metrics.observe('output.dsp', time.perf_counter() - began)
+                    self.play(self.ring.slots[index], size)
+                    if self.tap.active:
+                        self.tap.write(self.ring.slots[index], size, self.format)
+                    self.current = stream
+                    self.samples = self.ring.starts[index] + size // sampleSize
+                self.ring.releaseRead(generation)
+                if size == 0:
+                    current = None
+                    self.callback(generation, stream)
+
+    PREFETCH_BYTES = 64 * 1024
+    IO_HISTORY = 16
+
+    def __init__(self, callback, catalog=None, backend=None):
+        self.backend = backend or Mpg123Backend()
+        self.state = self.PlayState.stop
+        self.stream = None
+        self.startPosition = 0.0  # 当前歌曲开始播放的位置，还没有输出时position()返回它
+        self.callback = callback  # 当状态变化时调用callback(isNormalDone, nextPath)
+
+        # 后台预先打开下一首
+        self.preloader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='preloader')
+        self.prepareLock = threading.Lock()
+        self.nextPath = None
+        self.nextStream = None
+
+        # 曲库目录，需要实现seekIndex(path)、storeSeekIndex(path, index)和replayGain(path)，没有缓存的帧偏移表在后台生成
+        self.catalog = catalog
+        self.indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='indexer')
+        self.ioFiles = deque(maxlen=self.IO_HISTORY)  # 最近打开的文件的读取统计
+
+        self.ring = PcmRingBuffer()
+        self.dsp = PcmDsp(len(self.ring.slots[0]) // 2)
+        self.playing = threading.Event()
+        # 音频设备和两个线程到第一次播放时才创建，不拖慢启动
+        self.ThreadDecode = self.DecodeThread(self.ring)
+        self.ThreadOutput = None
+        self.output = None
+        self.tap = PcmTap(len(self.ring.slots[0]))
+        self.analyzer = None  # 第一次显示频谱时才创建
+        metrics.gauge('output.underruns', lambda: self.underruns)
+        metrics.gauge('ring.fill', self.ring.fill)
+
+    def startAudio(self):
+        """第一次播放时打开输出设备并启动解码和输出线程"""
+        if self.ThreadOutput is not None:
+            return
+        self.output = self.backend.openOutput()
+        self.ThreadDecode.start()
+        self.ThreadOutput = self.OutputThread(self.ring, self.dsp, self.output, self.playing, self.playDone, self.tap)
+        self.ThreadOutput.start()
+
+    @property
+    def underruns(self):
+        return self.ThreadOutput.underruns if self.ThreadOutput is not None else 0
+
+    def setVolume(self, level: float):
+        """level为0到1的音量，按三次方映射为增益，接近人耳的感知，下一个输出的槽位就生效"""
+        self.dsp.setVolume(max(0.0, min(1.0, level)) ** 3)
+
+    def setCrossfade(self, seconds: float):
+        """歌曲之间交叉淡入淡出的秒数，0为无缝衔接，需要numpy"""
+        self.ThreadDecode.crossfade = max(0.0, seconds)
+
+    def setReplayGain(self, mode: str, preamp=0.0):
+        """mode为off/track/album"""
+        self.dsp.setReplayGain(mode, preamp)
+
+    def bufferFill(self):
+        """环形缓冲区的填充比例，0到1"""
+        return self.ring.fill()
+
+    def setAnalysis(self, active: bool):
+        """显示频谱时打开分析，不显示时关闭，关闭后输出线程不再复制数据，分析线程也不再运行"""
+        if self.analyzer is None:
+            if not active or not SpectrumAnalyzer.available():
+                return
+            self.analyzer = SpectrumAnalyzer(self.tap)
+            self.analyzer.start()
+        self.analyzer.setActive(active)
+
+    def levels(self):
+        """最新的频谱和电平(bands, rms, peak)，都在0到1之间，没有在分析或者没有声音时返回None"""
+        return self.analyzer.result if self.analyzer is not None else None
+
+    def readStats(self):
+        """最近打开的文件的读取延迟，新的在前"""
+        return [stats.snapshot() for stats in reversed(self.ioFiles)]
+
+    def prepareNext(self, filePath):
+        """预测的下一首，在后台打开并预解码开头，当前歌曲结束时无缝切换"""
+        with self.prepareLock:
+            self.nextPath = filePath
+            self.nextStream = None
+        self.ThreadDecode.setNext(None)
+        if filePath is not None:
+            self.preloader.submit(self.preload, filePath)
+
+    def open(self, filePath: str):
+        stream = self.backend.openStream(filePath)
+        if stream.source is not None:
+            self.ioFiles.append(stream.source.stats)
+        index = self.catalog.seekIndex(filePath) if self.catalog is not None else None
+        if self.catalog is not None:
+            stream.gains = self.catalog.replayGain(filePath)
+        if index is not None:
+            stream.useIndex(index)
+        else:
+            self.indexer.submit(self.buildIndex, stream)
+        return stream
+
+    def buildIndex(self, stream: Mpg123Stream):
+        """用另一个句柄扫描文件生成帧偏移表，不影响正在解码的句柄"""
+        try:
+            index = self.backend.buildIndex(stream.path)
+        except (Mpg123.OpenFileException, Mpg123.LengthException, Mpg123.FormatException,
+                Mpg123.NeedMoreException) as error:
+            print(f'build seek index for {stream.path} failed, error: {error}')
+            return
+        if index is None:
+            return
+        stream.useIndex(index)
+        if self.catalog is not None:
+            self.catalog.storeSeekIndex(stream.path, index)
+
+    def preload(self, filePath: str):
+        try:
+            stream = self.open(filePath)
+            stream.prefetch(self.PREFETCH_BYTES)
+        except (Mpg123.OpenFileException, Mpg123.FormatException, Mpg123.NeedMoreException,
+                Mpg123.DecodeException) as error:
+            print(f'preload {filePath} failed, error: {error}')
+            return
+        with self.prepareLock:
+            if self.nextPath != filePath:  # 预测已经变了
+                return
+            self.nextStream = stream
+            self.ThreadDecode.setNext(stream)
+
+    def takePrepared(self, filePath: str):
+        with self.prepareLock:
+            stream = self.nextStream if self.nextPath == filePath else None
+            self.nextPath = None
+            self.nextStream = None
+        self.ThreadDecode.setNext(None)
+        return stream
+
+    def play(self, filePath: string, start=0.0, paused=False):
+        """从start秒开始播放，paused时只解码到缓冲区，等pause()继续"""
+        self.stop()
+        # 预先打开过的直接使用，开头已经解码好了
+        self.stream = self.takePrepared(filePath) or self.open(filePath)
+        self.startAudio()
+        self.startPosition = max(0.0, start)
+        seekTo = int(start * self.stream.rate) if start > 0 else None
+        self.ThreadDecode.load(self.stream, self.ring.generation, seekTo)
+        if paused:
+            self.state = self.PlayState.pause
+        else:
+            self.playInternal()
+
+    def seek(self, seconds: float):
+        """跳转到当前歌曲的指定位置，有帧偏移表时不需要读文件"""
+        if self.stream is None or self.state == self.PlayState.stop:
+            return
+        sample = int(max(0.0, seconds) * self.stream.rate)
+        generation = self.ring.clear()
+        self.startPosition = max(0.0, seconds)
+        if self.ThreadOutput is not None:  # 新位置的数据输出之前position()返回seek的位置
+            self.ThreadOutput.current = None
+        self.ThreadDecode.load(self.stream, generation, sample)
+
+    def position(self):
+        """当前歌曲已经输出的时长，秒"""
+        output = self.ThreadOutput
+        if self.stream is None:
+            return 0.0
+        if output is None or output.current is not self.stream:
+            return self.startPosition
+        return output.samples / self.stream.rate
+
+    def duration(self):
+        return self.stream.duration() if self.stream is not None else 0.0
+
+    def playInternal(self):
+        if self.stream is not None:
+            self.state = self.PlayState.playing
+            self.playing.set()
+
+    def playDone(self, generation, stream):
+        if generation != self.ring.generation:  # 已经切歌或者停止了
+            return
+        if stream.successor is not None:  # 已经无缝切换到了下一首
+            self.stream = stream.successor
+            self.startPosition = 0.0
+            with self.prepareLock:
+                self.nextPath = None
+                self.nextStream = None
+            self.callback(True, self.stream.path)
+            return
+        # 流已经完整输出，不清空缓冲区，避免丢弃设备中还没播放完的尾巴
+        self.playing.clear()
+        self.state = self.PlayState.stop
+        self.callback(True)
+
+    def pause(self):
+        if self.state == self.PlayState.playing:
+            self.playing.clear()
+            self.state = self.PlayState.pause
+        elif self.state == self.PlayState.pause:
+            self.playInternal()
+
+    def stop(self):
+        if self.state != self.PlayState.stop:
+            self.playing.clear()
+            self.ring.clear()
+            self.state = self.PlayState.stop
+
+
+class StateStore(threading.Thread):
+    """保存在JSON文件中的状态。update只修改内存中的数据，DELAY秒内的多次修改由后台线程合并成一次写入，
+    用writeAtomic写入，崩溃时文件要么是旧的要么是新的"""
+
+    DELAY = 1.0
+
+    def __init__(self, path: str):
+        threading.Thread.__init__(self, name='state', daemon=True)
+        self.path = path
+        self.cond = threading.Condition()
+        self.writeLock = threading.Lock()
+        self.data = self.read()
+        self.dirty = False
+        self.writes = 0
+        self.start()
+
+    def read(self):
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+            return data if isinstance(data, dict) else dict()
+        except FileNotFoundError:
+            return dict()
+        except (OSError, JSONDecodeError) as error:
+            print(f'read {self.path} failed, error: {error}')
+            return dict()
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def update(self, values: dict):
+        """值需要能用json保存，之后不能再修改"""
+        with self.cond:
+            self.data.update(values)
+            if not self.dirty:
+                self.dirty = True
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.dirty:
+                    self.cond.wait()
+            time.sleep(self.DELAY)  # 合并这段时间内的修改
+            self.flush()
+
+    def flush(self):
+        """立即写入还没保存的修改，退出前调用"""
+        with self.writeLock:
+            with self.cond:
+                if not self.dirty:
+                    return
+                text = json.dumps(self.data, ensure_ascii=False)
+                self.dirty = False
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                writeAtomic(self.path, text)
+                self.writes += 1
+            except OSError as error:
+                print(f'write {self.path} failed, error: {error}')
+
+
+class MPGSettings:
+    """设置管理，修改在后台合并写入"""
+
+    def __init__(self):
+        self.__dirs = 'dirs'
+        self.__mode = 'mode'
+        self.__vol = 'vol'
+        self.__replayGain = 'replayGain'
+        self.__crossfade = 'crossfade'
+        self.__collapseDuplicates = 'collapseDuplicates'
+
+        self.defaultDirs = [os.path.expanduser('~/Music')]
+        self.defaultMode = PlayMode.sequence
+        self.defaultVol = 100
+        self.defaultReplayGain = 'track'
+        self.defaultCrossfade = 0.0  # 秒，0为无缝衔接
+        self.defaultCollapseDuplicates = False
+
+        # 配置文件路径
+        self.__settingFile = os.path.join(configDir(), 'mpg_config.json')
+        self.__store = StateStore(self.__settingFile)
+        self.__settings = self.__store.data
+
+    def __str__(self):
+        return json.dumps(self.__settings)
+
+    @property
+    def keyDirs(self):
+        return self.__dirs
+
+    @property
+    def keyMode(self):
+        return self.__mode
+
+    @property
+    def keyVol(self):
+        return self.__vol
+
+    @property
+    def keyReplayGain(self):
+        return self.__replayGain
+
+    @property
+    def keyCrossfade(self):
+        return self.__crossfade
+
+    @property
+    def keyCollapseDuplicates(self):
+        return self.__collapseDuplicates
+
+    def storeSettings(self):
+        """立即写入，平时的修改由StateStore在后台写入"""
+        self.__store.flush()
+
+    def getSetting(self, key: str):
+        try:
+            if key == self.keyMode:
+                return PlayMode(self.__settings[key])
+            else:
+                return self.__settings[key]
+        except (KeyError, TypeError) as error:
+            if key == self.keyMode:
+                return self.defaultMode
+            elif key == self.keyDirs:
+                return self.defaultDirs
+            elif key == self.keyVol:
+                return self.defaultVol
+            elif key == self.keyReplayGain:
+                return self.defaultReplayGain
+            elif key == self.keyCrossfade:
+                return self.defaultCrossfade
+            elif key == self.keyCollapseDuplicates:
+                return self.defaultCollapseDuplicates
+
+    def updateSetting(self, key: str, value):
+        if key == self.keyMode:
+            newValue = value.value
+        else:
+            newValue = value
+
+        if key in self.__settings and self.__settings[key] == newValue:
+            return False
+        self.__store.update({key: newValue})
+        return True
+
+    def dumpSettings(self):
+        print(self.settings)
+
+
+class ViewEvent(Enum):
+    data = 0  # (ids, mode, append) 列表整体替换或者追加
+    remove = 1  # (ids,) 从列表中删除，ids升序
+    state = 2  # (state, music)
+    mode = 3  # (mode,)
+    vol = 4  # (vol,)
+    meta = 5  # (ids,) 这些歌曲的标签更新了
+    lyrics = 6  # (lyrics, line) 当前歌曲的歌词和正在唱的行，没有歌词时lyrics为None
+    waveform = 7  # (waveform,) 当前歌曲的波形，还没有生成或者无法生成时为None
+
+
+class NotifyBus:
+    """Model到界面的通知总线。post和call可以在任意线程中调用，积压的内容在主循环中一次分发，两次分发至少间隔一帧。
+    state/mode/vol/lyrics只保留最新的，meta合并id，data和remove按顺序合并，整体替换列表时丢弃之前的列表变化；
+    call为需要在主线程中执行的调用，例如后台线程送回的结果，在分发事件之前按顺序执行"""
+
+    FRAME_INTERVAL = 1 / 60  # 秒
+    LATEST = (ViewEvent.mode, ViewEvent.state, ViewEvent.vol, ViewEvent.lyrics, ViewEvent.waveform)
+
+    def __init__(self, schedule, later=None):
+        self.schedule = schedule  # schedule(func, *args)，在任意线程中调用，让主线程执行func
+        self.later = later  # later(seconds, func)，在主线程中调用，为None时不限制分发的频率
+        self.lock = threading.Lock()
+        self.handlers = dict()
+        self.calls = list()
+        self.listOps = list()  # [ViewEvent.data, ids, mode, append]或者[ViewEvent.remove, ids]
+        self.latest = dict()
+        self.meta = set()
+        self.pending = False  # 已经安排了分发
+        self.wokenAt = 0.0  # 安排分发的时间，启用了metrics时才记录
+        self.lastFlush = 0.0
+        self.posted = 0
+        self.flushes = 0
+
+    def connect(self, event: ViewEvent, handler):
+        self.handlers[event] = handler
+
+    def post(self, event: ViewEvent, *args):
+        with self.lock:
+            self.posted += 1
+            if event in self.LATEST:
+                self.latest[event] = args
+            elif event == ViewEvent.meta:
+                self.meta.update(args[0])
+            elif event == ViewEvent.data:
+                ids, mode, append = args[0], args[1], args[2] if len(args) > 2 else False
+                last = self.listOps[-1] if self.listOps else None
+                if not append:
+                    self.listOps = [[event, array('I', ids), mode, False]]
+                elif last is not None and last[0] == ViewEvent.data:
+                    last[1].extend(ids)
+                    last[2] = mode
+                else:
+                    self.listOps.append([event, array('I', ids), mode, True])
+            elif event == ViewEvent.remove:
+                last = self.listOps[-1] if self.listOps else None
+                if last is not None and last[0] == ViewEvent.remove:
+                    last[1] = array('I', sorted(set(last[1]).union(args[0])))
+                else:
+                    self.listOps.append([event, array('I', args[0])])
+            self.wake()
+
+    def call(self, func, *args):
+        with self.lock:
+            self.calls.append((func, args))
+            self.wake()
+
+    def wake(self):
+        if not self.pending:
+            self.pending = True
+            self.wokenAt = metrics.enabled and time.perf_counter()
+            self.schedule(self.flush)
+
+    def flush(self):
+        """在主线程中调用，距上次分发不到一帧时推迟到下一帧"""
+        if self.wokenAt:  # 从安排到主循环执行的延迟
+            metrics.observe('mainloop.latency', time.perf_counter() - self.wokenAt)
+        wait = self.lastFlush + self.FRAME_INTERVAL - time.monotonic()
+        if wait > 0 and self.later is not None:
+            self.later(wait, self.flushNow)
+        else:
+            self.flushNow()
+
+    def flushNow(self):
+        self.lastFlush = time.monotonic()
+        self.flushes += 1
+        began = metrics.enabled and time.perf_counter()
+        with self.lock:  # 执行calls时新加入的留到下一次
+            calls, self.calls = self.calls, list()
+        try:
+            for func, args in calls:
+                self.run(func, *args)
+        finally:  # 出错时也要重新安排分发，否则总线就停了
+            with self.lock:
+                listOps, self.listOps = self.listOps, list()
+                latest, self.latest = self.latest, dict()
+                meta, self.meta = self.meta, set()
+                self.pending = False
+                if self.calls:  # calls执行时又安排的调用
+                    self.wake()
+        for op in listOps:
+            self.dispatch(op[0], *op[1:])
+        for event in self.LATEST:
+            if event in latest:
+                self.dispatch(event, *latest[event])
+        if meta:
+            self.dispatch(ViewEvent.meta, sorted(meta))
+        if began:
+            metrics.observe('mainloop.dispatch', time.perf_counter() - began)
+
+    def dispatch(self, event: ViewEvent, *args):
+        handler = self.handlers.get(event)
+        if handler is not None:
+            self.run(handler, *args)
+
+    @staticmethod
+    def run(func, *args):
+        """一个调用或者处理函数出错只打印出来，不影响同一次分发中的其它调用和事件"""
+        try:
+            func(*args)
+        except Exception as error:
+            print(f'{getattr(func, "__qualname__", func)} failed, error: {error!r}')
+            traceback.print_exc()
+
+
+class Model:
+    """MVVM之M，不依赖GTK。
+    schedule(func, *args)让主循环执行func，可以在任意线程中调用，例如GLib.idle_add或者loop.call_soon_threadsafe；
+    later(seconds, func)在主线程中延迟执行func，用来限制通知的频率，为None时不限制；
+    watcher(callback)创建监视曲库目录的对象，为None时不监视；
+    backend为Player的解码和输出后端，为None时使用mpg123。
+    给界面的通知和后台线程送回的结果都经过NotifyBus，每帧最多分发一次"""
+
+    VOL_STEP = 5
+    INDEX_CHUNK = 500  # 主循环每次空闲时加入搜索索引的歌曲数
+    SEARCH_CHUNK = 4000  # 每帧校验的搜索候选数，10万首时一帧之内显示第一批结果，其余的之后追加
+    SESSION_INTERVAL = 5.0  # 播放时保存位置的间隔，秒
+    SESSION_HISTORY = 200  # 保存的随机播放历史的长度
+    LYRICS_LEAD = 0.02  # 定时器稍晚一点到，保证已经到了下一行
+
+    def __init__(self, schedule, watcher=None, later=None, backend=None):
+        self.bus = NotifyBus(schedule, later)
+        metrics.gauge('bus.calls', lambda: len(self.bus.calls))
+        metrics.gauge('bus.posted', lambda: self.bus.posted)
+        metrics.gauge('bus.flushes', lambda: self.bus.flushes)
+        self.settings = MPGSettings()
+        startupTrace.mark('settings')
+        self.catalog = MusicCatalog()
+        startupTrace.mark('open catalog')
+        self.player = Player(self.callbackFromPlayer, self.catalog, backend)
+        self.player.setVolume(self.settings.getSetting(self.settings.keyVol) / 100)
+        self.player.setReplayGain(self.settings.getSetting(self.settings.keyReplayGain))
+        self.player.setCrossfade(self.settings.getSetting(self.settings.keyCrossfade))
+        self.scanner = LibraryScanner(self.catalog, self.onScanned, self.bus.call)
+        self.metadata = MetadataService(self.catalog, self.onMetadata, self.bus.call)
+        self.lyrics = LyricsService(self.onLyricsLoaded, self.bus.call)
+        self.waveforms = WaveformService(self.onWaveformLoaded, self.bus.call)
+        self.duplicates = DuplicateFinder(self.catalog, self.onDuplicates, self.bus.call)
+        self.watcher = watcher(self.onWatchedChanged) if watcher is not None else None
+        startupTrace.mark('create player')
+
+        self.musicCurrent = None
+        self.musicSelected = None
+        self.musicNext = None  # 预测的下一首
+        self.queue = deque()  # 用户排队的id，排在播放模式决定的下一首之前
+        self.tracks = TrackTable()
+        self.shuffle = ShuffleEngine()
+        self.search = SearchIndex()
+        self.indexed = 0  # 已经加入搜索索引的id数，索引在主循环空闲时分批建立，先显示列表
+        self.indexing = False
+        self.query = ''
+        self.searching = None  # 正在分批校验的SearchIndex.Query
+        self.view = array('I')  # 列表中显示的id，升序，搜索时为过滤后的结果
+        self.shuffleDirty = False  # 过滤条件变了，洗牌的范围需要更新
+        self.duplicateGroups = None  # 重复歌曲的id，每组升序，还没有检查过时为None
+        self.collapsed = set()  # 合并重复歌曲时从列表和随机播放中隐藏的id，每组只保留第一首
+
+        # 上次退出时的播放状态，保存的是路径，曲库载入后找到对应的id再恢复
+        self.session = StateStore(os.path.join(configDir(), 'session.json'))
+        self.resume = dict(self.session.data) if self.session.get('track') else None
+        self.sessionTicking = False
+
+        # 歌词只在显示时为当前和下一首加载，按行变化的时间安排定时器，不轮询播放位置
+        self.lyricsShown = False
+        self.lyricsCurrent = None
+        self.lyricsPosted = None  # 最近通知界面的(lyrics, line)
+        self.lyricsTimer = 0  # 定时器的代数，过时的定时器到时后不做事
+
+        # 波形也只在显示时为当前和下一首打开，没有缓存时在后台生成
+        self.waveformShown = False
+        self.waveformPosted = None
+
+    def registerCallbacks(self, **kwargs):
+        """data/state/mode/vol/meta/remove/lyrics/waveform，对应ViewEvent中的事件"""
+        for event in ViewEvent:
+            if kwargs.get(event.name) is not None:
+                self.bus.connect(event, kwargs[event.name])
+
+    def updateDirs(self, newDirs: list):
+        if self.settings.updateSetting(self.settings.keyDirs, newDirs) or self.watcher is None \
+                or not self.watcher.monitors:
+            self.stop()
+            self.loadMusicData()
+        else:  # 文件夹配置项没变，不一定里面的内容没变，同步所有目录，不打断播放
+            self.watcher.touch(self.watcher.monitors)
+
+    def updateMode(self):
+        oldMode = self.settings.getSetting(self.settings.keyMode)
+
+        if oldMode == PlayMode.random:
+            self.shuffle.restart()
+
+        newMode = oldMode.next()
+        if newMode == PlayMode.random and self.musicCurrent is not None:
+            self.shuffle.played(self.musicCurrent.index)
+
+        self.settings.updateSetting(self.settings.keyMode, newMode)
+        self.bus.post(ViewEvent.mode, newMode)
+        self.predictNext()
+
+    def callbackFromPlayer(self, isNormalDone, nextPath=None):
+        if nextPath is not None:
+            self.bus.call(self.onAdvanced, nextPath)  # call from another thread
+        elif isNormalDone:
+            self.bus.call(self.playPrevNext, True)  # call from another thread
+
+    def onAdvanced(self, path: str):
+        """播放器已经无缝切换到了预测的下一首"""
+        music = self.musicNext
+        if music is None or music.path != path:
+            return
+        fromQueue = bool(self.queue) and self.queue[0] == music.index
+        if fromQueue:
+            self.queue.popleft()
+        if self.settings.getSetting(self.settings.keyMode) == PlayMode.random:
+            if fromQueue:
+                self.shuffle.played(music.index)
+            else:
+                self.shuffle.next(self.musicCurrent.index)
+        self.musicCurrent = music
+        self.bus.post(ViewEvent.state, self.player.state, self.musicCurrent)
+        self.syncWaveform()  # 先于下一首的预取排进生成队列
+        self.predictNext()
+        self.syncLyrics()
+        self.saveSession()
+
+    def predictNext(self):
+        """按照当前播放模式预测下一首，让播放器提前打开"""
+        self.musicNext = None
+        if self.queue:
+            self.musicNext = self.tracks.item(self.queue[0])
+        elif self.musicCurrent is not None and len(self.tracks) > 0:
+            index = self.musicCurrent.index
+            mode = self.settings.getSetting(self.settings.keyMode)
+            if mode == PlayMode.random:
+                self.syncShuffle()
+                nextS = self.shuffle.peek(index)
+            else:
+                nextS = self.nextIndex(index, True, mode)
+            if nextS >= 0:
+                self.musicNext = self.tracks.item(nextS)
+        self.player.prepareNext(self.musicNext.path if self.musicNext is not None else None)
+        if self.lyricsShown and self.musicNext is not None:
+            self.lyrics.get(self.musicNext.path)  # 提前加载下一首的歌词
+        if self.waveformShown and self.musicNext is not None:
+            self.waveforms.get(self.musicNext.path)
+
+    def reset(self):
+        self.musicCurrent = None
+        self.musicSelected = None
+        self.musicNext = None
+        self.queue.clear()
+        self.player.prepareNext(None)
+        self.metadata.cancel()
+        self.duplicates.cancel()
+        self.duplicateGroups = None
+        self.collapsed = set()
+        if self.watcher is not None:
+            self.watcher.stop()
+        self.tracks.clear()
+        self.search.clear()
+        self.indexed = 0
+        self.indexing = False
+        self.searching = None
+        self.view = array('I')
+        self.shuffle.reset()
+
+    def play(self, music: ItemMusic, randomAdd=True, start=0.0, paused=False):
+        """打开失败时停止播放，返回是否开始了播放"""
+        if music is not None:
+            try:
+                self.player.play(music.path, start, paused)
+            except STREAM_ERRORS as error:
+                print(f'play {music.path} failed, error: {error}')
+                self.player.stop()
+                self.bus.post(ViewEvent.state, self.player.state, self.musicCurrent)
+                return False
+            self.musicCurrent = music
+            self.bus.post(ViewEvent.state, self.player.state, self.musicCurrent)
+
+            mode = self.settings.getSetting(self.settings.keyMode)
+            if randomAdd and (mode == PlayMode.random):
+                self.shuffle.played(music.index)
+            self.syncWaveform()
+            self.predictNext()
+            self.syncLyrics()
+            self.saveSession()
+        return music is not None
+
+    def stop(self):
+        self.player.stop()
+        self.bus.post(ViewEvent.state, self.player.state, self.musicCurrent)
+        self.syncLyrics()
+        self.saveSession()
+
+    def pause(self):
+        self.player.pause()
+        self.bus.post(ViewEvent.state, self.player.state, self.musicCurrent)
+        self.syncLyrics()
+        self.saveSession()
+
+    def seek(self, seconds: float):
+        self.player.seek(seconds)
+        self.syncLyrics()
+        self.saveSession()
+
+    def close(self):
+        """退出前保存播放状态和设置，然后停止播放"""
+        self.saveSession()
+        self.session.flush()
+        self.settings.storeSettings()
+        self.player.stop()
+
+    def saveSession(self):
+        """记录当前歌曲、位置、队列和随机播放历史，由StateStore在后台合并写入，播放时每SESSION_INTERVAL秒记录一次位置"""
+        if self.resume is not None:  # 还没有恢复上次的状态，不要覆盖
+            return
+        state = self.player.state
+        shuffle = self.shuffle
+        self.session.update({
+            'track': self.musicCurrent.path if self.musicCurrent is not None else None,
+            'position': round(self.player.position(), 3) if state != self.player.PlayState.stop else 0.0,
+            'state': state.name,
+            'queue': [self.tracks.path(index) for index in self.queue],
+            'history': [self.tracks.path(index) for index in
+                        shuffle.history[max(0, shuffle.cursor + 1 - self.SESSION_HISTORY):shuffle.cursor + 1]],
+        })
+        if state == self.player.PlayState.playing and not self.sessionTicking and self.bus.later is not None:
+            self.sessionTicking = True
+            self.bus.later(self.SESSION_INTERVAL, self.sessionTick)
+
+    def sessionTick(self):
+        self.sessionTicking = False
+        self.saveSession()
+
+    def resumeTrack(self, start: int, rows: list):
+        """上次的歌曲在这批新加入的歌曲中时立即从上次的位置继续，上次暂停的恢复为暂停"""
+        resume = self.resume
+        dd, name = os.path.split(resume['track'])
+        for offset, row in enumerate(rows):
+            if row[1] + MUSIC_EXT == name and row[0] == dd:
+                resume['index'] = start + offset
+                state = resume.get('state')
+                if self.musicCurrent is None and state != self.player.PlayState.stop.name:
+                    if not self.play(self.tracks.item(start + offset), randomAdd=False, start=resume.get('position', 0.0),
+                                     paused=state == self.player.PlayState.pause.name):
+                        resume['index'] = None  # 例如文件已经删除但还在曲库目录中，不再恢复这首，队列等照常恢复
+                elif self.musicCurrent is None:
+                    self.musicCurrent = self.tracks.item(start + offset)
+                    self.bus.post(ViewEvent.state, self.player.state, self.musicCurrent)
+                return
+
+    def resumeSession(self):
+        """曲库载入完成后恢复队列和随机播放历史"""
+        resume, self.resume = self.resume, None
+        found = self.tracks.find(resume.get('queue', []) + resume.get('history', []))
+        self.queue.extend(found[path] for path in resume.get('queue', []) if path in found)
+        history = [found[path] for path in resume.get('history', []) if path in found]
+        if self.musicCurrent is not None and resume.get('index') == self.musicCurrent.index:
+            self.syncShuffle()
+            self.shuffle.restore(history)
+            self.predictNext()
+        self.saveSession()
+
+    def togglePlay(self):
+        if self.player.state == self.player.PlayState.playing:  # 正在播放，则暂停
+            self.pause()
+        elif self.player.state == self.player.PlayState.pause and \
+                (self.musicSelected is None or self.musicSelected == self.musicCurrent):
+            self.pause()  # 暂停中再调用一次为继续，例如恢复了上次暂停的位置
+        else:  # 没有在播放
+            if self.musicSelected is not None:  # 选择的音乐记录不为空
+                self.play(self.musicSelected)  # 播放选中的音乐
+            else:  # 无正在播放的记录
+                if self.musicCurrent is not None:  # 有选择的音乐
+                    self.play(self.musicCurrent)
+
+    def showLyrics(self, show: bool):
+        self.lyricsShown = show
+        if show and self.musicNext is not None:
+            self.lyrics.get(self.musicNext.path)
+        self.syncLyrics()
+
+    def syncLyrics(self):
+        """当前歌曲、播放状态或者位置变了，重新找正在唱的行，安排下一行的定时器"""
+        self.lyricsTimer += 1
+        lyrics = None
+        if self.lyricsShown and self.musicCurrent is not None:
+            loaded, lyrics = self.lyrics.get(self.musicCurrent.path)
+            if not loaded:  # 加载完后在onLyricsLoaded中再同步
+                return
+        self.lyricsCurrent = lyrics
+        self.followLyrics(self.lyricsTimer)
+
+    def followLyrics(self, timer: int):
+        if timer != self.lyricsTimer:
+            return
+        lyrics = self.lyricsCurrent
+        position = self.player.position()
+        line = lyrics.lineAt(position) if lyrics is not None else -1
+        if self.lyricsPosted != (lyrics, line):
+            self.lyricsPosted = (lyrics, line)
+            self.bus.post(ViewEvent.lyrics, lyrics, line)
+        if lyrics is None or self.player.state != self.player.PlayState.playing or self.bus.later is None:
+            return
+        change = lyrics.nextChange(line)
+        if change is not None:
+            self.bus.later(max(0.0, change - position) + self.LYRICS_LEAD, functools.partial(self.followLyrics, timer))
+
+    def onLyricsLoaded(self, path: str, lyrics):
+        if self.musicCurrent is not None and self.musicCurrent.path == path:
+            self.syncLyrics()
+
+    def showWaveform(self, show: bool):
+        self.waveformShown = show
+        self.syncWaveform()
+
+    def syncWaveform(self):
+        """当前歌曲变了，通知界面它的波形，还在生成时先通知None，生成完后在onWaveformLoaded中再通知"""
+        waveform = None
+        if self.waveformShown and self.musicCurrent is not None:
+            _, waveform = self.waveforms.get(self.musicCurrent.path)
+        if waveform is not self.waveformPosted:
+            self.waveformPosted = waveform
+            self.bus.post(ViewEvent.waveform, waveform)
+
+    def onWaveformLoaded(self, path: str, waveform):
+        if self.musicCurrent is not None and self.musicCurrent.path == path:
+            self.syncWaveform()
+
+    def nextIndex(self, index: int, isDirectionNext: bool, mode: PlayMode):
+        """非随机模式下在列表中显示的歌曲里找上一首/下一首"""
+        if mode == PlayMode.singleLoop:
+            return index
+        size = len(self.view)
+        if size == 0:
+            return -1
+        # 当前歌曲被过滤掉时，position是它在列表中应该在的位置
+        position = bisect_left(self.view, index)
+        inView = position < size and self.view[position] == index
+        if isDirectionNext:
+            position = position + 1 if inView else position
+        else:
+            position = position - 1
+        if mode == PlayMode.loop:
+            position %= size
+        elif position < 0 or position >= size:
+            return -1
+        return self.view[position]
+
+    def syncShuffle(self):
+        if self.shuffleDirty:
+            self.shuffleDirty = False
+            if self.query or self.collapsed:
+                self.shuffle.restrict(self.view, len(self.tracks))
+            else:
+                self.shuffle.restrict(self.tracks.liveIds(), len(self.tracks))
+
+    def setFilter(self, query: str):
+        """按搜索内容过滤列表，播放上一首/下一首也只在过滤结果中选择。
+        只搜索已经建立了索引的歌曲，先显示第一批结果，剩下的候选和之后索引的歌曲在主循环中分批校验，追加到列表"""
+        self.query = query.strip()
+        self.searching = self.search.start(self.query) if self.query else None
+        if self.searching is not None:
+            self.view = self.searching.take(self.SEARCH_CHUNK)
+            self.bus.call(self.searchStep, self.searching)
+        else:
+            self.view = self.tracks.liveIds()
+        if self.collapsed:
+            self.view = array('I', (index for index in self.view if index not in self.collapsed))
+        self.shuffleDirty = True
+        self.bus.post(ViewEvent.data, self.view, self.settings.getSetting(self.settings.keyMode))
+        if self.settings.getSetting(self.settings.keyMode) == PlayMode.random:
+            self.predictNext()
+
+    def enqueue(self, index: int):
+        """把歌曲排在接下来播放，返回在队列中的位置"""
+        if index < 0 or index >= len(self.tracks) or index in self.tracks.removed:
+            return -1
+        self.queue.append(index)
+        if len(self.queue) == 1:
+            self.predictNext()
+        self.saveSession()
+        return len(self.queue) - 1
+
+    def playPrevNext(self, isDirectionNext):
+        if isDirectionNext and self.queue:
+            self.play(self.tracks.item(self.queue.popleft()))
+            self.bus.post(ViewEvent.state, self.player.state, self.musicCurrent)
+            return
+        if self.musicCurrent is None:
+            index = 0
+        else:
+            index = self.musicCurrent.index
+
+        mode = self.settings.getSetting(self.settings.keyMode)
+        if mode != PlayMode.random:
+            nextS = self.nextIndex(index, isDirectionNext, mode)
+        else:
+            if isDirectionNext:
+                self.syncShuffle()
+                nextS = self.shuffle.next(index)
+            else:
+                nextS = self.shuffle.prev()
+                if nextS < 0:
+                    return
+
+        if nextS < 0:
+            self.pause()
+        else:
+            music = self.tracks.item(nextS)
+            self.play(music, randomAdd=False)
+        self.bus.post(ViewEvent.state, self.player.state, self.musicCurrent)
+
+    def loadMusicData(self):
+        self.reset()
+
+        # 获取播放模式设置，先清空列表，上次的曲库从曲库目录中分批送回，之后才在后台检查文件系统
+        playMode = self.settings.getSetting(self.settings.keyMode)
+        self.bus.post(ViewEvent.data, range(len(self.tracks)), playMode)
+
+        self.scanner.start(self.settings.getSetting(self.settings.keyDirs), cached=True)
+
+    def onScanned(self, rows: list, isDone: bool, cached=False):
+        if rows and not self.tracks:
+            startupTrace.mark('first rows')
+        start = len(self.tracks)
+        self.addRows(rows)
+        if self.resume is not None and 'index' not in self.resume:
+            self.resumeTrack(start, rows)
+        if not isDone:
+            return
+        if self.resume is not None:
+            self.resumeSession()
+        dirs = self.settings.getSetting(self.settings.keyDirs)
+        if cached:  # 缓存的曲库已经显示出来，在后台核对文件系统的变化，结果和目录监视一样处理
+            print(f'{len(self.tracks)} files loaded from catalog')
+            self.scanner.refresh(dirs, functools.partial(self.onRefreshed, self.tracks.generation), deep=True)
+            return
+        print(f'scan done, {len(self.tracks)} files')
+        self.requestMetadata()
+        self.requestDuplicates()
+        if self.watcher is not None:
+            self.watcher.watch(self.catalog.dirTree(dirs))
+
+    def searchStep(self, query):
+        if query is not self.searching:  # 搜索内容已经变了
+            return
+        ids = query.take(self.SEARCH_CHUNK)
+        if not query.done():
+            self.bus.call(self.searchStep, query)
+        elif query.end < len(self.search.keys):  # 搜索期间又建立了索引的歌曲
+            self.searching = self.search.start(self.query, query.end)
+            self.bus.call(self.searchStep, self.searching)
+        self.appendView(ids)
+
+    def finishSearch(self):
+        """建立完索引并校验完所有候选，需要完整结果时调用，例如无界面模式的search命令"""
+        self.indexUpTo(len(self.tracks))
+        while self.searching is not None and not (self.searching.done() and
+                                                  self.searching.end >= len(self.search.keys)):
+            self.searchStep(self.searching)
+
+    def appendView(self, ids):
+        """搜索结果追加到列表末尾，合并重复歌曲时隐藏的不显示"""
+        if self.collapsed:
+            ids = array('I', (index for index in ids if index not in self.collapsed))
+        if not ids:
+            return
+        self.view.extend(ids)
+        self.shuffle.resize(len(self.tracks))
+        self.shuffle.add(ids)
+        self.bus.post(ViewEvent.data, ids, self.settings.getSetting(self.settings.keyMode), True)
+
+    def indexUpTo(self, end: int):
+        for index in range(self.indexed, end):
+            if index not in self.tracks.removed:
+                self.search.add(index, self.tracks.searchText(index))
+        self.indexed = max(self.indexed, end)
+
+    def scheduleIndex(self):
+        if not self.indexing and self.indexed < len(self.tracks):
+            self.indexing = True
+            self.bus.call(self.indexStep, self.tracks.generation)
+
+    def indexStep(self, generation: int):
+        if generation != self.tracks.generation:  # 曲库已经重新载入了
+            return
+        self.indexing = False
+        self.indexUpTo(min(len(self.tracks), self.indexed + self.INDEX_CHUNK))
+        query = self.searching
+        if query is not None and query.done() and query.end < len(self.search.keys):  # 新索引的歌曲中符合搜索条件的
+            self.searching = self.search.start(self.query, query.end)
+            self.searchStep(self.searching)
+        self.scheduleIndex()
+
+    def addRows(self, rows: list):
+        """加入新的歌曲，符合搜索条件的追加到列表末尾"""
+        ids = self.tracks.extend(rows)
+
+        if self.query:  # 建立索引之后才显示新加入的歌曲中符合搜索条件的，见indexStep
+            self.shuffle.resize(len(self.tracks))
+        else:
+            self.shuffle.grow(len(self.tracks))
+            self.view.extend(ids)
+            if ids:
+                playMode = self.settings.getSetting(self.settings.keyMode)
+                self.bus.post(ViewEvent.data, ids, playMode, True)
+        self.scheduleIndex()
+
+    def requestMetadata(self):
+        """新增或变化的文件在后台解析标签、时长和帧数"""
+        ids = self.tracks.untagged()
+        if ids:
+            self.metadata.request([(index, self.tracks.path(index)) for index in ids], self.tracks.generation)
+
+    def requestDuplicates(self, force=False):
+        """合并重复歌曲时，曲库变化后在后台为新增或变化的文件计算哈希，重新找出重复的组；force时不合并也检查"""
+        if not force and not self.settings.getSetting(self.settings.keyCollapseDuplicates):
+            return
+        self.duplicates.request([self.tracks.path(index) for index in self.tracks.liveIds()], self.tracks.generation)
+
+    def onDuplicates(self, generation: int, groups: list):
+        if generation != self.tracks.generation:  # 曲库已经重新载入了
+            return
+        found = self.tracks.find([path for group in groups for path in group])
+        self.duplicateGroups = list()
+        for group in groups:
+            ids = sorted(found[path] for path in group if path in found)
+            if len(ids) > 1:
+                self.duplicateGroups.append(ids)
+        print(f'{len(self.duplicateGroups)} duplicate groups found')
+        self.applyCollapse()
+
+    def setCollapseDuplicates(self, collapse: bool):
+        self.settings.updateSetting(self.settings.keyCollapseDuplicates, collapse)
+        if collapse and self.duplicateGroups is None and not self.duplicates.busy():
+            self.requestDuplicates()
+        self.applyCollapse()
+
+    def applyCollapse(self):
+        """按设置和已经找到的重复组更新隐藏的歌曲，变了时重新生成列表"""
+        collapsed = set()
+        if self.settings.getSetting(self.settings.keyCollapseDuplicates) and self.duplicateGroups:
+            collapsed.update(index for group in self.duplicateGroups for index in group[1:])
+        if collapsed != self.collapsed:
+            self.collapsed = collapsed
+            self.setFilter(self.query)
+
+    def onWatchedChanged(self, dirs: list):
+        self.scanner.refresh(dirs, functools.partial(self.onRefreshed, self.tracks.generation))
+
+    def onRefreshed(self, generation: int, removed: list, rows: list):
+        """目录监视发现的变化：删除的歌曲从列表中去掉，新增的追加到列表末尾，变化了的重新解析标签，不打断播放和选择"""
+        if generation != self.tracks.generation:  # 曲库已经重新载入了
+            return
+        paths = [os.path.join(row[0], row[1] + MUSIC_EXT) for row in rows]
+        found = self.tracks.find(removed + paths)
+
+        gone = sorted(found[path] for path in removed if path in found)
+        hidden = list()
+        for index in gone:
+            self.tracks.remove(index)
+            self.search.remove(index)
+            self.shuffle.remove(index)
+            position = bisect_left(self.view, index)
+            if position < len(self.view) and self.view[position] == index:
+                del self.view[position]
+                hidden.append(index)
+        if hidden:
+            self.bus.post(ViewEvent.remove, hidden)
+        if gone and self.queue:
+            self.queue = deque(index for index in self.queue if index not in self.tracks.removed)
+
+        added = list()
+        updated = list()
+        for path, row in zip(paths, rows):
+            index = found.get(path)
+            if index is None:
+                added.append(row)
+            else:
+                self.tracks.invalidate(index, row[2])
+                self.lyrics.forget(path)
+                self.waveforms.forget(path)
+                updated.append(index)
+        self.addRows(added)
+        print(f'library changed, {len(gone)} removed, {len(added)} added, {len(updated)} updated')
+
+        if self.musicSelected is not None and self.musicSelected.index in self.tracks.removed:
+            self.musicSelected = None
+        if self.musicNext is None:
+            if added:  # 例如顺序播放到了最后一首，现在有了下一首
+                self.predictNext()
+        elif self.musicNext.index in self.tracks.removed or self.musicNext.index in updated:
+            self.predictNext()
+        self.requestMetadata()
+        self.requestDuplicates()
+        if self.watcher is not None:
+            self.watcher.watch(self.catalog.dirTree(self.settings.getSetting(self.settings.keyDirs)))
+            self.watcher.done()
+
+    def onMetadata(self, generation: int, results: list):
+        if generation != self.tracks.generation:  # 曲库已经重新载入了
+            return
+        for index, _, meta in results:
+            if index in self.tracks.removed:
+                continue
+            self.tracks.setMetadata(index, meta)
+            if index < self.indexed:  # 还没有索引的以后用新的标签索引
+                self.search.add(index, self.tracks.searchText(index))
+            if self.musicCurrent is not None and self.musicCurrent.index == index:
+                self.musicCurrent = self.tracks.item(index)
+                self.bus.post(ViewEvent.state, self.player.state, self.musicCurrent)
+        self.bus.post(ViewEvent.meta, [index for index, _, _ in results])
+
+    def adjustVol(self, up: bool):
+        vol = self.settings.getSetting(self.settings.keyVol)
+        vol = max(0, min(100, vol + (self.VOL_STEP if up else -self.VOL_STEP)))
+        self.player.setVolume(vol / 100)
+        self.settings.updateSetting(self.settings.keyVol, vol)
+        self.bus.post(ViewEvent.vol, vol)
@@ -0,0 +1,1078 @@
+import os
+import time
+from array import array
+from bisect import bisect_left
+import gi
+gi.require_version("Gtk", "3.0")
+gi.require_version("Gdk", "3.0")
+from gi.repository import Gtk
+from gi.repository.Gtk import License, Widget
+from gi.repository import Gdk, Gio, GLib, GObject, Pango
+from mpgcore import MUSIC_EXT, ItemMusic, Model, Player, PlayMode, SpectrumAnalyzer, TrackTable, metrics, startupTrace
+
+
+class LibraryWatcher:
+    """用Gio.FileMonitor（inotify）监视曲库中的每个目录，一阵密集的变化（例如rsync）合并成一次同步"""
+
+    QUIET_TIME = 0.5  # 秒，这么久没有新的变化才开始同步
+    MAX_DELAY = 5.0  # 一直有变化时最多等这么久
+    EVENTS = (Gio.FileMonitorEvent.CREATED, Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+              Gio.FileMonitorEvent.MOVED_IN, Gio.FileMonitorEvent.MOVED_OUT, Gio.FileMonitorEvent.RENAMED)
+
+    def __init__(self, callback):
+        self.callback = callback  # callback(dirs)，在主线程中调用，同步完成后需要调用done
+        self.monitors = dict()
+        self.dirty = set()
+        self.firstChange = 0.0
+        self.lastChange = 0.0
+        self.timer = 0
+        self.busy = False
+
+    def watch(self, dirs: list):
+        """改为监视dirs，已经在监视的目录保持不变"""
+        dirs = set(dirs)
+        for dd in [dd for dd in self.monitors if dd not in dirs]:
+            self.monitors.pop(dd).cancel()
+        for dd in dirs.difference(self.monitors):
+            try:
+                monitor = Gio.File.new_for_path(dd).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            except GLib.Error as error:  # 可能超过了inotify的监视数量上限
+                print(f'watch {dd} failed, error: {error}')
+                continue
+            monitor.connect('changed', self.onChanged, dd)
+            self.monitors[dd] = monitor
+
+    def stop(self):
+        for monitor in self.monitors.values():
+            monitor.cancel()
+        self.monitors.clear()
+        self.dirty.clear()
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = 0
+        self.busy = False
+
+    def relevant(self, file):
+        if file is None:
+            return False
+        path = file.get_path()
+        name = os.path.basename(path)
+        if name.startswith('.'):  # 隐藏文件，包括rsync写入中的临时文件
+            return False
+        return name.endswith(MUSIC_EXT) or path in self.monitors or os.path.isdir(path)
+
+    def onChanged(self, monitor, file, otherFile, event, dd: str):
+        if event in self.EVENTS and file.get_path() != dd and (self.relevant(file) or self.relevant(otherFile)):
+            self.touch([dd])
+
+    def touch(self, dirs):
+        """标记目录需要同步，等变化平息后再同步"""
+        now = time.monotonic()
+        if not self.dirty:
+            self.firstChange = now
+        self.lastChange = now
+        self.dirty.update(dirs)
+        if not self.timer and self.dirty:
+            self.timer = GLib.timeout_add(int(self.QUIET_TIME * 1000), self.onTimer)
+
+    def onTimer(self):
+        now = time.monotonic()
+        if self.busy or (now - self.lastChange < self.QUIET_TIME and now - self.firstChange < self.MAX_DELAY):
+            return True
+        self.timer = 0
+        dirs, self.dirty = self.dirty, set()
+        self.busy = True
+        self.callback(sorted(dirs))
+        return False
+
+    def done(self):
+        """上一次同步完成，同步期间积累的变化由定时器接着处理"""
+        self.busy = False
+
+
+class TrackListModel(GObject.GObject):
+    """TrackTable之上的列表模型，只保存显示顺序的id数组，get_item时才创建ItemMusic视图"""
+
+    __gsignals__ = {
+        'items-changed': (GObject.SignalFlags.RUN_LAST, None, (int, int, int)),
+    }
+
+    def __init__(self, table: TrackTable):
+        super().__init__()
+        self.table = table
+        self.rows = array('I')  # 按id升序
+
+    def get_n_items(self):
+        return len(self.rows)
+
+    def get_item(self, position: int):
+        return self.table.item(self.rows[position])
+
+    def splice(self, position: int, removed: int, ids):
+        self.rows[position:position + removed] = array('I', ids)
+        self.emit('items-changed', position, removed, len(ids))
+
+    def rowOf(self, index: int):
+        """id在列表中的行号，不在列表中时返回-1"""
+        row = bisect_left(self.rows, index)
+        return row if row < len(self.rows) and self.rows[row] == index else -1
+
+
+class TrackListView(Gtk.Stack):
+    """虚拟化的歌曲列表，不为每一行创建控件，只在一个绘图区域里绘制可见的行"""
+
+    __gsignals__ = {
+        'row-activated': (GObject.SignalFlags.RUN_FIRST, None, (int,)),
+        'row-selected': (GObject.SignalFlags.RUN_FIRST, None, (int,)),
+    }
+
+    PADDING = 4
+
+    def __init__(self):
+        super().__init__()
+        self.model = None
+        self.selected = -1
+        self.rowHeight = 0
+
+        # 滚动位置以像素为单位
+        self.adjustment = Gtk.Adjustment(value=0, lower=0, upper=0, step_increment=1, page_increment=1, page_size=0)
+        self.adjustment.connect('value-changed', lambda _: self.area.queue_draw())
+
+        self.area = Gtk.DrawingArea()
+        self.area.set_can_focus(True)
+        self.area.get_style_context().add_class(Gtk.STYLE_CLASS_VIEW)
+        self.area.add_events(Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.SCROLL_MASK |
+                             Gdk.EventMask.SMOOTH_SCROLL_MASK | Gdk.EventMask.KEY_PRESS_MASK)
+        self.area.connect('draw', self.onDraw)
+        self.area.connect('size-allocate', lambda *_: self.updateAdjustment())
+        self.area.connect('style-updated', self.onStyleUpdated)
+        self.area.connect('button-press-event', self.onButtonPress)
+        self.area.connect('scroll-event', self.onScroll)
+        self.area.connect('key-press-event', self.onKeyPress)
+
+        # 所有可见行复用同一个layout
+        self.layout = self.area.create_pango_layout('')
+        self.layout.set_alignment(Pango.Alignment.CENTER)
+        self.layout.set_ellipsize(Pango.EllipsizeMode.END)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        box.pack_start(self.area, True, True, 0)
+        box.pack_end(Gtk.Scrollbar(orientation=Gtk.Orientation.VERTICAL, adjustment=self.adjustment), False, True, 0)
+        self.add_named(box, 'list')
+
+    def bindModel(self, model):
+        """model需要实现get_n_items/get_item和items-changed信号，如TrackListModel"""
+        self.model = model
+        self.model.connect('items-changed', self.onItemsChanged)
+        self.onItemsChanged(model, 0, 0, 0)
+
+    def setPlaceholder(self, placeholder: Widget):
+        self.add_named(placeholder, 'placeholder')
+        self.updateVisibleChild()
+
+    def size(self):
+        return self.model.get_n_items() if self.model is not None else 0
+
+    def updateVisibleChild(self):
+        if self.get_child_by_name('placeholder') is not None:
+            self.set_visible_child_name('list' if self.size() > 0 else 'placeholder')
+
+    def updateRowHeight(self):
+        self.layout.set_text('Ag', -1)
+        _, height = self.layout.get_pixel_size()
+        self.rowHeight = height + 2 * self.PADDING
+
+    def updateAdjustment(self):
+        if self.rowHeight <= 0:
+            self.updateRowHeight()
+        pageSize = self.area.get_allocated_height()
+        upper = max(self.size() * self.rowHeight, pageSize)
+        self.adjustment.configure(min(self.adjustment.get_value(), upper - pageSize), 0, upper,
+                                  self.rowHeight, pageSize * 0.9, pageSize)
+
+    def onStyleUpdated(self, _):
+        self.layout.context_changed()
+        self.updateRowHeight()
+        self.updateAdjustment()
+
+    def onItemsChanged(self, model, position: int, removed: int, added: int):
+        if self.selected >= position + removed:
+            self.selected += added - removed
+        elif self.selected >= position:
+            self.selected = -1
+        self.updateVisibleChild()
+        self.updateAdjustment()
+        self.area.queue_draw()
+
+    def onDraw(self, widget: Widget, cr):
+        width = widget.get_allocated_width()
+        height = widget.get_allocated_height()
+        context = widget.get_style_context()
+        Gtk.render_background(context, cr, 0, 0, width, height)
+        if self.rowHeight <= 0:
+            return
+
+        offset = self.adjustment.get_value()
+        first = int(offset // self.rowHeight)
+        last = min(self.size(), first + height // self.rowHeight + 2)
+        self.layout.set_width((width - 2 * self.PADDING) * Pango.SCALE)
+        y = first * self.rowHeight - offset
+        for index in range(first, last):
+            self.layout.set_text(self.model.get_item(index).name, -1)
+            if index == self.selected:
+                context.save()
+                context.set_state(Gtk.StateFlags.SELECTED)
+                Gtk.render_background(context, cr, 0, y, width, self.rowHeight)
+                Gtk.render_layout(context, cr, self.PADDING, y + self.PADDING, self.layout)
+                context.restore()
+            else:
+                Gtk.render_layout(context, cr, self.PADDING, y + self.PADDING, self.layout)
+            y += self.rowHeight
+        return True
+
+    def refresh(self):
+        """行的内容变了，重新绘制可见的行"""
+        self.area.queue_draw()
+
+    def rowAtY(self, y: float):
+        if self.rowHeight <= 0:
+            return -1
+        index = int((y + self.adjustment.get_value()) // self.rowHeight)
+        return index if index < self.size() else -1
+
+    def selectRow(self, index: int):
+        if index < 0 or index >= self.size():
+            return
+        self.selected = index
+        self.scrollToRow(index)
+        self.area.queue_draw()
+        self.emit('row-selected', index)
+
+    def scrollToRow(self, index: int):
+        top = index * self.rowHeight
+        value = self.adjustment.get_value()
+        pageSize = self.adjustment.get_page_size()
+        if top < value:
+            self.adjustment.set_value(top)
+        elif top + self.rowHeight > value + pageSize:
+            self.adjustment.set_value(top + self.rowHeight - pageSize)
+
+    def onButtonPress(self, widget: Widget, event):
+        widget.grab_focus()
+        index = self.rowAtY(event.y)
+        if index < 0:
+            return False
+        if event.type == Gdk.EventType._2BUTTON_PRESS:
+            self.emit('row-activated', index)
+        elif event.type == Gdk.EventType.BUTTON_PRESS:
+            self.selectRow(index)
+        return True
+
+    def onScroll(self, widget: Widget, event):
+        ok, _, dy = event.get_scroll_deltas()
+        if not ok:
+            if event.direction == Gdk.ScrollDirection.UP:
+                dy = -1
+            elif event.direction == Gdk.ScrollDirection.DOWN:
+                dy = 1
+            else:
+                return False
+        self.adjustment.set_value(self.adjustment.get_value() + dy * 3 * self.rowHeight)
+        return True
+
+    def onKeyPress(self, widget: Widget, event):
+        pageRows = max(1, int(self.adjustment.get_page_size() // max(1, self.rowHeight)))
+        key = event.keyval
+        if key in (Gdk.KEY_Return, Gdk.KEY_KP_Enter):
+            if self.selected >= 0:
+                self.emit('row-activated', self.selected)
+            return True
+        elif key == Gdk.KEY_Up:
+            index = self.selected - 1
+        elif key == Gdk.KEY_Down:
+            index = self.selected + 1
+        elif key == Gdk.KEY_Page_Up:
+            index = self.selected - pageRows
+        elif key == Gdk.KEY_Page_Down:
+            index = self.selected + pageRows
+        elif key == Gdk.KEY_Home:
+            index = 0
+        elif key == Gdk.KEY_End:
+            index = self.size() - 1
+        else:
+            return False
+        self.selectRow(max(0, min(index, self.size() - 1)))
+        return True
+
+
+class SpectrumMeter(Gtk.DrawingArea):
+    """标题栏中的频谱和电平表，悬浮模式下也能看到。只在显示在屏幕上并且正在播放时打开播放器的频谱分析，
+    窗口隐藏、最小化或者暂停时分析线程和这里的定时器都停下来"""
+
+    REFRESH_INTERVAL = 1000 // SpectrumAnalyzer.RATE  # 毫秒
+    LEVEL_HEIGHT = 2  # 每个声道电平条的高度
+
+    def __init__(self, player: Player):
+        super().__init__()
+        self.player = player
+        self.set_size_request(96, 24)
+        self.set_valign(Gtk.Align.CENTER)
+        self.mapped = False
+        self.iconified = False
+        self.playing = False
+        self.timer = None
+        self.levels = None
+        self.connect('map', self.onMap)
+        self.connect('unmap', self.onUnmap)
+        self.connect('draw', self.onDraw)
+
+    def onMap(self, _):
+        self.mapped = True
+        self.update()
+
+    def onUnmap(self, _):
+        self.mapped = False
+        self.update()
+
+    def setIconified(self, iconified: bool):
+        self.iconified = iconified
+        self.update()
+
+    def setPlaying(self, playing: bool):
+        self.playing = playing
+        self.update()
+
+    def update(self):
+        active = self.mapped and self.playing and not self.iconified
+        if active == (self.timer is not None):
+            return
+        self.player.setAnalysis(active)
+        if active:
+            self.timer = GLib.timeout_add(self.REFRESH_INTERVAL, self.onTick)
+        else:
+            GLib.source_remove(self.timer)
+            self.timer = None
+            self.levels = None
+            self.queue_draw()
+
+    def onTick(self):
+        levels = self.player.levels()
+        if levels is not self.levels:  # 分析线程每次生成新的结果，没有新结果时不重画
+            self.levels = levels
+            self.queue_draw()
+        return True
+
+    def onDraw(self, widget: Widget, cr):
+        if self.levels is None:
+            return False
+        bands, rms, peak = self.levels
+        width = self.get_allocated_width()
+        height = self.get_allocated_height() - (self.LEVEL_HEIGHT + 1) * len(rms)
+        color = self.get_style_context().get_color(self.get_state_flags())
+
+        cr.set_source_rgba(color.red, color.green, color.blue, 0.7)
+        barWidth = width / len(bands)
+        for i, level in enumerate(bands):
+            barHeight = round(level * height)
+            cr.rectangle(round(i * barWidth), height - barHeight, max(1, round(barWidth) - 1), barHeight)
+        cr.fill()
+
+        # 每个声道一条RMS电平，峰值处画一个短竖线
+        cr.set_source_rgba(color.red, color.green, color.blue, 1.0)
+        for channel, (level, top) in enumerate(zip(rms, peak)):
+            y = height + 1 + channel * (self.LEVEL_HEIGHT + 1)
+            cr.rectangle(0, y, round(level * width), self.LEVEL_HEIGHT)
+            cr.rectangle(max(0, round(top * width) - 2), y, 2, self.LEVEL_HEIGHT)
+        cr.fill()
+        return False
+
+
+class LyricsView(Gtk.ScrolledWindow):
+    """歌词面板，每行一个Label，正在唱的行加粗并滚动到中间，只在歌词或者行变化时更新"""
+
+    def __init__(self):
+        super().__init__()
+        self.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        self.set_size_request(240, -1)
+        self.box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=4)
+        self.add(self.box)
+        self.lyrics = None
+        self.labels = list()
+        self.line = -1
+
+    def setLyrics(self, lyrics, line: int):
+        if lyrics is not self.lyrics or not self.labels:  # 第一次就是没有歌词时也要显示提示
+            self.lyrics = lyrics
+            self.line = -1
+            for label in self.labels:
+                label.destroy()
+            texts = lyrics.lines if lyrics is not None and lyrics.lines else ['没有歌词']
+            self.labels = [self.newLabel(text) for text in texts]
+            for label in self.labels:
+                self.box.pack_start(label, False, False, 0)
+            self.box.show_all()
+            self.get_vadjustment().set_value(0)
+        if line != self.line:
+            if 0 <= self.line < len(self.labels):
+                self.labels[self.line].set_text(self.lyrics.lines[self.line])
+            self.line = line
+            if 0 <= line < len(self.labels):
+                self.labels[line].set_markup(f'<b>{GLib.markup_escape_text(lyrics.lines[line])}</b>')
+                self.scrollTo(self.labels[line])
+
+    @staticmethod
+    def newLabel(text: str):
+        label = Gtk.Label(label=text)
+        label.set_line_wrap(True)
+        label.set_justify(Gtk.Justification.CENTER)
+        return label
+
+    def scrollTo(self, label: Gtk.Label):
+        allocation = label.get_allocation()
+        if allocation.height <= 1:  # 还没有分配位置，画出来之后再滚动
+            GLib.idle_add(self.scrollTo, label)
+            return False
+        adjustment = self.get_vadjustment()
+        adjustment.set_value(max(0, allocation.y + allocation.height / 2 - adjustment.get_page_size() / 2))
+        return False
+
+
+class SeekBar(Gtk.Box):
+    """底部的进度条和时间，有波形时画出波形。点击或者拖动跳到对应位置，滚轮以指针处为中心放大缩小。
+    每次只按像素列数从mmap的波形中取峰值，范围和大小不变时复用上次的路径；
+    只在播放并且显示在屏幕上时刷新，间隔为光标移动一个像素的时间"""
+
+    HEIGHT = 48
+    ZOOM = 2.0  # 滚轮每格放大缩小的倍数
+    MIN_SPAN = 2.0  # 最多放大到显示2秒
+    MIN_INTERVAL = 40  # 刷新间隔的范围，毫秒
+    MAX_INTERVAL = 1000
+
+    def __init__(self, model: Model):
+        super().__init__(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
+        self.model = model
+        self.player = model.player
+        self.waveform = None
+        self.path = None  # 缓存的(key, cairo路径)
+        self.music = None
+        self.span = None  # 放大后显示的秒数，None时显示整首
+        self.start = 0.0  # 放大后显示的起点
+        self.position = 0.0  # 上次刷新时的播放位置
+        self.dragging = None  # 拖动中指针处的秒数，松开时跳转
+        self.playing = False
+        self.mapped = False
+        self.timer = None
+        self.area = Gtk.DrawingArea()
+        self.area.set_size_request(-1, self.HEIGHT)
+        self.area.add_events(Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.BUTTON_RELEASE_MASK |
+                             Gdk.EventMask.BUTTON1_MOTION_MASK | Gdk.EventMask.SCROLL_MASK)
+        self.area.connect('draw', self.onDraw)
+        self.area.connect('button-press-event', self.onButtonPress)
+        self.area.connect('motion-notify-event', self.onMotion)
+        self.area.connect('button-release-event', self.onButtonRelease)
+        self.area.connect('scroll-event', self.onScroll)
+        self.area.connect('size-allocate', lambda *_: self.restartTimer())
+        self.label = Gtk.Label(label='0:00 / 0:00')
+        self.pack_start(self.area, True, True, 0)
+        self.pack_end(self.label, False, False, 0)
+        self.connect('map', self.onMap)
+        self.connect('unmap', self.onUnmap)
+
+    @staticmethod
+    def formatTime(seconds: float):
+        seconds = int(seconds)
+        if seconds >= 3600:
+            return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+        return f'{seconds // 60}:{seconds % 60:02d}'
+
+    def onMap(self, _):
+        self.mapped = True
+        self.restartTimer()
+
+    def onUnmap(self, _):
+        self.mapped = False
+        self.restartTimer()
+
+    def setWaveform(self, waveform):
+        self.waveform = waveform
+        self.path = None
+        self.area.queue_draw()
+
+    def setState(self, playState: Player.PlayState, music: ItemMusic):
+        if music is not self.music:  # 换歌后恢复显示整首
+            self.music = music
+            self.span = None
+            self.start = 0.0
+        self.playing = playState == Player.PlayState.playing
+        self.restartTimer()
+        self.refresh()
+
+    def visibleRange(self, duration: float):
+        if self.span is None or self.span >= duration:
+            return 0.0, duration
+        return self.start, self.start + self.span
+
+    def restartTimer(self):
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        if not (self.mapped and self.playing):
+            return
+        start, end = self.visibleRange(self.player.duration())
+        width = max(1, self.area.get_allocated_width())
+        interval = int((end - start) / width * 1000)
+        self.timer = GLib.timeout_add(max(self.MIN_INTERVAL, min(interval, self.MAX_INTERVAL)), self.onTick)
+
+    def onTick(self):
+        self.refresh()
+        return True
+
+    def refresh(self):
+        """更新时间，光标移动了至少一个像素时才重画；放大时播放到右边缘翻到下一页"""
+        duration = self.player.duration()
+        position = self.dragging if self.dragging is not None else self.player.position()
+        text = f'{self.formatTime(position)} / {self.formatTime(duration)}'
+        if self.label.get_text() != text:
+            self.label.set_text(text)
+        start, end = self.visibleRange(duration)
+        if self.span is not None and self.dragging is None and start <= self.position < end <= position:
+            self.start = min(position, duration - self.span)
+            start, end = self.visibleRange(duration)
+        width = self.area.get_allocated_width()
+        if end <= start or self.xAt(position, start, end, width) != self.xAt(self.position, start, end, width):
+            self.area.queue_draw()
+        self.position = position
+
+    @staticmethod
+    def xAt(seconds: float, start: float, end: float, width: int):
+        return int((seconds - start) / (end - start) * width) if end > start else -1
+
+    def timeAt(self, x: float):
+        duration = self.player.duration()
+        start, end = self.visibleRange(duration)
+        width = max(1, self.area.get_allocated_width())
+        return min(max(0.0, start + x / width * (end - start)), duration)
+
+    def waveformPath(self, cr, start: float, end: float, width: int, height: int):
+        """每个像素列一个从最小值到最大值的矩形"""
+        key = (self.waveform, start, end, width, height)
+        if self.path is not None and self.path[0] == key:
+            cr.append_path(self.path[1])
+            return
+        mins, maxs = self.waveform.columns(start, end, width)
+        scale = height / 2 / 127
+        tops = height / 2 - maxs * scale
+        heights = (maxs.astype(int) - mins) * scale
+        for x, (top, size) in enumerate(zip(tops.tolist(), heights.tolist())):
+            cr.rectangle(x, top, 1, max(1.0, size))
+        self.path = (key, cr.copy_path())
+
+    def onDraw(self, widget: Widget, cr):
+        width = widget.get_allocated_width()
+        height = widget.get_allocated_height()
+        color = widget.get_style_context().get_color(widget.get_state_flags())
+        duration = self.player.duration()
+        start, end = self.visibleRange(duration)
+        if self.waveform is not None and end > start:
+            self.waveformPath(cr, start, end, width, height)
+        else:  # 没有波形时是一条细的进度条
+            cr.rectangle(0, height / 2 - 2, width, 4)
+        path = cr.copy_path()
+        cr.new_path()
+
+        # 已播放的部分不透明，没有播放的部分淡一些
+        position = self.dragging if self.dragging is not None else self.player.position()
+        x = self.xAt(position, start, end, width)
+        cursor = min(max(0, x), width)
+        for left, right, alpha in ((0, cursor, 1.0), (cursor, width, 0.35)):
+            cr.save()
+            cr.rectangle(left, 0, right - left, height)
+            cr.clip()
+            cr.append_path(path)
+            cr.set_source_rgba(color.red, color.green, color.blue, alpha)
+            cr.fill()
+            cr.restore()
+        if end > start and 0 <= x <= width:
+            cr.set_source_rgba(color.red, color.green, color.blue, 1.0)
+            cr.rectangle(x - 1, 0, 2, height)
+            cr.fill()
+        if self.span is not None and end - start < duration:  # 放大时在底部标出显示的范围
+            cr.set_source_rgba(color.red, color.green, color.blue, 0.5)
+            cr.rectangle(start / duration * width, height - 2, max(2.0, (end - start) / duration * width), 2)
+            cr.fill()
+        return False
+
+    def onButtonPress(self, widget: Widget, event):
+        if event.button != 1 or self.player.duration() <= 0:
+            return False
+        self.dragging = self.timeAt(event.x)
+        self.refresh()
+        return True
+
+    def onMotion(self, widget: Widget, event):
+        if self.dragging is None:
+            return False
+        self.dragging = self.timeAt(event.x)
+        self.refresh()
+        return True
+
+    def onButtonRelease(self, widget: Widget, event):
+        if event.button != 1 or self.dragging is None:
+            return False
+        seconds, self.dragging = self.dragging, None
+        self.model.seek(seconds)
+        self.position = seconds
+        self.area.queue_draw()
+        return True
+
+    def onScroll(self, widget: Widget, event):
+        duration = self.player.duration()
+        if duration <= 0 or event.direction not in (Gdk.ScrollDirection.UP, Gdk.ScrollDirection.DOWN):
+            return False
+        start, end = self.visibleRange(duration)
+        ratio = event.x / max(1, widget.get_allocated_width())
+        anchor = start + ratio * (end - start)  # 指针处的时间放大缩小后不动
+        if event.direction == Gdk.ScrollDirection.UP:
+            span = max(self.MIN_SPAN, (end - start) / self.ZOOM)
+        else:
+            span = (end - start) * self.ZOOM
+        if span >= duration:
+            self.span = None
+            self.start = 0.0
+        else:
+            self.span = span
+            self.start = min(max(0.0, anchor - ratio * span), duration - span)
+        self.restartTimer()
+        self.area.queue_draw()
+        return True
+
+
+class MPythonG123Window(Gtk.Window):
+    """主窗口"""
+
+    def __init__(self, model: Model):
+        super().__init__(title="MPythonG123")
+
+        # VM对象
+        self.floatWindow = False
+        self.model = model
+
+        self.programName = 'MPythonG123 Player'
+
+        # liststore和filter
+        self.listBox = TrackListView()
+        self.listModel = TrackListModel(model.tracks)
+
+        # 一个VBOX
+        self.vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
+
+        # play button, 需要控制其状态
+        self.buttonPlay = None
+        self.buttonMode = None
+        self.icons = dict()  # 按钮当前的图标名
+        self.metricsPanel = None
+        self.shownMusic = -1  # 标题栏显示的歌曲id
+        self.buttonVolMinus = None
+        self.buttonVolPlus = None
+        self.meter = None
+        self.lyricsView = LyricsView()
+        self.seekBar = SeekBar(model)
+
+        # headbar
+        self.hb = None
+        self.searchEntry = None
+
+        # 窗口基础属性
+        self.set_border_width(10)
+        self.set_default_size(640, 480)
+        self.preSize = (640, 480)
+
+        # titlebar
+        self.customTitlebar()
+
+        # 主区域，显示歌曲文件列表，并显示歌词
+        self.mainArea()
+
+        # F12打开指标面板
+        self.connect('key-press-event', self.onKeyPress)
+        self.connect('window-state-event', self.onWindowState)
+
+        self.model.registerCallbacks(data=self.changedData, state=self.changedPlayState, mode=self.changedMode,
+                                     vol=self.changedVol, meta=self.changedMeta, remove=self.changedRemoved,
+                                     lyrics=self.changedLyrics, waveform=self.changedWaveform)
+        self.changedVol(self.model.settings.getSetting(self.model.settings.keyVol))
+        self.model.showWaveform(True)
+
+    def customTitlebar(self):
+        # 自定义titlebar
+        self.hb = Gtk.HeaderBar()
+        self.hb.set_show_close_button(True)
+        self.hb.props.title = self.programName
+
+        # 左侧的操控按钮
+        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        Gtk.StyleContext.add_class(box.get_style_context(), "linked")
+
+        # 左侧的关于按钮
+        button = Gtk.Button.new_from_icon_name("help-about-symbolic", Gtk.IconSize.BUTTON)
+        box.add(button)
+        button.connect("clicked", self.onClickAbout)
+
+        # 打开目录
+        button = Gtk.Button.new_from_icon_name("folder-open-symbolic", Gtk.IconSize.BUTTON)
+        box.add(button)
+        button.connect("clicked", self.onClickOpen)
+
+        # 播放模式按钮
+        self.buttonMode = Gtk.Button.new_from_icon_name("go-jump-symbolic", Gtk.IconSize.BUTTON)
+        box.add(self.buttonMode)
+        self.buttonMode.connect("clicked", self.onClickMode)
+
+        # 悬浮模式按钮
+        buttonFloat = Gtk.Button.new_from_icon_name("orientation-landscape-symbolic", Gtk.IconSize.BUTTON)
+        box.add(buttonFloat)
+        buttonFloat.connect("clicked", self.onClickFloat)
+
+        # 音量加减
+        self.buttonVolMinus = Gtk.Button.new_with_label('-')
+        box.add(self.buttonVolMinus)
+        self.buttonVolMinus.connect("clicked", self.onClickVolMinus)
+
+        self.buttonVolPlus = Gtk.Button.new_with_label('+')
+        box.add(self.buttonVolPlus)
+        self.buttonVolPlus.connect("clicked", self.onClickVolPlus)
+
+        # 加入headbar
+        self.hb.pack_start(box)
+
+        # 频谱和电平表，需要numpy
+        if SpectrumAnalyzer.available():
+            self.meter = SpectrumMeter(self.model.player)
+            self.hb.pack_start(self.meter)
+
+        # 右侧的操控按钮
+        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        Gtk.StyleContext.add_class(box.get_style_context(), "linked")
+
+        # 上一首按钮
+        button = Gtk.Button.new_from_icon_name("media-seek-backward-symbolic", Gtk.IconSize.BUTTON)
+        box.add(button)
+        button.connect("clicked", self.onClickPrev)
+
+        # 下一首按钮
+        button = Gtk.Button.new_from_icon_name("media-seek-forward-symbolic", Gtk.IconSize.BUTTON)
+        box.add(button)
+        button.connect("clicked", self.onClickNext)
+
+        # 播放按钮
+        self.buttonPlay = Gtk.Button.new_from_icon_name("media-playback-start-symbolic", Gtk.IconSize.BUTTON)
+        self.buttonPlay.connect('clicked', self.onClickPlayPause)
+        box.add(self.buttonPlay)
+
+        # 歌词按钮
+        button = Gtk.ToggleButton()
+        button.set_image(Gtk.Image.new_from_icon_name("format-justify-fill-symbolic", Gtk.IconSize.BUTTON))
+        button.connect("toggled", self.onToggleLyrics)
+        box.add(button)
+
+        # 加入headbar
+        self.hb.pack_end(box)
+
+        # 搜索框，每次输入都立即过滤
+        self.searchEntry = Gtk.SearchEntry()
+        self.searchEntry.set_width_chars(16)
+        self.searchEntry.set_placeholder_text('搜索')
+        self.searchEntry.set_tooltip_text('按文件名、歌名、歌手和专辑搜索，一两个字符只匹配词首，三个字符以上匹配任意位置')
+        self.searchEntry.connect('changed', self.onSearchChanged)
+        self.hb.pack_end(self.searchEntry)
+
+        # 设定自定义的titlebar
+        self.set_titlebar(self.hb)
+
+    def mainArea(self):
+        hbox1 = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
+        hbox2 = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
+        self.vbox.pack_start(hbox1, True, True, 0)
+        self.vbox.pack_end(hbox2, False, True, 0)
+
+        self.listBox.connect('row-activated', self.onRowActived)
+        self.listBox.connect('row-selected', self.onRowSelected)
+        self.listBox.bindModel(self.listModel)
+
+        buttonHolder = Gtk.Button.new_from_icon_name("folder-open-symbolic", Gtk.IconSize.LARGE_TOOLBAR)
+        buttonHolder.connect('clicked', self.onClickOpen)
+        self.listBox.setPlaceholder(buttonHolder)
+        self.listBox.set_vexpand(True)
+
+        hbox1.pack_start(self.listBox, True, True, 0)
+        hbox1.pack_end(self.lyricsView, False, True, 0)
+        self.lyricsView.set_no_show_all(True)  # 按下歌词按钮才显示
+        hbox2.pack_start(self.seekBar, True, True, 0)
+
+        self.add(self.vbox)
+
+    def onRowActived(self, view: TrackListView, index: int):
+        im = self.listModel.get_item(index)
+        self.model.play(im)
+
+    def onRowSelected(self, view: TrackListView, index: int):
+        im = self.listModel.get_item(index)
+        self.model.musicSelected = im
+
+    def dialogDir(self):
+        openD = Gtk.FileChooserDialog(title="请选择歌曲文件目录", parent=self)
+        openD.set_destroy_with_parent(True)
+        openD.set_action(Gtk.FileChooserAction.SELECT_FOLDER)
+        openD.set_select_multiple(True)
+        openD.add_button('打开', Gtk.ResponseType.OK)
+        openD.add_button('取消', Gtk.ResponseType.CANCEL)
+        return openD
+
+    def dialogAbout(self):
+        about = Gtk.AboutDialog(transient_for=self)
+        about.set_logo_icon_name('help-about-symbolic')
+        about.set_license_type(License.MIT_X11)
+        about.set_authors(['PTYX'])
+        about.set_program_name('Python Player based on MPG123')
+        about.set_website('https://github.com/ptyx092/mpythong123')
+        about.set_website_label('访问Github项目主页')
+        about.set_destroy_with_parent(True)
+        about.set_copyright("(c) PTYX/ptyx")
+        about.set_sensitive(True)
+        return about
+
+    def onClickOpen(self, widget: Widget):
+        openD = self.dialogDir()
+        response = openD.run()
+        if response == Gtk.ResponseType.OK:
+            dirs = openD.get_filenames()
+            openD.destroy()
+            self.model.updateDirs(dirs)
+            self.hb.props.title = self.programName
+        else:
+            openD.destroy()
+
+    def onClickAbout(self, widget: Widget):
+        about = self.dialogAbout()
+        response = about.run()
+        about.destroy()
+
+    def onClickPlayPause(self, widget: Widget):
+        self.model.togglePlay()
+
+    def onClickPrev(self, widget):
+        self.model.playPrevNext(False)
+
+    def onClickNext(self, widget):
+        self.model.playPrevNext(True)
+
+    def onKeyPress(self, widget, event):
+        if event.keyval in (Gdk.KEY_d, Gdk.KEY_D) and event.state & Gdk.ModifierType.CONTROL_MASK:
+            # Ctrl+D切换是否合并重复的歌曲
+            settings = self.model.settings
+            self.model.setCollapseDuplicates(not settings.getSetting(settings.keyCollapseDuplicates))
+            return True
+        if event.keyval != Gdk.KEY_F12:
+            return False
+        if self.metricsPanel is None:
+            self.metricsPanel = MetricsPanel(self, self.model.player)
+            self.metricsPanel.connect('destroy', self.onMetricsPanelClosed)
+        self.metricsPanel.present()
+        return True
+
+    def onWindowState(self, widget, event):
+        if self.meter is not None:
+            self.meter.setIconified(bool(event.new_window_state & Gdk.WindowState.ICONIFIED))
+        return False
+
+    def onMetricsPanelClosed(self, _):
+        self.metricsPanel = None
+
+    def onSearchChanged(self, entry: Gtk.SearchEntry):
+        self.model.setFilter(entry.get_text())
+
+    def onToggleLyrics(self, button: Gtk.ToggleButton):
+        show = button.get_active()
+        self.lyricsView.set_visible(show)  # 内容在setLyrics中显示
+        self.model.showLyrics(show)
+
+    def changedLyrics(self, lyrics, line: int):
+        if self.lyricsView.get_visible():
+            self.lyricsView.setLyrics(lyrics, line)
+
+    def changedWaveform(self, waveform):
+        self.seekBar.setWaveform(waveform)
+
+    def onClickMode(self, widget):
+        self.model.updateMode()
+
+    def onClickFloat(self, _):
+        if self.floatWindow:
+            self.set_keep_above(False)
+            self.vbox.show()
+            self.set_resizable(True)
+            self.resize(self.preSize[0], self.preSize[1])
+            self.floatWindow = False
+        else:
+            self.preSize = self.get_size()
+            self.set_keep_above(True)
+            self.vbox.hide()
+            rect = self.get_titlebar().get_allocated_size().allocation
+            # print(dir(rect))
+            # print(f'title_bar: {rect.x, rect.y, rect.width, rect.height}')
+            # self.set_modal(True)
+            self.set_size_request(rect.width, 1)
+            self.resize(rect.width, 1)
+            self.set_resizable(False)
+            self.floatWindow = True
+
+    def changedMode(self, newMode):
+        if newMode == PlayMode.sequence:
+            icon = 'media-playlist-consecutive-symbolic'
+        elif newMode == PlayMode.singleLoop:
+            icon = 'media-playlist-repeat-song-symbolic'
+        elif newMode == PlayMode.loop:
+            icon = 'media-playlist-repeat-symbolic'
+        elif newMode == PlayMode.random:
+            icon = 'media-playlist-shuffle-symbolic'
+
+        self.setButtonIcon(self.buttonMode, icon)
+
+    def setButtonIcon(self, button: Gtk.Button, iconName: str):
+        """图标没变时不重新创建Gtk.Image"""
+        if self.icons.get(button) == iconName:
+            return
+        self.icons[button] = iconName
+        icon = Gio.ThemedIcon(name=iconName)
+        image = Gtk.Image.new_from_gicon(icon, Gtk.IconSize.BUTTON)
+        button.set_image(image=image)
+
+    def changedPlayState(self, playState: Player.PlayState, music: ItemMusic):
+        if playState == Player.PlayState.playing:
+            icon_name = 'media-playback-pause-symbolic'
+            if music is not None and music.index != self.shownMusic:  # 换了歌才选中，不打断用户的选择
+                self.shownMusic = music.index
+                self.hb.props.title = music.name
+                self.listBox.selectRow(self.listModel.rowOf(music.index))
+            elif music is not None and self.hb.props.title != music.name:  # 标签更新了
+                self.hb.props.title = music.name
+        elif playState == Player.PlayState.pause:
+            icon_name = 'media-playback-start-symbolic'
+        elif playState == Player.PlayState.stop:
+            icon_name = 'media-playback-start-symbolic'
+            self.shownMusic = -1
+            self.hb.props.title = self.programName
+
+        self.setButtonIcon(self.buttonPlay, icon_name)
+        self.seekBar.setState(playState, music)
+        if self.meter is not None:
+            self.meter.setPlaying(playState == Player.PlayState.playing)
+
+    def changedData(self, files, mode: PlayMode, append=False):
+        if self.listModel is not None:
+            # 一次splice只触发一次items-changed
+            size = self.listModel.get_n_items()
+            if append:
+                self.listModel.splice(size, 0, files)
+            else:
+                self.listModel.splice(0, size, files)
+
+            if (not append or size == 0) and self.listModel.get_n_items() > 0:
+                self.listBox.selectRow(0)
+
+        self.changedMode(mode)
+        self.updateSubtitle()
+
+    def updateSubtitle(self):
+        """合并了重复的歌曲时在标题栏中显示隐藏的数量，隐藏的歌曲变了时列表整体更新，会调用到这里"""
+        hidden = len(self.model.collapsed)
+        self.hb.props.subtitle = f'已隐藏{hidden}首重复的歌曲' if hidden else None
+
+    def changedMeta(self, ids: list):
+        self.listBox.refresh()
+
+    def changedRemoved(self, ids: list):
+        """ids升序，相邻的行合并成一次splice，从后往前删除行号不会变"""
+        rows = [row for row in map(self.listModel.rowOf, ids) if row >= 0]
+        end = len(rows)
+        while end > 0:
+            start = end - 1
+            while start > 0 and rows[start - 1] == rows[start] - 1:
+                start -= 1
+            self.listModel.splice(rows[start], end - start, [])
+            end = start
+
+    def onClickVolMinus(self, widget):
+        self.model.adjustVol(False)
+
+    def onClickVolPlus(self, widget):
+        self.model.adjustVol(True)
+
+    def changedVol(self, newVol: int):
+        tooltip = f'音量 {newVol}%'
+        self.buttonVolMinus.set_tooltip_text(tooltip)
+        self.buttonVolPlus.set_tooltip_text(tooltip)
+        self.buttonVolMinus.set_sensitive(newVol > 0)
+        self.buttonVolPlus.set_sensitive(newVol < 100)
+
+
+class MetricsPanel(Gtk.Window):
+    """调试用的指标面板，打开时启用metrics，每秒刷新一次"""
+
+    REFRESH_INTERVAL = 1000  # 毫秒
+
+    def __init__(self, parent: Gtk.Window, player: Player):
+        super().__init__(title='MPythonG123 指标', transient_for=parent)
+        self.set_default_size(560, 360)
+        self.player = player
+        metrics.enable()
+
+        self.textView = Gtk.TextView()
+        self.textView.set_editable(False)
+        self.textView.set_monospace(True)
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.add(self.textView)
+        self.add(scrolled)
+
+        self.timer = GLib.timeout_add(self.REFRESH_INTERVAL, self.refresh)
+        self.connect('destroy', self.onDestroy)
+        self.refresh()
+        self.show_all()
+
+    def refresh(self):
+        lines = [metrics.toText() or '还没有数据', '', '最近打开的文件：']
+        for stats in self.player.readStats():
+            lines.append(f"{'网络' if stats['network'] else '本地'} 平均{stats['meanRead'] * 1000:.2f}ms "
+                         f"最长{stats['maxRead'] * 1000:.1f}ms 等待{stats['stalls']}次/{stats['stallTime']:.2f}s "
+                         f"{os.path.basename(stats['path'])}")
+        self.textView.get_buffer().set_text('\n'.join(lines))
+        return True
+
+    def onDestroy(self, _):
+        GLib.source_remove(self.timer)
+
+
+def runGui():
+    model = Model(GLib.idle_add, LibraryWatcher,
+                  later=lambda seconds, func: GLib.timeout_add(int(seconds * 1000), func))
+    view = MPythonG123Window(model)
+    startupTrace.mark('build window')
+
+    view.connect("destroy", Gtk.main_quit)
+    view.show_all()
+    startupTrace.mark('show window')
+
+    # 曲库从后台分批送回，第一批到达之前窗口就可以先画出来
+    model.loadMusicData()
+    startupTrace.mark('start loading')
+
+    if startupTrace.started is not None:
+        def onDraw(widget, _):
+            # 列表中有了歌曲（或者曲库为空扫描已经结束）之后画出的第一帧
+            if len(model.tracks) > 0 or model.scanner.job is None:
+                widget.disconnect(handler)
+                startupTrace.report('first frame')
+        handler = view.connect_after('draw', onDraw)
+
+    Gtk.main()
+    model.close()
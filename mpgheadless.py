@@ -0,0 +1,289 @@
+import asyncio
+import json
+import os
+import signal
+import traceback
+from mpgcore import Model, PlayMode, configDir, startupTrace
+
+
+def defaultSocket():
+    """$XDG_RUNTIME_DIR/mpythong123.sock，没有XDG_RUNTIME_DIR时放在配置目录中"""
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    return os.path.join(runtime, 'mpythong123.sock') if runtime else os.path.join(configDir(), 'control.sock')
+
+
+class CommandError(Exception):
+    pass
+
+
+class ControlServer:
+    """无界面模式的控制接口：Unix socket上每行一个JSON命令，例如{"cmd": "play", "id": 3}。
+    每个命令回复一行{"ok": true, ...}或者{"ok": false, "error": "..."}，命令中的req原样带回；
+    发送过subscribe的连接还会收到{"event": "state", ...}这样的状态变化"""
+
+    SEARCH_LIMIT = 50
+
+    def __init__(self, model: Model, path: str):
+        self.model = model
+        self.path = path
+        self.server = None
+        self.subscribers = set()
+        self.commands = {
+            'play': self.cmdPlay,
+            'pause': self.cmdPause,
+            'stop': self.cmdStop,
+            'next': self.cmdNext,
+            'prev': self.cmdPrev,
+            'seek': self.cmdSeek,
+            'queue': self.cmdQueue,
+            'status': self.cmdStatus,
+            'search': self.cmdSearch,
+            'volume': self.cmdVolume,
+            'subscribe': self.cmdSubscribe,
+            'io': self.cmdIo,
+            'lyrics': self.cmdLyrics,
+            'duplicates': self.cmdDuplicates,
+        }
+        model.registerCallbacks(data=self.onData, state=self.onState, mode=self.onMode, vol=self.onVol,
+                                lyrics=self.onLyrics)
+
+    async def start(self):
+        if os.path.dirname(self.path):  # 例如--socket ctl.sock时在当前目录中
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):  # 上次没有正常退出留下的
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.onClient, self.path)
+        os.chmod(self.path, 0o600)
+        print(f'listening on {self.path}')
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.subscribers):
+            writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def onClient(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                self.send(writer, self.handle(line, writer))
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as error:
+            print(f'control connection closed, error: {error}')
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    def handle(self, line: bytes, writer):
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            return {'ok': False, 'error': f'invalid json: {error}'}
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'request must be an object'}
+        command = self.commands.get(request.get('cmd'))
+        if command is None:
+            reply = {'ok': False, 'error': f'unknown command {request.get("cmd")!r}'}
+        else:
+            try:
+                reply = {'ok': True}
+                reply.update(command(request, writer) or {})
+            except CommandError as error:
+                reply = {'ok': False, 'error': str(error)}
+            except Exception as error:  # 命令执行出错也要回复，不能断开连接
+                print(f'command {request.get("cmd")} failed, error: {error!r}')
+                traceback.print_exc()
+                reply = {'ok': False, 'error': f'{type(error).__name__}: {error}'}
+        if 'req' in request:
+            reply['req'] = request['req']
+        return reply
+
+    @staticmethod
+    def send(writer, message: dict):
+        writer.write(json.dumps(message, ensure_ascii=False).encode() + b'\n')
+
+    def broadcast(self, message: dict):
+        for writer in list(self.subscribers):
+            if writer.is_closing():
+                self.subscribers.discard(writer)
+            else:
+                self.send(writer, message)
+
+    def track(self, request: dict):
+        """命令中用id或者path指定的歌曲，都没有时返回-1"""
+        tracks = self.model.tracks
+        if 'id' in request:
+            index = request['id']
+            if not isinstance(index, int) or index < 0 or index >= len(tracks) or index in tracks.removed:
+                raise CommandError(f'no track with id {index!r}')
+            return index
+        if 'path' in request:
+            index = tracks.find([str(request['path'])]).get(str(request['path']))
+            if index is None:
+                raise CommandError(f'no track with path {request["path"]!r}')
+            return index
+        return -1
+
+    @staticmethod
+    def describe(music):
+        if music is None:
+            return None
+        return {'id': music.index, 'name': music.name, 'path': music.path}
+
+    def status(self):
+        model = self.model
+        player = model.player
+        return {
+            'state': player.state.name,
+            'current': self.describe(model.musicCurrent),
+            'next': self.describe(model.musicNext),
+            'position': round(player.position(), 3),
+            'duration': round(player.duration(), 3),
+            'mode': model.settings.getSetting(model.settings.keyMode).name,
+            'volume': model.settings.getSetting(model.settings.keyVol),
+            'tracks': len(model.view),
+            'queue': list(model.queue),
+        }
+
+    def cmdPlay(self, request: dict, writer):
+        model = self.model
+        index = self.track(request)
+        if index >= 0:
+            music = model.tracks.item(index)
+        elif model.player.state == model.player.PlayState.pause:
+            model.pause()  # 暂停时再调用一次为继续
+            return self.status()
+        elif model.player.state != model.player.PlayState.stop:
+            return self.status()
+        elif model.musicCurrent is not None:
+            music = model.musicCurrent
+        elif model.view:
+            music = model.tracks.item(model.view[0])
+        else:
+            raise CommandError('library is empty')
+        if not model.play(music):
+            raise CommandError(f'cannot play {music.path!r}')
+        return self.status()
+
+    def cmdPause(self, request: dict, writer):
+        if self.model.player.state == self.model.player.PlayState.playing:
+            self.model.pause()
+        return self.status()
+
+    def cmdStop(self, request: dict, writer):
+        self.model.stop()
+        return self.status()
+
+    def cmdNext(self, request: dict, writer):
+        self.model.playPrevNext(True)
+        return self.status()
+
+    def cmdPrev(self, request: dict, writer):
+        self.model.playPrevNext(False)
+        return self.status()
+
+    def cmdSeek(self, request: dict, writer):
+        seconds = request.get('seconds')
+        if not isinstance(seconds, (int, float)):
+            raise CommandError('seek needs seconds')
+        self.model.seek(seconds)
+        return {'position': round(seconds, 3)}
+
+    def cmdQueue(self, request: dict, writer):
+        index = self.track(request)
+        if index < 0:  # 没有指定歌曲时只返回队列
+            return {'queue': list(self.model.queue)}
+        return {'position': self.model.enqueue(index), 'queue': list(self.model.queue)}
+
+    def cmdStatus(self, request: dict, writer):
+        return self.status()
+
+    def cmdSearch(self, request: dict, writer):
+        model = self.model
+        model.setFilter(str(request.get('query', '')))
+        model.finishSearch()  # 界面中结果分批追加，这里一次返回完整的结果
+        limit = request.get('limit', self.SEARCH_LIMIT)
+        if not isinstance(limit, int) or limit < 0:
+            raise CommandError('limit must be a non-negative integer')
+        return {'count': len(model.view),
+                'tracks': [self.describe(model.tracks.item(index)) for index in model.view[:limit]]}
+
+    def cmdVolume(self, request: dict, writer):
+        if 'up' in request:
+            self.model.adjustVol(bool(request['up']))
+        return {'volume': self.model.settings.getSetting(self.model.settings.keyVol)}
+
+    def cmdSubscribe(self, request: dict, writer):
+        self.subscribers.add(writer)
+
+    def cmdIo(self, request: dict, writer):
+        return {'files': self.model.player.readStats()}
+
+    def cmdLyrics(self, request: dict, writer):
+        """show为true时开始跟随当前歌曲的歌词，订阅的连接会收到每一行的变化；歌词还在加载时lines为null"""
+        if 'show' in request:
+            self.model.showLyrics(bool(request['show']))
+        lyrics = self.model.lyricsCurrent
+        if not self.model.lyricsShown or lyrics is None:
+            return {'lines': None, 'line': -1}
+        return {'lines': lyrics.lines, 'times': list(lyrics.times) if lyrics.synced else None,
+                'line': lyrics.lineAt(self.model.player.position())}
+
+    def cmdDuplicates(self, request: dict, writer):
+        """collapse设置是否从列表和随机播放中隐藏重复的歌曲；check为true时在后台重新检查，
+        还没有检查过或者正在检查时groups为null"""
+        model = self.model
+        if 'collapse' in request:
+            model.setCollapseDuplicates(bool(request['collapse']))
+        if request.get('check'):
+            model.requestDuplicates(force=True)
+        groups = None
+        if model.duplicateGroups is not None and not model.duplicates.busy():
+            groups = [[self.describe(model.tracks.item(index)) for index in group] for group in model.duplicateGroups]
+        return {'collapse': model.settings.getSetting(model.settings.keyCollapseDuplicates), 'groups': groups,
+                'hidden': len(model.collapsed)}
+
+    def onData(self, ids, mode: PlayMode, append=False):
+        pass
+
+    def onState(self, state, music):
+        self.broadcast({'event': 'state', 'state': state.name, 'current': self.describe(music)})
+
+    def onMode(self, mode: PlayMode):
+        self.broadcast({'event': 'mode', 'mode': mode.name})
+
+    def onVol(self, vol: int):
+        self.broadcast({'event': 'volume', 'volume': vol})
+
+    def onLyrics(self, lyrics, line: int):
+        text = lyrics.lines[line] if lyrics is not None and line >= 0 else None
+        self.broadcast({'event': 'lyrics', 'line': line, 'text': text})
+
+
+async def serve(socketPath: str):
+    loop = asyncio.get_running_loop()
+    model = Model(loop.call_soon_threadsafe, later=loop.call_later)
+    server = ControlServer(model, socketPath)
+    await server.start()
+    model.loadMusicData()
+    startupTrace.report('listening')
+
+    stopped = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    await stopped.wait()
+
+    model.close()
+    await server.close()
+    return 0
+
+
+def runHeadless(socketPath=None):
+    return asyncio.run(serve(socketPath or defaultSocket()))
@@ -0,0 +1,40 @@
+import os
+import pytest
+from mpgbench import MainLoop, SyntheticBackend
+
+
+class MissingFileBackend(SyntheticBackend):
+    """和mpg123一样，文件不存在时打开失败"""
+
+    def openStream(self, filePath: str):
+        if not os.path.exists(filePath):
+            raise FileNotFoundError(2, 'No such file or directory', filePath)
+        return super().openStream(filePath)
+
+
+@pytest.fixture(autouse=True)
+def home(tmp_path, monkeypatch):
+    """配置、曲库目录和缓存都放在临时目录中"""
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmp_path / 'config'))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    return tmp_path
+
+
+@pytest.fixture
+def backend():
+    return MissingFileBackend()
+
+
+@pytest.fixture
+def loop():
+    return MainLoop()
+
+
+@pytest.fixture
+def library(tmp_path):
+    """三首只有几个字节的歌曲"""
+    root = tmp_path / 'music'
+    root.mkdir()
+    for name in ('a', 'b', 'c'):
+        (root / f'{name}.mp3').write_bytes(b'ID3')
+    return root
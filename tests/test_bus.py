@@ -0,0 +1,31 @@
+from mpgcore import NotifyBus, ViewEvent
+
+
+def test_failing_call_does_not_block_later_events(loop):
+    bus = NotifyBus(loop.schedule)
+    states = list()
+    calls = list()
+    bus.connect(ViewEvent.state, lambda state, music: states.append(state))
+
+    def fail():
+        raise FileNotFoundError(2, 'No such file or directory', 'gone.mp3')
+
+    bus.call(fail)
+    bus.call(calls.append, 'after')
+    bus.post(ViewEvent.state, 'first', None)
+    assert loop.runUntil(lambda: not bus.pending, 5)
+    assert calls == ['after'] and states == ['first']  # 同一次分发中出错之后的调用和事件照常执行
+
+    bus.post(ViewEvent.state, 'second', None)
+    assert loop.runUntil(lambda: states == ['first', 'second'], 5)
+
+
+def test_failing_handler_does_not_drop_other_events(loop):
+    bus = NotifyBus(loop.schedule)
+    volumes = list()
+    bus.connect(ViewEvent.state, lambda state, music: 1 / 0)
+    bus.connect(ViewEvent.vol, volumes.append)
+    bus.post(ViewEvent.state, 'playing', None)
+    bus.post(ViewEvent.vol, 50)
+    assert loop.runUntil(lambda: volumes == [50], 5)
+    assert not bus.pending
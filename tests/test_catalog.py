@@ -0,0 +1,41 @@
+import sqlite3
+from mpgcore import MusicCatalog
+
+
+def oldCatalog(path, version: int):
+    """第3版结构的曲库目录：还没有标签的列，已经有帧偏移表，版本号记为version"""
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE dirs (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL, subdirs TEXT NOT NULL)')
+    db.execute('CREATE TABLE tracks (path TEXT PRIMARY KEY, dir TEXT NOT NULL, name TEXT NOT NULL, '
+               'size INTEGER NOT NULL, mtime INTEGER NOT NULL, duration REAL, frames INTEGER)')
+    db.execute('CREATE TABLE seekindex (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, '
+               'rate INTEGER NOT NULL, samples INTEGER NOT NULL, step INTEGER NOT NULL, offsets BLOB NOT NULL)')
+    db.execute("INSERT INTO dirs VALUES ('/music', 1, '')")
+    db.execute("INSERT INTO tracks VALUES ('/music/a.mp3', '/music', 'a', 10, 1, 3.5, 100)")
+    db.execute("INSERT INTO seekindex VALUES ('/music/a.mp3', 10, 1, 44100, 154350, 1152, x'00')")
+    db.execute(f'PRAGMA user_version={version}')
+    db.commit()
+    db.close()
+
+
+def test_upgrade_keeps_computed_tables(tmp_path):
+    path = str(tmp_path / 'library.db')
+    oldCatalog(path, 3)
+    catalog = MusicCatalog(path)
+    assert catalog.db.execute('PRAGMA user_version').fetchone()[0] == MusicCatalog.SCHEMA_VERSION
+    assert catalog.db.execute('SELECT COUNT(*) FROM seekindex').fetchone()[0] == 1
+    assert catalog.db.execute('SELECT dir, name, duration, title, tagged, rgTrackGain FROM tracks').fetchall() == \
+        [('/music', 'a', 3.5, None, 0, None)]  # 新增的列等重新解析标签
+    assert catalog.tracksInDir('/music') == [('/music', 'a', 3.5, None, None, None, 0)]
+    catalog.storeLoudness([('/music/a.mp3', 10, 1, -20.0, 0.9)])
+
+    catalog = MusicCatalog(path)  # 版本相同时什么都不改
+    assert catalog.db.execute('SELECT COUNT(*) FROM loudness').fetchone()[0] == 1
+
+
+def test_newer_version_rebuilds(tmp_path):
+    path = str(tmp_path / 'library.db')
+    oldCatalog(path, MusicCatalog.SCHEMA_VERSION + 1)
+    catalog = MusicCatalog(path)
+    assert catalog.db.execute('SELECT COUNT(*) FROM seekindex').fetchone()[0] == 0
+    assert catalog.db.execute('SELECT COUNT(*) FROM tracks').fetchone()[0] == 0
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from mpgcore import PcmDsp, ENC_FLOAT_32, ENC_SIGNED_16, ENC_SIGNED_32
+
+pytestmark = pytest.mark.filterwarnings('error')  # 转换溢出时numpy只给出RuntimeWarning
+
+
+def process(dsp, samples):
+    data = bytearray(samples.tobytes())
+    encoding = {np.int16: ENC_SIGNED_16, np.int32: ENC_SIGNED_32, np.float32: ENC_FLOAT_32}[samples.dtype.type]
+    dsp.process(memoryview(data), len(data), encoding)
+    return np.frombuffer(data, samples.dtype)
+
+
+@pytest.mark.parametrize('dtype, low, high', [(np.int16, -2 ** 15, 2 ** 15 - 1), (np.int32, -2 ** 31, 2 ** 31 - 1),
+                                              (np.float32, -1.0, 1.0)])
+def test_limiter_keeps_full_scale_sign(dtype, low, high):
+    dsp = PcmDsp(1024)
+    dsp.setVolume(2.0)
+    small = 5 if dtype is not np.float32 else 0.001
+    out = process(dsp, np.array([high, low, small], dtype))
+    assert 0.98 * high <= out[0] <= high
+    assert low <= out[1] <= 0.98 * low
+    assert out[2] == pytest.approx(2 * small, rel=1e-3)
+    assert dsp.limited == 1
+
+
+@pytest.mark.parametrize('dtype', [np.int16, np.int32, np.float32])
+def test_unity_gain_untouched(dtype):
+    dsp = PcmDsp(1024)
+    samples = np.array([1, -1, 0], dtype)
+    assert process(dsp, samples).tolist() == samples.tolist()
+
+
+def test_limiter_below_threshold_is_linear():
+    dsp = PcmDsp(1024)
+    dsp.setVolume(1.5)
+    out = process(dsp, np.array([10000, -10000], np.int16))
+    assert out.tolist() == [15000, -15000]
+    assert dsp.limited == 0
@@ -0,0 +1,50 @@
+import io
+from mpgcore import audioExtent, hashAudio
+
+
+def frames(count: int, fill: int):
+    """MPEG1 Layer III 128kbps 44.1kHz，每帧417字节"""
+    frame = b'\xff\xfb\x90\x00' + bytes([fill]) * 413
+    return frame * count
+
+
+def id3v2(text: bytes):
+    body = b'TIT2' + (len(text) + 1).to_bytes(4, 'big') + b'\x00\x00\x00' + text
+    return b'ID3\x03\x00\x00' + bytes((0, 0, len(body) >> 7, len(body) & 0x7F)) + body
+
+
+def ape(items: bytes, header=True):
+    def block(flags):
+        return b'APETAGEX' + (2000).to_bytes(4, 'little') + (len(items) + 32).to_bytes(4, 'little') + \
+            (1).to_bytes(4, 'little') + flags.to_bytes(4, 'little') + bytes(8)
+    return (block(0xA0000000) if header else b'') + items + block(0x80000000 if header else 0)
+
+
+def id3v1(title: bytes):
+    return b'TAG' + title.ljust(30, b'\x00') + bytes(95)
+
+
+def test_extent_strips_all_tags():
+    audio = frames(4, 1)
+    data = id3v2(b'Song') + b'\x00' * 100 + audio + ape(b'item data', header=True) + id3v1(b'Song')
+    start, end = audioExtent(io.BytesIO(data), len(data))
+    assert data[start:end] == audio
+    data = audio + ape(b'x' * 40, header=False)
+    assert audioExtent(io.BytesIO(data), len(data)) == (0, len(audio))
+
+
+def test_extent_without_audio():
+    data = id3v2(b'Song')
+    start, end = audioExtent(io.BytesIO(data), len(data))
+    assert start == end
+
+
+def test_same_audio_different_tags(tmp_path):
+    audio = frames(6, 2)
+    a, b, c, d = (tmp_path / name for name in ('a.mp3', 'b.mp3', 'c.mp3', 'd.mp3'))
+    a.write_bytes(id3v2(b'One') + audio)
+    b.write_bytes(id3v2(b'Another title') + audio + ape(b'rg') + id3v1(b'Another'))
+    c.write_bytes(id3v2(b'One') + frames(6, 3))
+    d.write_bytes(id3v2(b'Only tags'))
+    hashes = [hashAudio(str(path))[3] for path in (a, b, c, d)]
+    assert hashes[0] == hashes[1] and hashes[0] != hashes[2] and hashes[3] is None
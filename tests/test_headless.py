@@ -0,0 +1,43 @@
+import asyncio
+import json
+from mpgcore import Model
+from mpgheadless import ControlServer
+
+
+def command(server, **request):
+    return server.handle(json.dumps(request).encode(), None)
+
+
+def test_errors_are_replied(loop, library, backend, tmp_path):
+    model = Model(loop.schedule, later=loop.later, backend=backend)
+    model.settings.updateSetting(model.settings.keyDirs, [str(library)])
+    server = ControlServer(model, str(tmp_path / 'ctl.sock'))
+    model.loadMusicData()
+    assert loop.runUntil(lambda: len(model.view) == 3, 10)
+
+    (library / 'b.mp3').unlink()
+    reply = command(server, cmd='play', path=str(library / 'b.mp3'), req=7)
+    assert reply['ok'] is False and 'b.mp3' in reply['error'] and reply['req'] == 7
+
+    def broken(request, writer):
+        raise ValueError('boom')
+    server.commands['broken'] = broken
+    assert command(server, cmd='broken') == {'ok': False, 'error': 'ValueError: boom'}
+
+    reply = command(server, cmd='play', path=str(library / 'a.mp3'))
+    assert reply['ok'] is True and reply['current']['path'] == str(library / 'a.mp3')
+    model.close()
+
+
+def test_relative_socket_path(loop, backend, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    model = Model(loop.schedule, later=loop.later, backend=backend)
+    server = ControlServer(model, 'ctl.sock')
+
+    async def startAndClose():
+        await server.start()
+        assert (tmp_path / 'ctl.sock').exists()
+        await server.close()
+    asyncio.run(startAndClose())
+    assert not (tmp_path / 'ctl.sock').exists()
+    model.close()
@@ -0,0 +1,48 @@
+import pytest
+from mpgcore import Lyrics, loadLyrics
+
+
+def test_parse_lrc_multiple_stamps_and_info():
+    lyrics = Lyrics.parseLrc('[ar:歌手]\n[ti:歌名]\n[00:12.50][01:02.00]副歌\n[00:01.00]第一行\n\n[00:05:20]冒号的百分秒')
+    assert list(lyrics.times) == [1.0, 5.2, 12.5, 62.0]
+    assert lyrics.lines == ['第一行', '冒号的百分秒', '副歌', '副歌']
+    assert lyrics.synced
+
+
+@pytest.mark.parametrize('offset, first', [('+500', 0.5), ('-500', 1.5), ('2000', 0.0)])
+def test_parse_lrc_offset(offset, first):
+    """offset为毫秒，正数表示歌词提前，提前到开头之前的从0秒开始"""
+    lyrics = Lyrics.parseLrc(f'[offset:{offset}]\n[00:01.00]一\n[00:03.00]二')
+    assert lyrics.times[0] == pytest.approx(first)
+    assert lyrics.times[1] == pytest.approx(3.0 - int(offset) / 1000)
+
+
+def test_parse_lrc_unsynced_and_empty():
+    lyrics = Lyrics.parseLrc('[ar:歌手]\n第一行\n第二行')
+    assert not lyrics.synced and lyrics.lines == ['第一行', '第二行']
+    assert lyrics.lineAt(10.0) == -1 and lyrics.nextChange(0) is None
+    assert Lyrics.parseLrc('[ar:歌手]\n\n') is None
+
+
+def test_line_at_and_next_change():
+    lyrics = Lyrics.parseLrc('[00:01.00]一\n[00:03.00]二\n[00:05.00]三')
+    assert [lyrics.lineAt(t) for t in (0.5, 1.0, 2.9, 3.0, 99.0)] == [-1, 0, 0, 1, 2]
+    assert lyrics.nextChange(-1) == 1.0 and lyrics.nextChange(1) == 5.0 and lyrics.nextChange(2) is None
+
+
+def test_lrc_file_before_embedded(tmp_path):
+    song = tmp_path / 'a.mp3'
+    song.write_bytes(b'ID3')
+    assert loadLyrics(str(song)) is None
+    (tmp_path / 'a.lrc').write_bytes('[00:02.00]你好'.encode('gb18030'))  # 没有声明编码的GB18030
+    lyrics = loadLyrics(str(song))
+    assert lyrics.lines == ['你好'] and list(lyrics.times) == [2.0]
+
+
+def test_embedded_sylt(tmp_path):
+    body = b'\x03eng\x02\x01' + b'\x00' + b'two\x00' + (3000).to_bytes(4, 'big') + b'one\x00' + (1000).to_bytes(4, 'big')
+    frame = b'SYLT' + len(body).to_bytes(4, 'big') + b'\x00\x00' + body
+    song = tmp_path / 'a.mp3'
+    song.write_bytes(b'ID3\x03\x00\x00' + bytes((0, 0, len(frame) >> 7, len(frame) & 0x7F)) + frame)
+    lyrics = loadLyrics(str(song))
+    assert lyrics.lines == ['one', 'two'] and list(lyrics.times) == [1.0, 3.0]
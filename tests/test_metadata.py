@@ -0,0 +1,65 @@
+from mpgcore import readMetadata, readMetadataBatch
+
+
+def syncsafe(value: int):
+    return bytes((value >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+
+def id3Frame(frameId: bytes, text: str):
+    body = b'\x03' + text.encode()  # UTF-8
+    return frameId + len(body).to_bytes(4, 'big') + b'\x00\x00' + body
+
+
+def mpegFrame(xing=b''):
+    """MPEG1 Layer III 128kbps 44.1kHz立体声，每帧417字节，Xing头在帧头之后32字节"""
+    frame = bytearray(417)
+    frame[:4] = b'\xff\xfb\x90\x00'
+    frame[36:36 + len(xing)] = xing
+    return bytes(frame)
+
+
+def lameHeader(frames: int, delay: int, padding: int):
+    lame = bytearray(b'LAME3.100' + bytes(15))
+    lame[21:24] = bytes((delay >> 4, (delay & 0x0F) << 4 | padding >> 8, padding & 0xFF))
+    return b'Info' + (3).to_bytes(4, 'big') + frames.to_bytes(4, 'big') + (41700).to_bytes(4, 'big') + bytes(lame)
+
+
+def test_tags_and_gapless_duration(tmp_path):
+    frames = id3Frame(b'TIT2', 'Song') + id3Frame(b'TPE1', 'Singer') + id3Frame(b'TRCK', '3/12')
+    path = tmp_path / 'a.mp3'
+    path.write_bytes(b'ID3\x03\x00\x00' + syncsafe(len(frames)) + frames +
+                     mpegFrame(lameHeader(100, 576, 1000)) + mpegFrame() * 3)
+    meta = readMetadata(str(path))
+    assert (meta['title'], meta['artist'], meta['track']) == ('Song', 'Singer', 3)
+    assert meta['duration'] == (100 * 1152 - 576 - 1000) / 44100 and meta['frames'] == 100
+
+
+def test_cbr_frame_count(tmp_path):
+    path = tmp_path / 'a.mp3'
+    path.write_bytes(mpegFrame() * 5)
+    meta = readMetadata(str(path))
+    assert meta['frames'] == 5 and meta['bitrate'] == 128000
+
+
+def test_truncated_id3_frame_header(tmp_path):
+    path = tmp_path / 'a.mp3'
+    path.write_bytes(b'ID3\x04\x00\x00' + syncsafe(100) + b'TIT2\x00\x00')
+    meta = readMetadata(str(path))
+    assert 'title' not in meta and meta['track'] == 0
+
+
+def test_truncated_lame_header(tmp_path):
+    path = tmp_path / 'a.mp3'
+    path.write_bytes(mpegFrame(lameHeader(100, 576, 1000))[:36 + 20 + 10])  # LAME标签之后只剩几个字节
+    meta = readMetadata(str(path))
+    assert meta['duration'] == 100 * 1152 / 44100
+
+
+def test_bad_file_keeps_batch(tmp_path):
+    good = tmp_path / 'good.mp3'
+    good.write_bytes(b'ID3\x03\x00\x00' + syncsafe(14) + id3Frame(b'TIT2', 'Song'))
+    bad = tmp_path / 'bad.mp3'
+    bad.write_bytes(b'ID3\x04\x00\x00' + syncsafe(100) + b'TIT2\x00\x00')
+    results = readMetadataBatch([(0, str(bad)), (1, str(tmp_path / 'missing.mp3')), (2, str(good))])
+    assert [index for index, _, _ in results] == [0, 1, 2]
+    assert results[1][2] == {} and results[2][2]['title'] == 'Song'
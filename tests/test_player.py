@@ -0,0 +1,59 @@
+import queue
+import time
+from mpgcore import Player
+from mpgbench import NullOutput, SyntheticBackend, SyntheticStream
+
+
+class MonoTailStream(SyntheticStream):
+    """后一半变成单声道，和mpg123解码时返回NEW_FORMAT一样"""
+
+    def readInto(self, view: memoryview):
+        if self.decoded >= self.total // 2 and self.format[1] == 2:
+            self.format = (self.RATE, 1, self.format[2])
+            self.sampleSize = 2
+        if self.decoded < self.total // 2:  # 正好在一半处变化
+            view = view[:(self.total // 2 - self.decoded) * self.sampleSize]
+        return SyntheticStream.readInto(self, view)
+
+
+class RecordingOutput(NullOutput):
+
+    def __init__(self):
+        NullOutput.__init__(self)
+        self.formats = list()
+
+    def start(self, rate: int, channels: int, encoding: int):
+        NullOutput.start(self, rate, channels, encoding)
+        self.formats.append((rate, channels, encoding))
+
+
+def test_seek_after_handover_keeps_next():
+    events = queue.Queue()
+    player = Player(lambda *args: events.put(args), backend=SyntheticBackend(trackSeconds=6.0, realtime=True, speed=4.0))
+    player.play('a.mp3')
+    player.prepareNext('b.mp3')
+    # 缓冲区大约4.4秒，输出到a的中间之前解码线程就接上了b
+    deadline = time.perf_counter() + 5
+    while player.stream.successor is None and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert player.stream.successor is not None and player.stream.successor.path == 'b.mp3'
+
+    player.seek(5.5)
+    assert events.get(timeout=5) == (True, 'b.mp3')
+    assert player.stream.path == 'b.mp3'
+    player.stop()
+
+
+def test_format_change_inside_stream():
+    events = queue.Queue()
+    backend = SyntheticBackend(trackSeconds=1.0)
+    backend.openStream = lambda path: MonoTailStream(path, backend.trackSeconds)
+    output = RecordingOutput()
+    backend.openOutput = lambda: output
+    player = Player(lambda *args: events.put(args), backend=backend)
+    player.play('a.mp3')
+    assert events.get(timeout=5) == (True,)
+    stereo = (SyntheticStream.RATE, 2, player.stream.format[2])
+    assert output.formats == [stereo, (SyntheticStream.RATE, 1, stereo[2])]
+    assert output.bytes == SyntheticStream.RATE // 2 * 4 + SyntheticStream.RATE // 2 * 2
+    assert player.position() == 1.0
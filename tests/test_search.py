@@ -0,0 +1,84 @@
+import pytest
+import mpgcore
+from mpgcore import Model, SearchIndex
+from mpgbench import syntheticRows
+
+
+def index(*texts):
+    search = SearchIndex()
+    for i, text in enumerate(texts):
+        search.add(i, text)
+    return search
+
+
+@pytest.fixture(params=[True, False], ids=['numpy', 'sets'])
+def numpy(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(mpgcore, 'np', None)
+
+
+def test_short_query_matches_word_prefix(numpy):
+    search = index('Abbey Road', 'Cabin Fever', 'ab ba')
+    assert list(search.search('ab')) == [0, 2]
+    assert list(search.search('a')) == [0, 2]
+    assert list(search.search('abi')) == [1]  # 三个字符以上匹配任意位置
+    assert list(search.search('bey roa')) == [0]
+    assert search.search('  ') is None
+
+
+def test_long_word_must_be_contiguous(numpy):
+    search = index('trackalbum', 'track album', 'rack')
+    assert list(search.search('trackalbum')) == [0]
+    assert list(search.search('rack')) == [0, 1, 2]
+    assert list(search.search('ackal')) == [0]
+
+
+def test_cjk_characters_are_word_starts(numpy):
+    search = index('周杰伦 晴天', '七里香')
+    assert list(search.search('晴')) == [0]
+    assert list(search.search('里香')) == [1]
+
+
+def test_updated_and_removed(numpy):
+    search = index('Old Name', 'Other')
+    search.add(0, 'New Title')
+    assert list(search.search('old')) == [] and list(search.search('ol')) == []
+    assert list(search.search('new')) == [0]
+    search.remove(1)
+    assert list(search.search('ot')) == []
+
+
+def test_query_in_chunks(numpy):
+    search = index(*(f'track {i}' for i in range(100)))
+    query = search.start('track 1', first=10)
+    found = list(query.take(5))
+    while not query.done():
+        found.extend(query.take(5))
+    assert found == [10, 11, 12, 13, 14, 15, 16, 17, 18, 19] and query.end == 100
+
+
+def test_filter_before_index_is_built(loop, backend, monkeypatch):
+    monkeypatch.setattr(Model, 'SEARCH_CHUNK', 100)
+    model = Model(loop.schedule, backend=backend)
+    shown = list()
+
+    def onData(ids, mode, append=False):
+        if not append:
+            del shown[:]
+        shown.extend(ids)
+    model.registerCallbacks(data=onData)
+    model.addRows(syntheticRows(3000))
+    model.setFilter('track 1')  # 索引还没有建立，先显示已经索引的部分
+    assert model.indexed < len(model.tracks)
+    assert loop.runUntil(lambda: model.indexed == len(model.tracks) and model.searching.done(), 10)
+    loop.runUntil(lambda: not model.bus.pending, 1)
+    expected = list(model.search.search('track 1'))
+    assert len(expected) > 1000
+    assert list(model.view) == expected and shown == expected
+
+    model.setFilter('')
+    assert len(model.view) == 3000
+    model.setFilter('track 1')
+    model.finishSearch()  # 无界面模式的search命令一次得到完整的结果
+    assert list(model.view) == expected
+    model.close()
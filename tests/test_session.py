@@ -0,0 +1,34 @@
+import json
+import os
+from mpgcore import Model, configDir
+
+
+def loadLibrary(loop, library, backend):
+    model = Model(loop.schedule, later=loop.later, backend=backend)
+    model.settings.updateSetting(model.settings.keyDirs, [str(library)])
+    model.loadMusicData()
+    assert loop.runUntil(lambda: len(model.view) == 3, 10)
+    return model
+
+
+def test_resume_into_missing_file(loop, library, backend):
+    loadLibrary(loop, library, backend).close()  # 曲库目录中留下三首
+    missing = library / 'b.mp3'
+    with open(os.path.join(configDir(), 'session.json'), 'w') as fp:
+        json.dump({'track': str(missing), 'position': 10.0, 'state': 'playing',
+                   'queue': [str(library / 'c.mp3')], 'history': []}, fp)
+    missing.unlink()
+
+    model = Model(loop.schedule, later=loop.later, backend=backend)
+    model.loadMusicData()
+    assert loop.runUntil(lambda: model.resume is None and not model.bus.pending, 10)
+    assert model.musicCurrent is None
+    assert model.player.state == model.player.PlayState.stop
+    assert [model.tracks.path(index) for index in model.queue] == [str(library / 'c.mp3')]
+    # 目录核对之后删除的歌曲从列表中去掉
+    assert loop.runUntil(lambda: len(model.view) == 2, 10)
+
+    # 之后的状态照常保存
+    assert model.play(model.tracks.item(model.view[0]))
+    assert model.session.get('track') == str(library / 'a.mp3')
+    model.close()
@@ -0,0 +1,60 @@
+from mpgcore import ShuffleEngine
+
+
+def engine(size=50, seed=7):
+    shuffle = ShuffleEngine(seed=seed)
+    shuffle.grow(size)
+    return shuffle
+
+
+def test_round_without_repeats():
+    shuffle = engine()
+    first = [shuffle.next() for _ in range(50)]
+    assert sorted(first) == list(range(50))
+    second = [shuffle.next() for _ in range(50)]
+    assert sorted(second) == list(range(50))
+    assert second[0] != first[-1]  # 新一轮开始时不重复上一首
+
+
+def test_peek_then_next_and_history():
+    shuffle = engine()
+    played = [shuffle.next() for _ in range(5)]
+    peeked = shuffle.peek()
+    assert shuffle.next() == peeked
+    assert shuffle.prev() == played[-1] and shuffle.prev() == played[-2]
+    assert shuffle.next() == played[-1] and shuffle.next() == peeked  # 前进时按历史
+    assert shuffle.prev() == played[-1]
+    shuffle.played(3)  # 从历史中间选了别的歌，丢弃前进的历史
+    assert shuffle.history[-1] == 3 and peeked not in shuffle.history[shuffle.cursor + 1:]
+
+
+def test_played_and_removed_are_skipped():
+    shuffle = engine(10)
+    shuffle.played(4)
+    shuffle.remove(7)
+    drawn = [shuffle.next() for _ in range(8)]
+    assert sorted(drawn) == [0, 1, 2, 3, 5, 6, 8, 9]
+    assert 7 not in shuffle.history and not shuffle.contains(7)
+
+
+def test_restrict_and_add():
+    shuffle = engine(20)
+    shuffle.restrict([2, 5, 11], 20)
+    assert sorted(shuffle.next() for _ in range(3)) == [2, 5, 11]
+    shuffle.resize(25)
+    shuffle.add([21, 5])  # 已经在范围内的不重复加入
+    assert len(shuffle) == 4 and shuffle.contains(21) and not shuffle.contains(22)
+    assert shuffle.next() == 21  # 本轮只剩新加入的
+
+
+def test_grow_mid_round_and_restore():
+    shuffle = engine(5)
+    first = [shuffle.next() for _ in range(5)]
+    shuffle.grow(8)
+    assert sorted(shuffle.next() for _ in range(3)) == [5, 6, 7]
+
+    restored = engine(5, seed=3)
+    restored.restore(first[:3] + [99])  # 不存在的id丢掉
+    assert restored.history == first[:3] and restored.prev() == first[1]
+    assert restored.next() == first[2]
+    assert sorted([restored.next(), restored.next()]) == sorted(first[3:])  # 历史中的算作本轮已经播放过
@@ -0,0 +1,52 @@
+import os
+import pytest
+np = pytest.importorskip('numpy')
+from mpgcore import Waveform
+
+
+def randomPeaks(count: int, seed=1):
+    rng = np.random.default_rng(seed)
+    low = rng.integers(-128, 0, count, dtype=np.int8)
+    return np.stack((low, (-low.astype(np.int16) - 1).astype(np.int8)), axis=1)
+
+
+@pytest.fixture
+def waveform(tmp_path):
+    peaks = randomPeaks(1000)
+    path = str(tmp_path / 'peaks' / 'a.peak')
+    Waveform.write(path, 12345, 678, 100.0, peaks)
+    return Waveform.open(path, 12345, 678), peaks
+
+
+def test_full_resolution(waveform):
+    wave, peaks = waveform
+    assert wave.duration() == 10.0
+    mins, maxs = wave.columns(0.0, 10.0, 1000)
+    assert (mins == peaks[:, 0]).all() and (maxs == peaks[:, 1]).all()
+
+
+def test_zoomed_out_is_envelope(waveform):
+    wave, peaks = waveform
+    mins, maxs = wave.columns(0.0, 8.0, 100)  # 每列8对，用第3级
+    assert (mins == peaks[:800, 0].reshape(100, 8).min(axis=1)).all()
+    assert (maxs == peaks[:800, 1].reshape(100, 8).max(axis=1)).all()
+    mins, maxs = wave.columns(0.0, 10.0, 7)  # 不是整数倍时每列也不超出整体的范围
+    assert mins.min() >= peaks[:, 0].min() and maxs.max() <= peaks[:, 1].max()
+
+
+def test_zoomed_in_and_past_end(waveform):
+    wave, peaks = waveform
+    mins, maxs = wave.columns(9.9, 10.1, 40)  # 每对占4列，后一半在结尾之后
+    assert (mins[:20] == np.repeat(peaks[990:, 0], 2)).all() and (maxs[:20] == np.repeat(peaks[990:, 1], 2)).all()
+    assert not mins[20:].any() and not maxs[20:].any()
+    assert not wave.columns(20.0, 30.0, 10)[1].any()
+    assert not wave.columns(5.0, 5.0, 10)[0].any()
+
+
+def test_open_rejects_stale_or_truncated(tmp_path, waveform):
+    path = str(tmp_path / 'peaks' / 'a.peak')
+    assert Waveform.open(path, 12345, 679) is None  # 音频文件变了
+    assert Waveform.open(str(tmp_path / 'missing.peak'), 12345, 678) is None
+    with open(path, 'r+b') as fp:
+        fp.truncate(os.path.getsize(path) - 1)
+    assert Waveform.open(path, 12345, 678) is None